@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2014-2016 EDF SA                                            #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+"""
+Minimal IPMI 2.0 RMCP+ (lanplus) client.
+
+It implements the session handshake of cipher suite 3 (RAKP-HMAC-SHA1,
+HMAC-SHA1-96 and AES-CBC-128) over asyncio UDP sockets, so that many BMC
+sessions are handled concurrently by a single process, and the common
+chassis and SEL commands. The other commands are left to ipmitool.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import struct
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+IPMI_PORT = 623
+# Seconds to wait for the answer to a packet before sending it again
+PACKET_TIMEOUT = 1
+PACKET_RETRIES = 3
+
+RMCP_HEADER = bytes([0x06, 0x00, 0xff, 0x07])
+AUTH_RMCPPLUS = 0x06
+
+PAYLOAD_IPMI = 0x00
+PAYLOAD_OPEN_SESSION_REQUEST = 0x10
+PAYLOAD_OPEN_SESSION_RESPONSE = 0x11
+PAYLOAD_RAKP1 = 0x12
+PAYLOAD_RAKP2 = 0x13
+PAYLOAD_RAKP3 = 0x14
+PAYLOAD_RAKP4 = 0x15
+PAYLOAD_ENCRYPTED = 0x80
+PAYLOAD_AUTHENTICATED = 0x40
+
+PRIVILEGE_ADMINISTRATOR = 0x04
+# Search the user by name only when checking the privilege level
+NAME_ONLY_LOOKUP = 0x10
+
+NETFN_CHASSIS = 0x00
+NETFN_APP = 0x06
+NETFN_STORAGE = 0x0a
+
+BMC_ADDRESS = 0x20
+CONSOLE_ADDRESS = 0x81
+
+# RAKP-HMAC-SHA1, HMAC-SHA1-96 and AES-CBC-128 (cipher suite 3)
+CIPHER_SUITE_3 = bytes([0x00, 0x00, 0x00, 0x08, 0x01, 0x00, 0x00, 0x00,
+                        0x01, 0x00, 0x00, 0x08, 0x01, 0x00, 0x00, 0x00,
+                        0x02, 0x00, 0x00, 0x08, 0x01, 0x00, 0x00, 0x00])
+
+RAKP_STATUS = {
+    0x01: "insufficient resources to create a session",
+    0x02: "invalid session ID",
+    0x0d: "invalid role",
+    0x0e: "unauthorized role or privilege level requested",
+    0x0f: "insufficient resources to create a session at the requested role",
+    0x10: "invalid name length",
+    0x11: "unauthorized name",
+    0x12: "unauthorized GUID",
+    0x13: "invalid integrity check value",
+}
+
+# Status of the open session response meaning that the BMC refuses cipher suite 3
+UNSUPPORTED_ALGORITHMS = (0x03, 0x04, 0x05, 0x11, 0x12, 0x13)
+
+
+class LanplusError(Exception):
+    """Error of a RMCP+ session or command"""
+
+
+class LanplusUnsupported(LanplusError):
+    """The BMC or the command is not supported by this client"""
+
+
+def checksum(data):
+    return (0x100 - sum(data)) & 0xff
+
+
+def hmac_sha1(key, data):
+    return hmac.new(key, data, hashlib.sha1).digest()
+
+
+class _Protocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait(data)
+
+    def error_received(self, exc):
+        self.queue.put_nowait(exc)
+
+
+class Session:
+    """RMCP+ session with a BMC
+
+       Usage:
+           async with Session(host, username, password) as session:
+               data = await session.command(NETFN_CHASSIS, 0x01)
+    """
+    def __init__(self, host, username, password, port=IPMI_PORT,
+                 timeout=PACKET_TIMEOUT, retries=PACKET_RETRIES):
+        self.host = host
+        self.port = port
+        self.username = username.encode()
+        self.password = password.encode()
+        self.timeout = timeout
+        self.retries = retries
+        self.transport = None
+        self.protocol = None
+        self.console_sid = struct.unpack("<I", os.urandom(4))[0] | 1
+        self.managed_sid = 0
+        self.sequence = 0
+        self.rq_seq = 0
+        self.k1 = None
+        self.k2 = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None or issubclass(exc_type, LanplusError):
+            if exc_type is not None:
+                self.retries = 1
+            try:
+                await self.close()
+            except LanplusError as error:
+                logging.debug("lanplus/close: {0}: {1}".format(self.host, error))
+        if self.transport is not None:
+            self.transport.close()
+
+    async def _exchange(self, build, parse):
+        """Send the packet returned by build until parse returns an answer
+           for one of the received packets."""
+        for attempt in range(self.retries):
+            self.transport.sendto(build())
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.timeout
+            while True:
+                try:
+                    data = await asyncio.wait_for(self.protocol.queue.get(),
+                                                  deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if isinstance(data, Exception):
+                    raise LanplusError(str(data))
+                answer = parse(data)
+                if answer is not None:
+                    return answer
+        raise LanplusError("no answer from {0}".format(self.host))
+
+    def _packet(self, payload_type, payload, session_id=0, sequence=0):
+        header = struct.pack("<BBIIH", AUTH_RMCPPLUS, payload_type, session_id, sequence, len(payload))
+        return RMCP_HEADER + header + payload
+
+    def _unpack(self, data, payload_type):
+        """Return the payload of a packet if it has the expected type"""
+        if len(data) < 16 or data[:4] != RMCP_HEADER or data[4] != AUTH_RMCPPLUS:
+            return None
+        if data[5] & 0x3f != payload_type:
+            return None
+        length = struct.unpack("<H", data[14:16])[0]
+        payload = data[16:16 + length]
+        if data[5] & PAYLOAD_AUTHENTICATED:
+            if self.k1 is None:
+                return None
+            # the auth code signs everything from the session header
+            signed, auth_code = data[4:-12], data[-12:]
+            if not hmac.compare_digest(hmac_sha1(self.k1, signed)[:12], auth_code):
+                return None
+        if data[5] & PAYLOAD_ENCRYPTED:
+            if self.k2 is None or len(payload) < 32:
+                return None
+            decryptor = Cipher(algorithms.AES(self.k2[:16]), modes.CBC(payload[:16])).decryptor()
+            payload = decryptor.update(payload[16:]) + decryptor.finalize()
+            payload = payload[:-(payload[-1] + 1)]
+        return payload
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.transport, self.protocol = await loop.create_datagram_endpoint(
+            _Protocol, remote_addr=(self.host, self.port))
+
+        # Open session, request cipher suite 3
+        request = struct.pack("<BBHI", 0, PRIVILEGE_ADMINISTRATOR, 0, self.console_sid) + CIPHER_SUITE_3
+
+        def parse_open(data):
+            payload = self._unpack(data, PAYLOAD_OPEN_SESSION_RESPONSE)
+            if payload is None or len(payload) < 2:
+                return None
+            if payload[1] in UNSUPPORTED_ALGORITHMS:
+                raise LanplusUnsupported("{0} does not support cipher suite 3".format(self.host))
+            if payload[1] != 0:
+                raise LanplusError("open session failed: {0}".format(
+                    RAKP_STATUS.get(payload[1], "status 0x{0:02x}".format(payload[1]))))
+            return payload
+
+        payload = await self._exchange(lambda: self._packet(PAYLOAD_OPEN_SESSION_REQUEST, request), parse_open)
+        console_sid, self.managed_sid = struct.unpack("<II", payload[4:12])
+        if console_sid != self.console_sid:
+            raise LanplusError("open session failed: wrong session ID")
+
+        # RAKP 1 and 2, authenticate the BMC
+        rm = os.urandom(16)
+        role = PRIVILEGE_ADMINISTRATOR | NAME_ONLY_LOOKUP
+        user = bytes([role, len(self.username)]) + self.username
+        rakp1 = struct.pack("<B3xI", 0, self.managed_sid) + rm + bytes([role, 0, 0, len(self.username)]) + self.username
+
+        def parse_rakp(payload_type, size):
+            def parse(data):
+                payload = self._unpack(data, payload_type)
+                if payload is None or len(payload) < 2:
+                    return None
+                if payload[1] != 0:
+                    raise LanplusError("authentication failed: {0}".format(
+                        RAKP_STATUS.get(payload[1], "status 0x{0:02x}".format(payload[1]))))
+                if len(payload) < size:
+                    raise LanplusError("authentication failed: truncated answer")
+                return payload
+            return parse
+
+        payload = await self._exchange(lambda: self._packet(PAYLOAD_RAKP1, rakp1), parse_rakp(PAYLOAD_RAKP2, 60))
+        rc, guid, auth_code = payload[8:24], payload[24:40], payload[40:60]
+        sids = struct.pack("<II", self.console_sid, self.managed_sid)
+        if not hmac.compare_digest(hmac_sha1(self.password, sids + rm + rc + guid + user), auth_code):
+            raise LanplusError("authentication failed: wrong password")
+
+        sik = hmac_sha1(self.password, rm + rc + user)
+        self.k1 = hmac_sha1(sik, b"\x01" * 20)
+        self.k2 = hmac_sha1(sik, b"\x02" * 20)
+
+        # RAKP 3 and 4, authenticate the console
+        auth_code = hmac_sha1(self.password, rc + struct.pack("<I", self.console_sid) + user)
+        rakp3 = struct.pack("<BBHI", 0, 0, 0, self.managed_sid) + auth_code
+        payload = await self._exchange(lambda: self._packet(PAYLOAD_RAKP3, rakp3), parse_rakp(PAYLOAD_RAKP4, 20))
+        integrity = hmac_sha1(sik, rm + struct.pack("<I", self.managed_sid) + guid)[:12]
+        if not hmac.compare_digest(integrity, payload[8:20]):
+            raise LanplusError("authentication failed: invalid integrity check value")
+
+        await self.command(NETFN_APP, 0x3b, bytes([PRIVILEGE_ADMINISTRATOR]))
+
+    def _session_packet(self, message):
+        """Encrypt and sign an IPMI message with the session keys"""
+        self.sequence += 1
+        pad = 15 - len(message) % 16
+        iv = os.urandom(16)
+        encryptor = Cipher(algorithms.AES(self.k2[:16]), modes.CBC(iv)).encryptor()
+        payload = iv + encryptor.update(message + bytes(range(1, pad + 1)) + bytes([pad])) + encryptor.finalize()
+        packet = self._packet(PAYLOAD_IPMI | PAYLOAD_ENCRYPTED | PAYLOAD_AUTHENTICATED,
+                              payload, self.managed_sid, self.sequence)
+        integrity_pad = (4 - (len(packet) - 4 + 2) % 4) % 4
+        packet += b"\xff" * integrity_pad + bytes([integrity_pad, 0x07])
+        return packet + hmac_sha1(self.k1, packet[4:])[:12]
+
+    async def command(self, netfn, cmd, data=b""):
+        """Send an IPMI command in the session and return the data of the
+           answer, raise LanplusError if its completion code is not 0."""
+        # the retransmits of a command keep its request sequence number, so
+        # that the BMC does not run it again when only the answer was lost
+        self.rq_seq = (self.rq_seq + 1) % 64
+        header = bytes([BMC_ADDRESS, netfn << 2])
+        body = bytes([CONSOLE_ADDRESS, self.rq_seq << 2, cmd]) + data
+        message = header + bytes([checksum(header)]) + body + bytes([checksum(body)])
+
+        def build():
+            return self._session_packet(message)
+
+        def parse(data):
+            message = self._unpack(data, PAYLOAD_IPMI)
+            if message is None or len(message) < 8:
+                return None
+            if message[1] >> 2 != netfn + 1 or message[4] >> 2 != self.rq_seq or message[5] != cmd:
+                return None
+            return message
+
+        answer = await self._exchange(build, parse)
+        if answer[6] != 0:
+            raise LanplusError("command 0x{0:02x} failed with completion code 0x{1:02x}".format(cmd, answer[6]))
+        return answer[7:-1]
+
+    async def close(self):
+        if self.k1 is not None:
+            await self.command(NETFN_APP, 0x3c, struct.pack("<I", self.managed_sid))
+            self.k1 = self.k2 = None
+
+
+async def power_status(session):
+    data = await session.command(NETFN_CHASSIS, 0x01)
+    return "Chassis Power is {0}".format("on" if data[0] & 0x01 else "off")
+
+
+def chassis_control(control, message):
+    async def command(session):
+        await session.command(NETFN_CHASSIS, 0x02, bytes([control]))
+        return "Chassis Power Control: {0}".format(message)
+    return command
+
+
+def bootdev(device, flags):
+    async def command(session):
+        # boot flags valid for the next boot only
+        await session.command(NETFN_CHASSIS, 0x08, bytes([0x05, 0x80, flags, 0x00, 0x00, 0x00]))
+        return "Set Boot Device to {0}".format(device)
+    return command
+
+
+def identify(interval):
+    async def command(session):
+        await session.command(NETFN_CHASSIS, 0x04, bytes([interval]))
+        return "Chassis identify interval: {0} seconds".format(interval)
+    return command
+
+
+async def sel_clear(session):
+    reservation = await session.command(NETFN_STORAGE, 0x42)
+    await session.command(NETFN_STORAGE, 0x47, reservation[:2] + b"CLR\xaa")
+    return "Clearing SEL.  Please allow a few seconds to erase."
+
+
+# ipmitool arguments handled natively
+COMMANDS = {
+    ("power", "status"): power_status,
+    ("chassis", "power", "status"): power_status,
+    ("power", "on"): chassis_control(0x01, "Up/On"),
+    ("power", "off"): chassis_control(0x00, "Down/Off"),
+    ("power", "soft"): chassis_control(0x05, "Soft"),
+    ("power", "reset"): chassis_control(0x03, "Reset"),
+    ("chassis", "power", "reset"): chassis_control(0x03, "Reset"),
+    ("chassis", "bootdev", "pxe"): bootdev("pxe", 0x04),
+    ("chassis", "bootdev", "disk"): bootdev("disk", 0x08),
+    ("chassis", "bootparam", "set", "bootflag", "force_bios"): bootdev("force_bios", 0x18),
+    ("chassis", "identify", "1"): identify(1),
+    ("sel", "clear"): sel_clear,
+}
+
+
+def supported(args):
+    return tuple(args) in COMMANDS
+
+
+async def execute(host, username, password, args, port=IPMI_PORT):
+    """Run the command given with the arguments of ipmitool on host and
+       return its output as printed by ipmitool."""
+    if not supported(args):
+        raise LanplusUnsupported("command not supported: {0}".format(" ".join(args)))
+    async with Session(host, username, password, port) as session:
+        return await COMMANDS[tuple(args)](session)
@@ -95,12 +95,6 @@ from pprint import pprint, pformat
 from textwrap import fill
 from datetime import datetime
 
-try:
-    from prettytable import PrettyTable as prettytable
-except:
-    logging.warning("Missing Dependency: run 'pip install prettytable' or install 'python3-prettytable' package.")
-    pass
-
 def copy(software, basedir, target):
     software = re.sub(r'/(\.)?', '-', software)
     if not software.endswith(".eb"):
@@ -315,6 +309,8 @@ def search(software, basedir, width, force):
                     easyconfig[CFGS] = [path]
 
             try:
+                # imported here as it is slow to load
+                from prettytable import PrettyTable as prettytable
                 table = prettytable()
                 table.field_names = ["easyconfig files"]
             except:
@@ -36,15 +36,26 @@
 Creates and updates the images of installation of a cluster.
 
 Usage:
-    clara images create [--no-sync] <dist> [<image>] [--keep-chroot-dir]
+    clara images create [--no-sync] [--no-cache] <dist> [<image>] [--keep-chroot-dir]
     clara images unpack ( <dist> | --image=<path> )
     clara images repack <directory> ( <dist> | --image=<path> )
-    clara images edit <dist> [<image>]
-    clara images initrd [--no-sync] <dist> [--output=<dirpath>]
+    clara images edit <dist> [<image>] [--overlay | --delta]
+    clara images initrd [--no-sync] <dist> [--output=<dirpath>] [--kver=<kvers>]
     clara images push <dist> [<image>]
+    clara images benchmark <dist> [<image>] [--profiles=<names>]
     clara images -h | --help | help
+
+Options:
+    --overlay           Edit the image in an overlay on top of the mounted image
+                        instead of unpacking it.
+    --delta             Like --overlay, but only save the changes in a delta image.
+    --kver=<kvers>      Comma separated list of kernel versions, kver in the
+                        configuration by default.
+    --profiles=<names>  Comma separated list of squashfs profiles to benchmark,
+                        all the known profiles by default.
 """
 
+import concurrent.futures
 import errno
 import logging
 import os
@@ -56,12 +67,14 @@ import sys
 import tempfile
 import time
 import glob
+import hashlib
 import docopt
 import re
-import requests
+import shlex
 
-from clara.utils import clara_exit, run, makedirs_mode, get_from_config, get_from_config_or, has_config_value, conf, get_bool_from_config_or
-from clara import sftp
+from clara.utils import clara_exit, run, makedirs_mode, get_from_config, get_from_config_or, has_config_value, conf, get_bool_from_config_or, getconfig, \
+    get_int_from_config_or, get_distributions
+from clara import relay, sftp
 
 _opts = {'keep_chroot_dir': None}
 
@@ -92,6 +105,15 @@ dists.update({
       } for distro in ["rhel", "centos", "rocky", "almalinux"]
 })
 
+# Builtin mksquashfs compression profiles, selected with squashfs_profile.
+# More profiles can be defined with squashfs_profile_<name> in config.ini.
+squashfs_profiles = {
+    "default": "",
+    "fast": "-comp zstd -Xcompression-level 3 -b 1M",
+    "lz4": "-comp lz4 -b 1M",
+    "release": "-comp xz -Xbcj x86 -b 1M",
+}
+
 class osRelease:
     # Common base class for OS release
     def __init__(self, ID, VERSION_ID):
@@ -287,6 +309,7 @@ Notice a that, if need, directory {} will be created to receive gpg keys.
             logging.info("creating directoring %s" % dir_path)
             makedirs_mode(dir_path, 0o0755)
 
+        import requests
         response = requests.get(url)
         if response.status_code == 200:
             logging.info("Dowloading gpg key from url %s to %s" % (url, dir_path))
@@ -383,7 +406,7 @@ path-include=/usr/share/locale/locale.alias
                              stdin=part1.stdout,
                              universal_newlines=True)
     part1.stdout.close()  # Allow part1 to receive a SIGPIPE if part2 exits.
-    #output = part2.communicate()[0]
+    part2.wait()
 
 
 def mount_chroot(work_dir):
@@ -610,6 +633,162 @@ def run_script_post_creation(work_dir, dist):
         run_chroot(["chroot", work_dir, "bash", "/tmp/script"], work_dir)
 
 
+def get_squashfs_profiles(dist):
+    profiles = dict(squashfs_profiles)
+    for section in ["images", "images-" + dist]:
+        if getconfig().has_section(section):
+            for key, value in getconfig().items(section):
+                if key.startswith("squashfs_profile_"):
+                    profiles[key[len("squashfs_profile_"):]] = value.strip()
+    return profiles
+
+
+def squashfs_opts(dist, profile=None):
+    """Return the mksquashfs options for the compression profile, the
+       squashfs_profile of the distribution by default."""
+    if profile is None:
+        profile = get_from_config_or("images", "squashfs_profile", dist, "default")
+    profiles = get_squashfs_profiles(dist)
+    if profile not in profiles:
+        clara_exit("Unknown squashfs profile '{0}', known profiles are: {1}"
+                   .format(profile, ", ".join(sorted(profiles))))
+
+    processors = get_from_config_or("images", "squashfs_processors", dist, str(os.cpu_count()))
+    opts = ["-no-exports", "-noappend", "-processors", processors]
+    opts += shlex.split(profiles[profile])
+    if conf.ddebug:
+        opts.append("-info")
+    return opts
+
+
+def mksquashfs(work_dir, squashfs_file, dist, profile=None):
+    run(["mksquashfs", work_dir, squashfs_file] + squashfs_opts(dist, profile))
+
+
+def sftp_push(files, destination, mode, dist):
+    """Upload files in destination on all the hosts of the distribution,
+       with at most sftp_parallel concurrent transfers. With sftp_chunked,
+       only the chunks which changed since the previous push are sent. With
+       push_fanout, the hosts relay the files to each other."""
+    return sftp_push_batches([(files, destination)], mode, dist)
+
+
+def sftp_push_batches(batches, mode, dist):
+    """Upload each (files, destination) batch on all the hosts of the
+       distribution in a single SFTP session, return the failed hosts."""
+    sftp_user = get_from_config("images", "sftp_user", dist)
+    sftp_private_key = get_from_config("images", "sftp_private_key", dist)
+    sftp_passphrase = get_from_config_or("images", "sftp_passphrase", dist, None)
+    sftp_hosts = get_from_config("images", "hosts", dist).split(',')
+    sftp_parallel = get_int_from_config_or("images", "sftp_parallel", dist)
+    chunk_size = None
+    if get_bool_from_config_or("images", "sftp_chunked", dist, False):
+        chunk_size = get_int_from_config_or("images", "sftp_chunk_size", dist, 4) * 1024 * 1024
+    fanout = get_int_from_config_or("images", "push_fanout", dist, 0)
+    with sftp.Sftp(sftp_hosts, sftp_user, sftp_private_key, sftp_passphrase,
+                   sftp_parallel, chunk_size) as sftp_client:
+        failed = set()
+        for files, destination in batches:
+            if fanout > 0:
+                command = get_from_config_or("images", "push_relay_command", dist, relay.RELAY_COMMAND)
+                failed.update(relay.Relay(sftp_client, fanout, command).upload(files, destination, mode))
+            else:
+                failed.update(sftp_client.upload(files, destination, mode))
+        return sorted(failed)
+
+
+def install_files_inputs(dist):
+    """Return the paths of the files copied in the image by install_files"""
+    paths = []
+    list_files_to_install = get_from_config_or("images", "list_files_to_install", dist, "")
+    if os.path.isfile(list_files_to_install):
+        paths.append(list_files_to_install)
+        dir_origin = get_from_config_or("images", "dir_files_to_install", dist, "")
+        with open(list_files_to_install, "r") as file_to_read:
+            for line in file_to_read:
+                if len(line.split()):
+                    paths.append(dir_origin + "/" + line.split()[0])
+    return paths
+
+
+# Cached stages of the creation of an image, with the config values and the
+# files they depend on. A snapshot of the chroot is stored in build_cache_dir
+# after each stage.
+build_stages = [
+    ("bootstrap",
+     ["debiandist", "debmirror", "baseurl", "list_repos", "gpg_check", "gpg_keyring",
+      "proxy", "etc_hosts"],
+     lambda dist: []),
+    ("files",
+     ["list_files_to_install", "dir_files_to_install"],
+     install_files_inputs),
+    ("system",
+     ["foreign_archs", "preseed_file", "package_file", "group_pkgs", "extra_packages_image", "proxy"],
+     lambda dist: [get_from_config_or("images", "preseed_file", dist, ""),
+                   get_from_config_or("images", "package_file", dist, "")]),
+]
+
+
+def stage_key(previous_key, stage, dist):
+    """Return the hash of the inputs of a build stage, chained with the key of
+       the previous stage."""
+    name, values, files = stage
+    digest = hashlib.sha256()
+    digest.update("{0}:{1}:{2}\n".format(previous_key, dist, name).encode())
+    for value in values:
+        digest.update("{0}={1}\n".format(value, get_from_config_or("images", value, dist, "")).encode())
+    for path in files(dist):
+        digest.update(path.encode())
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def build_chroot(work_dir, dist, use_cache=True):
+    """Run the stages building the chroot of the image. When build_cache_dir is
+       set, start from the snapshot of the last stage whose inputs haven't
+       changed and store a snapshot after each stage that is run."""
+    builders = {"bootstrap": base_install,
+                "files": install_files,
+                "system": system_install}
+    cache_dir = get_from_config_or("images", "build_cache_dir", dist, "")
+    if len(cache_dir) == 0:
+        for name, _, _ in build_stages:
+            builders[name](work_dir, dist)
+        return
+
+    cache_dir = os.path.join(cache_dir, dist)
+    makedirs_mode(cache_dir, 0o0700)
+    snapshots = []
+    key = ""
+    for stage in build_stages:
+        key = stage_key(key, stage, dist)
+        snapshots.append(os.path.join(cache_dir, "{0}-{1}.tar".format(stage[0], key[:16])))
+
+    start = 0
+    if use_cache:
+        for i in reversed(range(len(build_stages))):
+            if os.path.isfile(snapshots[i]):
+                logging.info("Restoring stage {0} from {1}".format(build_stages[i][0], snapshots[i]))
+                run(["tar", "--numeric-owner", "--xattrs", "--acls", "-C", work_dir,
+                     "-xpf", snapshots[i]])
+                start = i + 1
+                break
+
+    for i in range(start, len(build_stages)):
+        name = build_stages[i][0]
+        builders[name](work_dir, dist)
+
+        # Only keep the latest snapshot of each stage
+        for old in glob.glob(os.path.join(cache_dir, name + "-*.tar")):
+            os.remove(old)
+        logging.info("Storing snapshot of stage {0} in {1}".format(name, snapshots[i]))
+        run(["tar", "--numeric-owner", "--xattrs", "--acls", "-C", work_dir,
+             "-cpf", snapshots[i] + ".tmp", "."])
+        os.rename(snapshots[i] + ".tmp", snapshots[i])
+
+
 def genimg(image, work_dir, dist):
     if (image is None):
         squashfs_file = get_from_config("images", "trg_img", dist)
@@ -634,22 +813,14 @@ def genimg(image, work_dir, dist):
 
     makedirs_mode(os.path.dirname(squashfs_file), 0o0755)
 
-    if conf.ddebug:
-        run(["mksquashfs", work_dir, squashfs_file, "-no-exports", "-noappend", "-info"])
-    else:
-        run(["mksquashfs", work_dir, squashfs_file, "-no-exports", "-noappend"])
+    mksquashfs(work_dir, squashfs_file, dist)
 
     os.chmod(squashfs_file, 0o755)
 
     sftp_mode = has_config_value("images", "hosts", dist)
     dargs = docopt.docopt(__doc__)
     if sftp_mode and not dargs['--no-sync']:
-        sftp_user = get_from_config("images", "sftp_user", dist)
-        sftp_private_key = get_from_config("images", "sftp_private_key", dist)
-        sftp_passphrase = get_from_config_or("images", "sftp_passphrase", dist, None)
-        sftp_hosts = get_from_config("images", "hosts", dist).split(',')
-        sftp_client = sftp.Sftp(sftp_hosts, sftp_user, sftp_private_key, sftp_passphrase)
-        sftp_client.upload([squashfs_file], os.path.dirname(squashfs_file), 0o755)
+        sftp_push([squashfs_file], os.path.dirname(squashfs_file), 0o755, dist)
 
 
 def extract_image(image, dist):
@@ -675,21 +846,23 @@ def extract_image(image, dist):
           "\tclara images repack {0} ( <dist> | --image=<path> )".format(extract_dir))
 
 
-def geninitrd(path, work_dir, dist):
+def initrd_generator(work_dir, ID, distrib, kver):
+    """Return the command generating the initrd of kver in the image"""
+    if dists[ID]['bootstrapper'] == "dnf":
+        opts = ["--force", "--add", "livenet", "-v", "/tmp/initrd-" + kver, "--kver", kver,
+                "--no-early-microcode"]
+    else:
+        opts = ["-o", "/tmp/initrd-" + kver, kver]
+    return ["chroot", work_dir, distrib["initrdGen"]] + opts
+
+
+def prepare_initrd_tree(work_dir, dist, kvers):
+    """Unpack the image of dist once and install all the kernels and the
+       packages needed to generate their initrds."""
     ID, VERSION_ID = get_osRelease(dist)
     image = imageInstant(work_dir, ID, VERSION_ID)
     distrib = image.dist
 
-    if (path is None):
-        trg_dir = get_from_config("images", "trg_dir", dist)
-
-        if (trg_dir=="" or trg_dir==None):
-            trg_dir = "/var/lib/clara/images/"
-    else:
-        trg_dir = path
-
-
-    makedirs_mode(trg_dir, 0o0755)
     squashfs_file = get_from_config("images", "trg_img", dist)
     if (squashfs_file=="" or squashfs_file==None):
         image_name=dist+"_image.squashfs"
@@ -704,19 +877,16 @@ def geninitrd(path, work_dir, dist):
 
     mount_chroot(work_dir)
 
-    # Install the kernel in the image
-    kver = get_from_config("images", "kver", dist)
-    if len(kver) == 0:
-        clara_exit("kver hasn't be set in config.ini")
-    else:
-        if ID == "debian":
-            run_chroot(["chroot", work_dir, distrib["pkgManager"], "update"], work_dir)
-            run_chroot(["chroot", work_dir, distrib["pkgManager"], "install",
-                    "--no-install-recommends", "--yes", "--force-yes", "linux-image-" + kver], work_dir)
-        if dists[ID]['bootstrapper'] == "dnf":
-            run_chroot(["chroot", work_dir, distrib["pkgManager"], "makecache"], work_dir)
-            run_chroot(["chroot", work_dir, distrib["pkgManager"], "install",
-                    "-y", "--nobest", "kernel-"+ kver], work_dir)
+    # Install the kernels in the image
+    if ID == "debian":
+        run_chroot(["chroot", work_dir, distrib["pkgManager"], "update"], work_dir)
+        run_chroot(["chroot", work_dir, distrib["pkgManager"], "install",
+                "--no-install-recommends", "--yes", "--force-yes"] +
+                ["linux-image-" + kver for kver in kvers], work_dir)
+    if dists[ID]['bootstrapper'] == "dnf":
+        run_chroot(["chroot", work_dir, distrib["pkgManager"], "makecache"], work_dir)
+        run_chroot(["chroot", work_dir, distrib["pkgManager"], "install",
+                "-y", "--nobest"] + ["kernel-" + kver for kver in kvers], work_dir)
     # Install packages from 'packages_initrd'
     packages_initrd = get_from_config("images", "packages_initrd", dist)
     if len(packages_initrd) == 0:
@@ -725,42 +895,104 @@ def geninitrd(path, work_dir, dist):
         pkgs = packages_initrd.split(',')
         if ID == "debian":
             opts = ["--no-install-recommends", "--yes", "--force-yes"]
-            intitrd_opts = ["-o", "/tmp/initrd-" + kver, kver]
         if dists[ID]['bootstrapper'] == "dnf":
             opts = ["-y", "--nobest"]
-            intitrd_opts = ["--force", "--add", "livenet", "-v", "/tmp/initrd-"+ kver, "--kver", kver,
-                            "--no-early-microcode"]
         opts = ["chroot", work_dir, distrib["pkgManager"], "install"] + opts + pkgs
         run_chroot(opts, work_dir)
 
-    # Generate the initrd in the image
-    intitrd_opts = ["chroot", work_dir, distrib["initrdGen"]] + intitrd_opts
-    run_chroot(intitrd_opts, work_dir)
+    return [initrd_generator(work_dir, ID, distrib, kver) for kver in kvers]
 
-    umount_chroot(work_dir)
 
-    # Copy the initrd out of the chroot
-    initrd_file = trg_dir + "/initrd-" + kver
-    shutil.copy(work_dir + "/tmp/initrd-" + kver, initrd_file)
-    os.chmod(initrd_file, 0o644)
-    logging.info("Initrd available at " + initrd_file)
+def _generate_initrd(cmd):
+    """Run an initrd generator in a worker process, return the error if any"""
+    try:
+        run(cmd, exit_on_error=False)
+    except RuntimeError as error:
+        return str(error)
+    return None
+
+
+def geninitrd(path, work_dir, dists_list, kvers=None):
+    """Generate the initrds of all the kernels of all the distributions. Each
+       image is unpacked and prepared once, then all the initrd generators
+       run concurrently in a pool of processes."""
+    trg_dirs = {}
+    dist_kvers = {}
+    for dist in dists_list:
+        if (path is None):
+            trg_dir = get_from_config("images", "trg_dir", dist)
+
+            if (trg_dir=="" or trg_dir==None):
+                trg_dir = "/var/lib/clara/images/"
+        else:
+            trg_dir = path
+        makedirs_mode(trg_dir, 0o0755)
+        trg_dirs[dist] = trg_dir
+
+        if kvers is None:
+            kver = get_from_config("images", "kver", dist)
+            if len(kver) == 0:
+                clara_exit("kver hasn't be set in config.ini")
+            dist_kvers[dist] = kver.split(',')
+        else:
+            dist_kvers[dist] = kvers.split(',')
+
+    # One unpacked tree per image, with all its kernels
+    generators = []
+    for dist in dists_list:
+        dist_dir = os.path.join(work_dir, dist)
+        os.mkdir(dist_dir)
+        for kver, cmd in zip(dist_kvers[dist], prepare_initrd_tree(dist_dir, dist, dist_kvers[dist])):
+            generators.append((dist, kver, cmd))
+
+    # Generate the initrds in the images
+    parallel = get_int_from_config_or("images", "initrd_parallel", dists_list[0],
+                                        os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=parallel) as executor:
+        errors = list(executor.map(_generate_initrd, [cmd for _, _, cmd in generators]))
+
+    for dist in dists_list:
+        umount_chroot(os.path.join(work_dir, dist))
+
+    failed = []
+    batches = {}
+    for (dist, kver, _), error in zip(generators, errors):
+        if error is not None:
+            logging.error("Failed to generate the initrd {0} of {1}: {2}".format(kver, dist, error))
+            failed.append("{0}/{1}".format(dist, kver))
+            continue
+        dist_dir = os.path.join(work_dir, dist)
+        trg_dir = trg_dirs[dist]
+
+        # Copy the initrd out of the chroot
+        initrd_file = trg_dir + "/initrd-" + kver
+        shutil.copy(dist_dir + "/tmp/initrd-" + kver, initrd_file)
+        os.chmod(initrd_file, 0o644)
+        logging.info("Initrd available at " + initrd_file)
+
+        # Copy vmlinuz out of the chroot
+        vmlinuz_file = trg_dir + "/vmlinuz-" + kver
+        shutil.copy(dist_dir + "/boot/vmlinuz-" + kver, vmlinuz_file)
+        os.chmod(vmlinuz_file, 0o644)
+        logging.info("vmlinuz available at " + vmlinuz_file)
+
+        batches.setdefault(dist, []).append(([initrd_file, vmlinuz_file], trg_dir))
+
+    # Send files where they will be used, in one session per set of hosts
+    dargs = docopt.docopt(__doc__)
+    if not dargs['--no-sync']:
+        sessions = {}
+        for dist in dists_list:
+            if dist in batches and has_config_value("images", "hosts", dist):
+                session = (get_from_config("images", "hosts", dist),
+                           get_from_config("images", "sftp_user", dist))
+                sessions.setdefault(session, (dist, []))[1].extend(batches[dist])
+        for dist, dist_batches in sessions.values():
+            sftp_push_batches(dist_batches, 0o644, dist)
 
-    # Copy vmlinuz out of the chroot
-    vmlinuz_file = trg_dir + "/vmlinuz-" + kver
-    shutil.copy(work_dir + "/boot/vmlinuz-" + kver, vmlinuz_file)
-    os.chmod(vmlinuz_file, 0o644)
-    logging.info("vmlinuz available at " + vmlinuz_file)
+    if failed:
+        clara_exit("Failed to generate the initrds: {0}".format(", ".join(failed)))
 
-    # Send files where they will be used
-    sftp_mode = has_config_value("images", "hosts", dist)
-    dargs = docopt.docopt(__doc__)
-    if sftp_mode and not dargs['--no-sync']:
-        sftp_user = get_from_config("images", "sftp_user", dist)
-        sftp_private_key = get_from_config("images", "sftp_private_key", dist)
-        sftp_passphrase = get_from_config_or("images", "sftp_passphrase", dist, None)
-        sftp_hosts = get_from_config("images", "hosts", dist).split(',')
-        sftp_client = sftp.Sftp(sftp_hosts, sftp_user, sftp_private_key, sftp_passphrase)
-        sftp_client.upload([initrd_file, vmlinuz_file], trg_dir, 0o644)
 
 def push(image, dist):
     if (image is None):
@@ -778,17 +1010,69 @@ def push(image, dist):
     sftp_mode = has_config_value("images", "hosts", dist)
     dargs = docopt.docopt(__doc__)
     if sftp_mode:
-        sftp_user = get_from_config("images", "sftp_user", dist)
-        sftp_private_key = get_from_config("images", "sftp_private_key", dist)
-        sftp_passphrase = get_from_config_or("images", "sftp_passphrase", dist, None)
-        sftp_hosts = get_from_config("images", "hosts", dist).split(',')
-        sftp_client = sftp.Sftp(sftp_hosts, sftp_user, sftp_private_key, sftp_passphrase)
-        sftp_client.upload([squashfs_file], os.path.dirname(squashfs_file), 0o755)
+        sftp_push([squashfs_file], os.path.dirname(squashfs_file), 0o755, dist)
     else:
         clara_exit("Hosts not found for the image {0}".format(squashfs_file))
 
 
-def edit(image, work_dir, dist):
+def umount_overlay(work_dir):
+    for mount_point in ["merged", "lower"]:
+        path = os.path.join(work_dir, mount_point)
+        if os.path.ismount(path):
+            run(["umount", path])
+
+
+def edit_overlay(squashfs_file, work_dir, dist, delta=False):
+    """Edit the image in an overlayfs stacked on the read-only mounted image,
+       so that only modified files are written, then repack the image (or
+       just the changes with delta) if anything changed."""
+    lower, upper, overlay_work, merged = [os.path.join(work_dir, d)
+                                          for d in ["lower", "upper", "work", "merged"]]
+    for directory in [lower, upper, overlay_work, merged]:
+        os.mkdir(directory)
+
+    logging.info("Mounting {0} with an overlay in {1} ...".format(squashfs_file, merged))
+    run(["mount", "-t", "squashfs", "-o", "loop,ro", squashfs_file, lower])
+    run(["mount", "-t", "overlay", "overlay", "-o",
+         "lowerdir={0},upperdir={1},workdir={2}".format(lower, upper, overlay_work), merged])
+
+    # Work in the image
+    os.chdir(merged)
+    logging.info("Entering into a bash shell to edit the image. ^d when you have finished.")
+    os.putenv("PROMPT_COMMAND", "echo -ne  '\e[1;31m({0}) clara images> \e[0m'".format(dist))
+    pty.spawn(["/bin/bash"])
+    os.chdir(work_dir)
+
+    if len(os.listdir(upper)) == 0:
+        umount_overlay(work_dir)
+        logging.info("No changes made, the image {0} hasn't been modified.".format(squashfs_file))
+        return
+
+    save = input('Save changes made in the image? (N/y)')
+    logging.debug("Input from the user: '{0}'".format(save))
+    if save not in ('Y', 'y'):
+        umount_overlay(work_dir)
+        clara_exit("Changes ignored. The image {0} hasn't been modified.".format(squashfs_file))
+
+    if delta:
+        # Deleted files are kept as overlayfs whiteouts in the delta image
+        delta_file = squashfs_file + ".delta"
+        umount_overlay(work_dir)
+        mksquashfs(upper, delta_file, dist)
+        os.chmod(delta_file, 0o755)
+        logging.info("\nThe changes made in the image have been saved at {0}".format(delta_file))
+        return
+
+    mksquashfs(merged, squashfs_file + ".new", dist)
+    umount_overlay(work_dir)
+    os.rename(squashfs_file, squashfs_file + ".old")
+    os.rename(squashfs_file + ".new", squashfs_file)
+    os.chmod(squashfs_file, 0o755)
+    logging.info("\nPrevious image renamed to {0}."
+          "\nThe image has been repacked at {1}".format(squashfs_file + ".old", squashfs_file))
+
+
+def edit(image, work_dir, dist, overlay=False, delta=False):
     if (image is None):
         squashfs_file = get_from_config("images", "trg_img", dist)
         if (squashfs_file=="" or squashfs_file==None):
@@ -800,6 +1084,10 @@ def edit(image, work_dir, dist):
     if not os.path.isfile(squashfs_file):
         clara_exit("{0} doesn't exist.".format(squashfs_file))
 
+    if overlay or delta:
+        edit_overlay(squashfs_file, work_dir, dist, delta)
+        return
+
     # Extract the image.
     logging.info("Extracting {0} to {1} ...".format(squashfs_file, work_dir))
     if conf.ddebug:
@@ -820,18 +1108,74 @@ def edit(image, work_dir, dist):
 
     # Rename old image and recreate new one
     os.rename(squashfs_file, squashfs_file + ".old")
-    if conf.ddebug:
-        run(["mksquashfs", work_dir, squashfs_file, "-no-exports", "-noappend", "-info"])
-    else:
-        run(["mksquashfs", work_dir, squashfs_file, "-no-exports", "-noappend"])
+    mksquashfs(work_dir, squashfs_file, dist)
 
     os.chmod(squashfs_file, 0o755)
     logging.info("\nPrevious image renamed to {0}."
           "\nThe image has been repacked at {1}".format(squashfs_file + ".old", squashfs_file))
 
 
-def clean_and_exit(work_dir):
+def benchmark(image, work_dir, dist, profiles=None):
+    """Build the image with each squashfs profile and report the build time,
+       the size of the image and its decompression speed."""
+    if (image is None):
+        squashfs_file = get_from_config("images", "trg_img", dist)
+        if (squashfs_file=="" or squashfs_file==None):
+            image_name=dist+"_image.squashfs"
+            squashfs_file = "/var/lib/clara/images/"+image_name
+    else:
+        squashfs_file = image
+
+    if not os.path.isfile(squashfs_file):
+        clara_exit("{0} doesn't exist.".format(squashfs_file))
+
+    if profiles is None:
+        profiles = sorted(get_squashfs_profiles(dist))
+    else:
+        profiles = profiles.split(',')
+    # check all profiles before starting
+    for profile in profiles:
+        squashfs_opts(dist, profile)
+
+    chroot_dir = os.path.join(work_dir, "chroot")
+    logging.info("Extracting {0} to {1} ...".format(squashfs_file, chroot_dir))
+    run(["unsquashfs", "-f", "-d", chroot_dir, squashfs_file])
+    chroot_size = int(subprocess.check_output(["du", "-sb", chroot_dir]).split()[0])
+
+    results = []
+    for profile in profiles:
+        bench_file = os.path.join(work_dir, profile + ".squashfs")
+        extract_dir = os.path.join(work_dir, profile + ".extract")
+        logging.info("Benchmarking squashfs profile {0} ...".format(profile))
+
+        start = time.time()
+        mksquashfs(chroot_dir, bench_file, dist, profile)
+        build_time = time.time() - start
+        size = os.path.getsize(bench_file)
+
+        start = time.time()
+        run(["unsquashfs", "-n", "-f", "-d", extract_dir, bench_file], stdout=subprocess.DEVNULL)
+        extract_time = time.time() - start
+
+        results.append((profile, build_time, size, chroot_size / extract_time / 1024 / 1024))
+        shutil.rmtree(extract_dir)
+        os.remove(bench_file)
+
+    line = "{:>12} {:>12} {:>12} {:>8} {:>16}"
+    logging.info(line.format("Profile", "Build (s)", "Size (MB)", "Ratio", "Unpack (MB/s)"))
+    for profile, build_time, size, speed in results:
+        logging.info(line.format(profile, "%.1f" % build_time, "%.1f" % (size / 1024 / 1024),
+                                 "%.2f" % (chroot_size / size), "%.1f" % speed))
+
+
+def clean_and_exit(work_dir, dists_list=()):
     if os.path.exists(work_dir):
+        # initrd prepares a chroot per distribution in work_dir
+        for dist in dists_list:
+            dist_dir = os.path.join(work_dir, dist)
+            if os.path.isdir(dist_dir):
+                umount_chroot(dist_dir)
+        umount_overlay(work_dir)
         umount_chroot(work_dir)
         if not _opts['keep_chroot_dir']:
             shutil.rmtree(work_dir)
@@ -846,8 +1190,12 @@ def main():
     dist = get_from_config("common", "default_distribution")
     if dargs['<dist>'] is not None:
         dist = dargs["<dist>"]
-    if dist not in get_from_config("common", "allowed_distributions"):
-        clara_exit("{0} is not a know distribution".format(dist))
+    # initrd accepts a comma separated list of distributions
+    dists_list = dist.split(',') if dargs['initrd'] else [dist]
+    for dist_name in dists_list:
+        if dist_name not in get_distributions():
+            clara_exit("{0} is not a know distribution".format(dist_name))
+    dist = dists_list[0]
 
     work_dir = ""
     if dargs['repack']:
@@ -862,14 +1210,12 @@ def main():
     # - the program dies because of a signal
     # - os._exit() is invoked directly
     # - a Python fatal error is detected (in the interpreter)
-    atexit.register(clean_and_exit, work_dir)
+    atexit.register(clean_and_exit, work_dir, dists_list if dargs['initrd'] else ())
 
     if dargs['create']:
         if dargs["--keep-chroot-dir"]:
             _opts['keep_chroot_dir'] = True
-        base_install(work_dir, dist)
-        install_files(work_dir, dist)
-        system_install(work_dir, dist)
+        build_chroot(work_dir, dist, not dargs["--no-cache"])
         remove_files(work_dir, dist)
         run_script_post_creation(work_dir, dist)
         genimg(dargs['<image>'], work_dir, dist)
@@ -878,11 +1224,13 @@ def main():
     elif dargs['unpack']:
         extract_image(dargs['--image'], dist)
     elif dargs['initrd']:
-        geninitrd(dargs['--output'], work_dir, dist)
+        geninitrd(dargs['--output'], work_dir, dists_list, dargs['--kver'])
     elif dargs['edit']:
-        edit(dargs['<image>'], work_dir, dist)
+        edit(dargs['<image>'], work_dir, dist, dargs['--overlay'], dargs['--delta'])
     elif dargs['push']:
         push(dargs['<image>'], dist)
+    elif dargs['benchmark']:
+        benchmark(dargs['<image>'], work_dir, dist, dargs['--profiles'])
 
 if __name__ == '__main__':
     main()
@@ -37,7 +37,7 @@ Manages and get the status from the nodes of a cluster.
 
 Usage:
     clara ipmi connect [-jf] <host>
-    clara ipmi getmac <hostlist>
+    clara ipmi [--p=<level>] getmac <hostlist> [--format=<format>]
     clara ipmi [--p=<level>] deconnect <hostlist>
     clara ipmi [--p=<level>] (on|off|reboot|soft) <hostlist>
     clara ipmi [--p=<level>] status <hostlist>
@@ -51,12 +51,14 @@ Usage:
     clara ipmi [--p=<level>] reset <hostlist>
     clara ipmi [--p=<level>] sellist <hostlist>
     clara ipmi [--p=<level>] selclear <hostlist>
+    clara ipmi [--p=<level>] selsync <hostlist>
+    clara ipmi selquery [<hostlist>] [--sensor=<type>] [--since=<date>] [--until=<date>]
     clara ipmi ssh <hostlist> <command>
     clara ipmi [--p=<level>] command <hostlist> <command>...
     clara ipmi -h | --help
 Alternative:
     clara ipmi <host> connect [-jf]
-    clara ipmi <hostlist> getmac
+    clara ipmi [--p=<level>] <hostlist> getmac [--format=<format>]
     clara ipmi [--p=<level>] <hostlist> deconnect
     clara ipmi [--p=<level>] <hostlist> (on|off|reboot|soft)
     clara ipmi [--p=<level>] <hostlist> status
@@ -70,110 +72,338 @@ Alternative:
     clara ipmi [--p=<level>] <hostlist> reset
     clara ipmi [--p=<level>] <hostlist> sellist
     clara ipmi [--p=<level>] <hostlist> selclear
+    clara ipmi [--p=<level>] <hostlist> selsync
     clara ipmi <hostlist> ssh <command>
     clara ipmi [--p=<level>] <hostlist> command <command>...
 """
 
+import asyncio
+import csv
 import errno
-import multiprocessing
+import functools
+import json
 import logging
 import os
 import re
-import subprocess
 import sys
+from datetime import datetime
 
 import ClusterShell
 import docopt
-from clara.utils import clara_exit, run, get_from_config, get_from_config_or, get_bool_from_config_or, value_from_file, has_config_value
+from clara import selstore
+from clara.utils import clara_exit, run, get_from_config, get_from_config_or, get_bool_from_config_or, \
+    get_int_from_config, get_int_from_config_or, value_from_file, has_config_value
 
 
 # Global dictionary
 _opts = {'parallel': 1}
 
+# Default time in seconds given to ipmitool to answer for a host
+IPMI_TIMEOUT = 30
+
 def full_hostname(host):
     prefix = get_from_config("ipmi", "prefix")
     suffix = get_from_config_or("ipmi", "suffix", "")
     return prefix + host + suffix
 
 
-def ipmi_run(cmd):
-
-    ipmi_p = subprocess.Popen(cmd, stderr=subprocess.STDOUT,
-                              stdout=subprocess.PIPE,
-                              universal_newlines=True)
-    output = ipmi_p.communicate()[0].strip()
-    exit_code = ipmi_p.wait()
-    if exit_code:
-        return "ERROR: " + output
-    else:
-        return "OK: " + output
-
+async def ipmitool_run_async(cmd, merge_stderr=True):
+    """Run ipmitool, return whether it succeeded and its output. Without
+       merge_stderr, the messages of ipmitool on stderr are only returned
+       when it fails, so that the output of a success can be parsed."""
+    stderr = asyncio.subprocess.STDOUT if merge_stderr else asyncio.subprocess.PIPE
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=stderr)
+    except OSError as e:
+        if (e.errno == errno.ENOENT):
+            return False, "Binary not found: {0}".format(cmd[0])
+        raise
+    try:
+        output, errors = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    if proc.returncode != 0 and errors:
+        output = errors + output
+    return proc.returncode == 0, output.decode(errors="replace").strip()
+
+
+async def lanplus_run_async(host, imm_user, cmd, ipmitool, merge_stderr=True):
+    """Run the command with the native lanplus client, fall back to
+       ipmitool if the BMC does not support it."""
+    from clara import lanplus
+    try:
+        return True, await lanplus.execute(host, imm_user, os.environ["IPMI_PASSWORD"], cmd)
+    except lanplus.LanplusUnsupported as e:
+        logging.debug("ipmi/ipmi_do: {0}: {1}, using ipmitool".format(host, e))
+        return await ipmitool_run_async(ipmitool, merge_stderr)
+    except lanplus.LanplusError as e:
+        return False, str(e)
+
+
+async def ipmi_run_async(host, run_cmd, semaphore, timeout, retries):
+    """Run the command of a host with at most timeout seconds per attempt,
+       retry up to retries times on failure and return the result."""
+    async with semaphore:
+        for attempt in range(retries + 1):
+            if attempt:
+                logging.debug("ipmi/ipmi_do: {0}: retry {1}/{2}".format(host, attempt, retries))
+            try:
+                success, output = await asyncio.wait_for(run_cmd(), timeout)
+            except asyncio.TimeoutError:
+                result = "ERROR: no answer after {0}s".format(timeout)
+                continue
+            if success:
+                return "OK: " + output
+            result = "ERROR: " + output
+        return result
+
+
+async def ipmi_gather(commands, parallel, timeout, retries, stream=True):
+    """Run the command of each host with at most parallel commands at the
+       same time and print the results as soon as they are received if
+       stream is set."""
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def run_host(host, run_cmd):
+        return host, await ipmi_run_async(host, run_cmd, semaphore, timeout, retries)
+
+    results = {}
+    for future in asyncio.as_completed([run_host(host, run_cmd) for host, run_cmd in commands.items()]):
+        host, result = await future
+        if stream:
+            print(host, result)
+            sys.stdout.flush()
+        results[host] = result
+    return results
+
+
+def ipmi_summary(results):
+    """Print the hosts sharing the same result folded together, the multiline
+       results are summarized by their status."""
+    summary = {}
+    for host, result in results.items():
+        if "\n" in result:
+            result = result.split(":", 1)[0]
+        summary.setdefault(result, []).append(host)
+    for result, hosts in sorted(summary.items(), key=lambda item: item[0].startswith("OK")):
+        print("{0}: {1}".format(ClusterShell.NodeSet.fold(",".join(hosts)), result))
+
+
+def bmc_hostname(host):
+    pat = re.compile("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
+    if not pat.match(host):
+        host = full_hostname(host)
+    return host
 
-def ipmi_do(hosts, *cmd):
 
+def ipmi_run_hosts(hosts, cmd, stream=True, merge_stderr=True):
+    """Run the ipmitool command on the BMCs of hosts concurrently and return
+       the results by BMC. cmd is the list of arguments of ipmitool, or a
+       function returning the arguments for a node. Without merge_stderr,
+       the warnings of ipmitool are kept out of the output to parse."""
     imm_user = value_from_file(get_from_config("common", "master_passwd_file"), "IMMUSER")
     os.environ["IPMI_PASSWORD"] = value_from_file(get_from_config("common", "master_passwd_file"), "IMMPASSWORD")
     nodeset = ClusterShell.NodeSet.NodeSet(hosts)
-
-    p = multiprocessing.Pool(_opts['parallel'])
-    result_map = {}
-
-    for host in nodeset:
-
-        pat = re.compile("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
-        if not pat.match(host):
-            host = full_hostname(host)
+    timeout = get_int_from_config_or("ipmi", "timeout", default=IPMI_TIMEOUT)
+    retries = get_int_from_config_or("ipmi", "retries", default=0)
+    native = get_from_config_or("ipmi", "backend", default="ipmitool") == "native"
+    if native and callable(cmd):
+        native = False
+    elif native:
+        from clara import lanplus
+        native = lanplus.supported(cmd)
+        if not native:
+            logging.debug("ipmi/ipmi_do: {0} not supported natively, using ipmitool".format(" ".join(cmd)))
+
+    commands = {}
+    for node in nodeset:
+        host = bmc_hostname(node)
 
         ipmitool = ["ipmitool", "-I", "lanplus", "-H", host, "-U", imm_user, "-E", "-e!"]
-        ipmitool.extend(cmd)
+        ipmitool.extend(cmd(node) if callable(cmd) else cmd)
         logging.debug("ipmi/ipmi_do: {0}".format(" ".join(ipmitool)))
-        result_map[host] = p.apply_async(ipmi_run, (ipmitool,))
-
-    p.close()
-    p.join()
+        if native:
+            commands[host] = functools.partial(lanplus_run_async, host, imm_user, cmd, ipmitool,
+                                               merge_stderr)
+        else:
+            commands[host] = functools.partial(ipmitool_run_async, ipmitool, merge_stderr)
 
-    for host, result in result_map.items():
-        print(host, result.get())
+    return asyncio.run(ipmi_gather(commands, _opts['parallel'], timeout, retries, stream))
 
 
-def getmac(hosts):
-    imm_user = value_from_file(get_from_config("common", "master_passwd_file"), "IMMUSER")
-    os.environ["IPMI_PASSWORD"] = value_from_file(get_from_config("common", "master_passwd_file"), "IMMPASSWORD")
-    nodeset = ClusterShell.NodeSet.NodeSet(hosts)
-    for host in nodeset:
-
-        pat = re.compile("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
-        if not pat.match(host):
-            host = full_hostname(host)
-
-        logging.info("{0}: ".format(host))
-        cmd = ["ipmitool", "-I", "lanplus", "-H", host,
-               "-U", imm_user, "-E", "fru", "print", "0"]
-        logging.debug("ipmi/getmac: {0}".format(" ".join(cmd)))
-
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                universal_newlines=True)
-        # The data we want is in line 15
-        lines = proc.stdout.readlines()
-        if (len(lines) < 14):
-            clara_exit("Host {0} can't be reached".format(host))
-        full_mac = lines[14].split(":")[1].strip().upper()
-        mac_address1 = "{0}:{1}:{2}:{3}:{4}:{5}".format(full_mac[0:2],
-                                                        full_mac[2:4],
-                                                        full_mac[4:6],
-                                                        full_mac[6:8],
-                                                        full_mac[8:10],
-                                                        full_mac[10:12])
-
-        mac_address2 = "{0}:{1}:{2}:{3}:{4}:{5}".format(full_mac[12:14],
-                                                        full_mac[14:16],
-                                                        full_mac[16:18],
-                                                        full_mac[18:20],
-                                                        full_mac[20:22],
-                                                        full_mac[22:24])
-
-        logging.info("  eth0's MAC address is {0}\n"
-                     "  eth1's MAC address is {1}".format(mac_address1, mac_address2))
+def ipmi_do(hosts, *cmd):
+    results = ipmi_run_hosts(hosts, cmd)
+    if len(results) > 1:
+        print("---")
+        ipmi_summary(results)
+    return results
+
+
+def parse_macs(output):
+    """Return the MAC addresses of eth0 and eth1 from the output of fru print"""
+    # The data we want is in line 15
+    lines = output.splitlines()
+    if (len(lines) < 15):
+        return None
+    fields = lines[14].split(":")
+    if len(fields) != 2 or not fields[1].strip().isalnum():
+        logging.debug("ipmi/parse_macs: unexpected line 15 of fru print: {0}".format(lines[14]))
+        return None
+    full_mac = fields[1].strip().upper()
+    mac_address1 = "{0}:{1}:{2}:{3}:{4}:{5}".format(full_mac[0:2],
+                                                    full_mac[2:4],
+                                                    full_mac[4:6],
+                                                    full_mac[6:8],
+                                                    full_mac[8:10],
+                                                    full_mac[10:12])
+
+    mac_address2 = "{0}:{1}:{2}:{3}:{4}:{5}".format(full_mac[12:14],
+                                                    full_mac[14:16],
+                                                    full_mac[16:18],
+                                                    full_mac[18:20],
+                                                    full_mac[20:22],
+                                                    full_mac[22:24])
+    return mac_address1, mac_address2
+
+
+def getmac(hosts, output_format="text"):
+    """Get the MAC addresses of all the hosts concurrently, the hosts which
+       can't be reached are reported without stopping the others."""
+    nodes = list(ClusterShell.NodeSet.NodeSet(hosts))
+    # the MAC addresses are read at a fixed line, the warnings must not shift it
+    results = ipmi_run_hosts(hosts, ["fru", "print", "0"], stream=False, merge_stderr=False)
+
+    rows = []
+    for node in nodes:
+        bmc = bmc_hostname(node)
+        result = results[bmc]
+        row = {"node": node, "bmc": bmc, "eth0": "", "eth1": "", "status": "ok"}
+        macs = parse_macs(result[len("OK: "):]) if result.startswith("OK: ") else None
+        if macs is None and result.startswith("OK: "):
+            row["status"] = "Host {0}: unexpected output of fru print".format(bmc)
+        elif macs is None:
+            row["status"] = "Host {0} can't be reached".format(bmc)
+            if result.startswith("ERROR: ") and len(result) > len("ERROR: "):
+                row["status"] += ": " + result[len("ERROR: "):].splitlines()[0]
+        else:
+            row["eth0"], row["eth1"] = macs
+        rows.append(row)
+
+    if output_format == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=["node", "bmc", "eth0", "eth1", "status"])
+        writer.writeheader()
+        writer.writerows(rows)
+    elif output_format == "json":
+        print(json.dumps(rows, indent=2))
+    else:
+        for row in rows:
+            if row["status"] != "ok":
+                logging.warning(row["status"])
+                continue
+            logging.info("{0}: ".format(row["bmc"]))
+            logging.info("  eth0's MAC address is {0}\n"
+                         "  eth1's MAC address is {1}".format(row["eth0"], row["eth1"]))
+
+    failed = [row["node"] for row in rows if row["status"] != "ok"]
+    if failed:
+        logging.warning("ipmi/getmac: failed on {0}/{1} hosts: {2}".format(
+            len(failed), len(rows), ClusterShell.NodeSet.fold(",".join(failed))))
+    return rows
+
+
+def parse_sel(output):
+    """Return the entries listed by ipmitool sel list"""
+    entries = []
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) < 5:
+            continue
+        try:
+            entry_id = int(fields[0], 16)
+        except ValueError:
+            continue
+        try:
+            created = datetime.strptime(fields[1] + " " + fields[2], '%m/%d/%Y %H:%M:%S')
+            created = created.strftime(selstore.TIME_FORMAT)
+        except ValueError:
+            # entries logged before the clock of the BMC was set
+            created = ""
+        entries.append({'id': entry_id, 'created': created,
+                        'sensor_type': fields[3].split(' #')[0], 'message': fields[4],
+                        'code': " | ".join(fields[5:])})
+    return entries
+
+
+def sel_store_path():
+    return get_from_config_or("ipmi", "sel_store", default=selstore.default_path())
+
+
+def selsync(hosts):
+    """Fetch the entries added to the SEL of the hosts since the previous
+       synchronization and store them"""
+    nodes = list(ClusterShell.NodeSet.NodeSet(hosts))
+    sync_time = datetime.now().strftime(selstore.TIME_FORMAT)
+    infos = ipmi_run_hosts(hosts, ["sel", "info"], stream=False)
+
+    with selstore.SelStore(sel_store_path()) as store:
+        totals = {}
+        windows = {}
+        failed = []
+        for node in nodes:
+            info = infos[bmc_hostname(node)]
+            match = re.search(r"^Entries\s*:\s*(\d+)", info, re.MULTILINE)
+            if not info.startswith("OK: ") or match is None:
+                logging.error("{0} {1}".format(bmc_hostname(node), info))
+                failed.append(node)
+                continue
+            totals[node] = int(match.group(1))
+            last_id, _ = store.last(node, "ipmi")
+            if totals[node] == 0:
+                if last_id is not None:
+                    logging.info("{0}: the SEL has been cleared".format(node))
+                    store.reset(node, "ipmi")
+                logging.info("{0}: 0 new entries".format(node))
+            elif last_id is None:
+                windows[node] = totals[node]
+            else:
+                # the new entries and the last one seen, if the SEL grew
+                # since the previous synchronization
+                windows[node] = min(totals[node], max(totals[node] - store.count(node, "ipmi"), 0) + 1)
+
+        # list the last entries of the SELs, more of them until the last
+        # entry seen by the previous synchronization is found
+        while windows:
+            lists = ipmi_run_hosts(ClusterShell.NodeSet.fold(",".join(windows)),
+                                   lambda node: ["sel", "list", "last", str(windows[node])],
+                                   stream=False)
+            wider = {}
+            for node, window in windows.items():
+                result = lists[bmc_hostname(node)]
+                if not result.startswith("OK: "):
+                    logging.error("{0} {1}".format(bmc_hostname(node), result))
+                    failed.append(node)
+                    continue
+                whole = window >= totals[node]
+                last_id, last_created = store.last(node, "ipmi")
+                cleared, complete, entries = selstore.new_entries(
+                    parse_sel(result[len("OK: "):]), last_id, last_created, whole)
+                if not complete:
+                    wider[node] = totals[node] if cleared else min(2 * window, totals[node])
+                    continue
+                if cleared:
+                    logging.info("{0}: the SEL has been cleared".format(node))
+                    store.reset(node, "ipmi")
+                added = store.add(node, "ipmi", entries, sync_time)
+                logging.info("{0}: {1} new entries".format(node, added))
+            windows = wider
+
+    if failed:
+        logging.warning("ipmi/selsync: failed on {0}/{1} hosts: {2}".format(
+            len(failed), len(nodes), ClusterShell.NodeSet.fold(",".join(failed))))
 
 
 def do_connect_ipmi(host):
@@ -201,7 +431,7 @@ def do_connect(host, j=False, f=False):
         do_connect_ipmi(host)
     else:
         conmand = get_from_config_or("ipmi", "conmand", '')
-        port = int(get_from_config("ipmi", "port"))
+        port = get_int_from_config("ipmi", "port")
         if len(conmand) == 0:
             do_connect_ipmi(host)
             return
@@ -244,7 +474,8 @@ def do_ssh(hosts, command):
         value_from_file(get_from_config("common", "master_passwd_file"),
                         "IMMUSER")
 
-    task = ClusterShell.Task.task_self()
+    from ClusterShell.Task import task_self
+    task = task_self()
     task.set_info("ssh_user", imm_user)
     task.set_info("ssh_path", "/usr/bin/sshpass -e /usr/bin/ssh")
     task.set_info("ssh_options", "-oBatchMode=no")
@@ -267,7 +498,7 @@ def main():
         _opts['parallel'] = int(dargs['--p'])
     # Read the value from the config file and use 1 if it hasn't been set
     elif has_config_value("ipmi", "parallel"):
-        _opts['parallel']= int(get_from_config("ipmi", "parallel"))
+        _opts['parallel']= get_int_from_config("ipmi", "parallel")
     else:
         logging.debug("parallel hasn't been set in config.ini, using 1 as default")
 
@@ -283,7 +514,10 @@ def main():
         ipmi_do(dargs['<hostlist>'], "user", "set", "name", "2", imm_user)
         ipmi_do(dargs['<hostlist>'], "user", "set", "password", "2", imm_pwd)
     elif dargs['getmac']:
-        getmac(dargs['<hostlist>'])
+        output_format = dargs['--format'] or "text"
+        if output_format not in ("text", "csv", "json"):
+            clara_exit("Unknown format {0}, use text, csv or json".format(output_format))
+        getmac(dargs['<hostlist>'], output_format)
     elif dargs['on']:
         ipmi_do(dargs['<hostlist>'], "power", "on")
     elif dargs['off']:
@@ -310,6 +544,11 @@ def main():
         ipmi_do(dargs['<hostlist>'], "sel", "list")
     elif dargs['selclear']:
         ipmi_do(dargs['<hostlist>'], "sel", "clear")
+    elif dargs['selsync']:
+        selsync(dargs['<hostlist>'])
+    elif dargs['selquery']:
+        selstore.query(sel_store_path(), dargs['<hostlist>'], dargs['--sensor'],
+                       dargs['--since'], dargs['--until'])
     elif dargs['ping']:
         do_ping(dargs['<hostlist>'])
     elif dargs['ssh']:
@@ -99,7 +99,11 @@ def mktorrent(image):
         sftp_user = get_from_config("p2p", "sftp_user", _opts['dist'])
         sftp_private_key = get_from_config("p2p", "sftp_private_key", _opts['dist'])
         sftp_passphrase = get_from_config_or("p2p", "sftp_passphrase", _opts['dist'], None)
-        sftp_client = sftp.Sftp(seeders.split(','), sftp_user, sftp_private_key, sftp_passphrase)
+        sftp_parallel = get_from_config_or("p2p", "sftp_parallel", _opts['dist'], None)
+        if sftp_parallel is not None:
+            sftp_parallel = int(sftp_parallel)
+        sftp_client = sftp.Sftp(seeders.split(','), sftp_user, sftp_private_key,
+                                sftp_passphrase, sftp_parallel)
 
     for server, torrent_f in trackers.items():
         announce = []
@@ -114,6 +118,9 @@ def mktorrent(image):
         if sftp_mode:
             sftp_client.upload([torrent_f], os.path.dirname(torrent_f), 0o0644)
 
+    if sftp_mode:
+        sftp_client.close()
+
     clush(seeders, init_start.format(seeding_service))
 
 def main():
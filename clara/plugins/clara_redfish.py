@@ -36,36 +36,40 @@
 Manages and get the status from the nodes of a cluster.
 
 Usage:
-    clara redfish getmac <hostlist>
+    clara redfish [--p=<level>] getmac <hostlist>
     clara redfish [--p=<level>] ping <hostlist>
     clara redfish [--p=<level>] (on|off|reboot) <hostlist>
     clara redfish [--p=<level>] sellist <hostlist>
     clara redfish [--p=<level>] selclear <hostlist>
+    clara redfish [--p=<level>] selsync <hostlist>
+    clara redfish selquery [<hostlist>] [--sensor=<type>] [--since=<date>] [--until=<date>]
     clara redfish [--p=<level>] status <hostlist>
     clara redfish [--p=<level>] pxe <hostlist>
     clara redfish [--p=<level>] dflt <hostlist>
     clara redfish [--p=<level>] bios <hostlist>
     clara redfish [--p=<level>] disk <hostlist>
+    clara redfish [--p=<level>] discover <hostlist>
+    clara redfish invalidate [<hostlist>]
     clara redfish -h | --help
 Alternative:
-    clara redfish <hostlist> getmac
+    clara redfish [--p=<level>] <hostlist> getmac
     clara redfish [--p=<level>] <hostlist> ping
     clara redfish [--p=<level>] <hostlist> (on|off|reboot)
     clara redfish [--p=<level>] <hostlist> sellist
     clara redfish [--p=<level>] <hostlist> selclear
+    clara redfish [--p=<level>] <hostlist> selsync
     clara redfish [--p=<level>] <hostlist> status
     clara redfish [--p=<level>] <hostlist> pxe
     clara redfish [--p=<level>] <hostlist> dflt
     clara redfish [--p=<level>] <hostlist> bios
     clara redfish [--p=<level>] <hostlist> disk
+    clara redfish [--p=<level>] <hostlist> discover
 """
 
 import errno
-import multiprocessing
 import logging
 import os
 import re
-import subprocess
 import sys
 from datetime import datetime
 
@@ -73,7 +77,9 @@ import ClusterShell
 import docopt
 from requests.auth import HTTPBasicAuth
 
-from clara.utils import clara_exit, run, get_from_config, get_from_config_or, get_bool_from_config_or, value_from_file, has_config_value, get_response
+from clara import redfish, selstore
+from clara.utils import clara_exit, run, get_from_config, get_from_config_or, get_bool_from_config_or, \
+    get_int_from_config, get_int_from_config_or, value_from_file, has_config_value
 
 # Global dictionary
 _opts = {'parallel': 1}
@@ -115,138 +121,267 @@ def full_hostname(host):
     suffix = get_from_config_or("ipmi", "suffix", "")
     return prefix + host + suffix
 
-def get_topurl(hosts, auth):
-    nodeset = ClusterShell.NodeSet.NodeSet(hosts)
-    endpoint = ""
-    host = nodeset[0]
-
+def bmc_hostname(host):
     pat = re.compile("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
     if not pat.match(host):
         host = full_hostname(host)
+    return host
 
-    url = "https://{0}/redfish/v1/Systems".format(host)
-    response = get_response(url, endpoint, auth)
-    members = [response['Members'] if 'Members' in response else '']
-    members = members[0][0]
 
-    return(members['@odata.id'])
+def redfish_pool():
+    imm_user, imm_password = get_authentication()
+    auth = HTTPBasicAuth(imm_user, imm_password)
+    timeout = get_int_from_config_or("redfish", "timeout", default=redfish.REDFISH_TIMEOUT)
+    return redfish.RedfishPool(auth, _opts['parallel'], timeout)
 
 
-def getmac(hosts):
+def topology_cache():
+    if os.geteuid() == 0:
+        default = "/var/cache/clara/redfish.json"
+    else:
+        default = "%s/.cache/clara/redfish.json" % os.environ["HOME"]
+    path = get_from_config_or("redfish", "cache_file", default=default)
+    ttl = get_int_from_config_or("redfish", "cache_ttl", default=redfish.TOPOLOGY_TTL)
+    return redfish.TopologyCache(path, ttl)
+
+
+def with_topology(cache, operation):
+    """Return an operation of the pool calling operation(client, host, topology)
+       with the topology of the host, discovered again and the operation run
+       again if the cached one is wrong: a cached URI is not found or the
+       cached topology is partial."""
+    def run(client, host):
+        cached = cache.get(host) is not None
+        try:
+            return operation(client, host, cache.topology(client, host))
+        except (redfish.RedfishError, KeyError, IndexError) as error:
+            # an unreachable BMC is not waited for twice, and an action which
+            # may have reached the BMC is not sent again
+            wrong = not isinstance(error, redfish.RedfishError) or error.status == 404
+            if not cached or not wrong:
+                raise
+            logging.debug("redfish/cache: {0} failed with the cached topology: {1!r}".format(host, error))
+            cache.invalidate([host])
+            return operation(client, host, cache.topology(client, host, refresh=True))
+    return run
+
+
+def report(hosts, results):
+    """Log a folded summary of the hosts which failed"""
+    failed = [host for host, result in results.items() if isinstance(result, redfish.RedfishError)]
+    if failed:
+        logging.warning("redfish: failed on {0}/{1} hosts: {2}".format(
+            len(failed), len(results), ClusterShell.NodeSet.fold(",".join(failed))))
+
+
+def log_result(host, result):
+    if isinstance(result, redfish.RedfishError):
+        logging.error("{0} ERROR: {1}".format(host, result))
+    else:
+        for line in result:
+            logging.info(line)
 
-    imm_user, imm_password = get_authentication()
-    auth  = HTTPBasicAuth(imm_user, imm_password)
 
-    topurl = get_topurl(hosts, auth)
-    endpoint = "/EthernetInterfaces"
+def getmac(hosts):
 
     nodeset = ClusterShell.NodeSet.NodeSet(hosts)
-    for host in nodeset:
-
-        pat = re.compile("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
-        if not pat.match(host):
-            host = full_hostname(host)
-
-        url = "https://{0}{1}".format(host, topurl)
-        logging.debug(f"{url} {endpoint}")
-        logging.info("{0}: ".format(host))
-        if "Self" in topurl:
-            url = url.replace('Systems','Managers')
-            response = get_response(url, endpoint + "/eth0", auth)
-            mac_address1 = [response['MACAddress'] if 'MACAddress' in response else '']
-            response = get_response(url, endpoint + "/eth1", auth)
-            mac_address2 = [response['MACAddress'] if 'MACAddress' in response else '']
-
-            logging.info("  eth0's MAC address is {0}\n"
-                         "  eth1's MAC address is {1}".format(mac_address1, mac_address2))
-        else:
-            response = get_response(url, endpoint, auth)
-            nbr = [response['Members@odata.count'] if 'Members@odata.count' in response else 0]
-            for n in range(nbr[0]):
-                response = get_response(url, endpoint + "/" + str(n + 1), auth)
-                mac_address = [response['MACAddress'] if 'MACAddress' in response else '']
-                logging.info( "eth" + str(n) + "'s MAC address is {0} ".format(mac_address[0].replace('-',':')))
+    cache = topology_cache()
+
+    def host_macs(client, host, topology):
+        lines = ["{0}: ".format(host)]
+        for n, interface in enumerate(topology['interfaces']):
+            response = client.get(interface)
+            mac_address = [response['MACAddress'] if 'MACAddress' in response else '']
+            lines.append("eth" + str(n) + "'s MAC address is {0} ".format(mac_address[0].replace('-',':')))
+        return lines
+
+    with redfish_pool() as pool:
+        results = pool.run([bmc_hostname(host) for host in nodeset],
+                           with_topology(cache, host_macs), log_result)
+    cache.save()
+    report(hosts, results)
+    return results
+
+
+def discover(hosts):
+    """Discover the topology of the hosts again and print it"""
+    nodeset = ClusterShell.NodeSet.NodeSet(hosts)
+    cache = topology_cache()
+
+    def host_discover(client, host):
+        try:
+            topology = cache.topology(client, host, refresh=True)
+        except (redfish.RedfishError, KeyError, IndexError):
+            # do not keep the previous topology of a BMC which changed
+            cache.invalidate([host])
+            raise
+        return ["{0}: vendor={1} system={2} manager={3} interfaces={4}".format(
+            host, topology['vendor'], topology['system'], topology['manager'],
+            ",".join(topology['interfaces']))]
+
+    with redfish_pool() as pool:
+        results = pool.run([bmc_hostname(host) for host in nodeset], host_discover, log_result)
+    cache.save()
+    report(hosts, results)
+    return results
+
+
+def invalidate(hosts):
+    """Forget the cached topology of the hosts, of all the hosts by default"""
+    cache = topology_cache()
+    if hosts is None:
+        cache.invalidate()
+    else:
+        cache.invalidate([bmc_hostname(host) for host in ClusterShell.NodeSet.NodeSet(hosts)])
+    cache.save()
 
 def do_ping(hosts):
     nodes = ClusterShell.NodeSet.NodeSet(hosts)
     cmd = ["/sbin/fping", "-r1", "-u", "-s"] + list(nodes)
     run(cmd)
 
-def redfish_do(hosts, *cmd):
+# Bodies of the actions sent to the systems
+actions = {'poweron': ('POST', {"ResetType" : "On"}),
+           'poweroff': ('POST', {"ResetType" : "ForceOff"}),
+           'powerreboot': ('POST', {"ResetType" : "ForceRestart"}),
+           'selclear': ('POST', {}),
+           'bootdevpxe': ('PATCH', {"Boot": { "BootSourceOverrideEnabled": "Continuous", "BootSourceOverrideTarget": "Pxe"}}),
+           'bootdevdflt': ('PATCH', {"Boot": { "BootSourceOverrideEnabled": "Disabled", "BootSourceOverrideTarget": "None"}}),
+           'bootdevbios': ('PATCH', {"Boot": { "BootSourceOverrideEnabled": "Continuous", "BootSourceOverrideTarget": "BiosSetup"}}),
+           'bootdevhdd': ('PATCH', {"Boot": { "BootSourceOverrideEnabled": "Continuous", "BootSourceOverrideTarget": "Hdd"}}),
+          }
+
+def sel_entry(url, mbr):
+    """Return an entry of the SEL from its Redfish representation"""
+    if 'Self' in url:
+        tab = mbr['Message'].split(',')
+        datecreated = datetime.strptime(mbr['Created'], '%Y-%m-%dT%H:%M:%Sz').astimezone()
+        message = tab[9].split(':')[1]
+    else:
+        dtcreated = mbr['Created'].split('+')
+        datecreated = dtcreated[0] + "+" + dtcreated[1].replace(':','')
+        datecreated = datetime.strptime(datecreated, '%Y-%m-%dT%H:%M:%S%z')
+        message = mbr['Message']
+    entry_id = int(mbr['Id']) if str(mbr['Id']).isdigit() else mbr['Id']
+    return {'id': entry_id, 'created': datecreated, 'sensor_type': mbr['SensorType'],
+            'message': message, 'code': mbr['EntryCode']}
+
+def sel_lines(host, url, response):
+    lines = ["{0}: ".format(host)]
+    for mbr in response['Members']:
+        fmt = '%Y/%m/%d | %H:%M:%S'
+        entry = sel_entry(url, mbr)
+        lines.append(f"{mbr['Id']} | {entry['created'].strftime(fmt)} | {entry['sensor_type']} | {entry['message']} | {entry['code']} ")
+    return lines
+
+def fetch_sel(client, path, skip):
+    """Return the entries of the SEL after the first skip ones and the total
+       number of entries, following the pages of the collection"""
+    entries = []
+    response = client.get("{0}?$skip={1}".format(path, skip))
+    total = response.get('Members@odata.count')
+    entries.extend(response.get('Members', []))
+    while 'Members@odata.nextLink' in response:
+        response = client.get(response['Members@odata.nextLink'])
+        entries.extend(response.get('Members', []))
+    return entries, total
+
+def sel_store_path():
+    return get_from_config_or("redfish", "sel_store", default=selstore.default_path())
+
+def selsync(hosts):
+    """Fetch the entries added to the SEL of the hosts since the previous
+       synchronization and store them"""
+    nodeset = ClusterShell.NodeSet.NodeSet(hosts)
+    bmcs = {bmc_hostname(node): node for node in nodeset}
+    cache = topology_cache()
+    sync_time = datetime.now().strftime(selstore.TIME_FORMAT)
 
-    imm_user, imm_password = get_authentication()
-    auth  = HTTPBasicAuth(imm_user, imm_password)
+    with selstore.SelStore(sel_store_path()) as store:
+        stored = {bmc: store.count(node, "redfish") for bmc, node in bmcs.items()}
+        last = {bmc: store.last(node, "redfish") for bmc, node in bmcs.items()}
+
+        def host_sel(client, host, topology):
+            url = topology['system']
+            path = url + urls['sellist']
+            if 'Self' in url:
+                path = path.replace('SEL', 'BIOS')
+            last_id, last_created = last[host]
+            # the new entries and the last one seen, if the SEL grew since the
+            # previous synchronization, then more of them until it is found
+            skip = max(stored[host] - 1, 0) if last_id is not None else 0
+            while True:
+                members, total = fetch_sel(client, path, skip)
+                entries = []
+                for mbr in members:
+                    entry = sel_entry(url, mbr)
+                    entry['created'] = entry['created'].strftime(selstore.TIME_FORMAT)
+                    entries.append(entry)
+                cleared, complete, entries = selstore.new_entries(entries, last_id, last_created, skip == 0)
+                if complete:
+                    return cleared, entries
+                if cleared or total is None:
+                    skip = 0
+                else:
+                    skip = max(total - 2 * max(total - skip, 1), 0)
+
+        with redfish_pool() as pool:
+            results = pool.run(list(bmcs), with_topology(cache, host_sel))
+        cache.save()
+
+        for bmc, result in results.items():
+            node = bmcs[bmc]
+            if isinstance(result, redfish.RedfishError):
+                logging.error("{0} ERROR: {1}".format(bmc, result))
+                continue
+            cleared, entries = result
+            if cleared:
+                logging.info("{0}: the SEL has been cleared".format(node))
+                store.reset(node, "redfish")
+            added = store.add(node, "redfish", entries, sync_time)
+            logging.info("{0}: {1} new entries".format(node, added))
+    report(hosts, results)
+    return results
+
+def redfish_do(hosts, *cmd):
 
-    topurl = get_topurl(hosts, auth)
     value = ""
     endpoint = ""
     if 'user' in cmd and 'set' in cmd:
         logging.debug(f"{cmd}")
+        return {}
     else:
         for i in range(len(cmd) - 2, len(cmd), 1):
             value = value + cmd[i]
         endpoint = urls[value]
 
     nodeset = ClusterShell.NodeSet.NodeSet(hosts)
-    for host in nodeset:
-
-        pat = re.compile("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
-        if not pat.match(host):
-            host = full_hostname(host)
-
-        url = "https://{0}{1}".format(host, topurl)
+    cache = topology_cache()
 
+    def host_do(client, host, topology):
+        url = topology['system']
+        path = endpoint
         if value == "powerstatus":
-            response = get_response(url, endpoint, auth)
-            logging.debug(f"redfish/redfish_do: {url} {endpoint} {response} {response['PowerState']}")
+            response = client.get(url + path)
+            logging.debug(f"redfish/redfish_do: {host} {url} {path} {response}")
             redfishtool = [response['PowerState'] if 'PowerState' in response else '']
             logging.debug("redfish/redfish_do: {0}".format(" ".join(redfishtool)))
-            logging.info(f"{host} OK: Chassis Power is {redfishtool[0]}")
-        elif value == "sellist":
-            if 'Self' in url:
-                endpoint = endpoint.replace('SEL','BIOS')
-            response = get_response(url, endpoint, auth)
-            logging.info("{0}: ".format(host))
-            for mbr in response['Members']:
-                fmt = '%Y/%m/%d | %H:%M:%S'
-                if 'Self' in url:
-                    tab = mbr['Message'].split(',')
-                    datecreated = datetime.strptime(mbr['Created'], '%Y-%m-%dT%H:%M:%Sz').astimezone()
-                    logging.info(f"{mbr['Id']} | {datecreated.strftime(fmt)} | {mbr['SensorType']} | {tab[9].split(':')[1]} | {mbr['EntryCode']} ")
-                else:
-                    dtcreated = mbr['Created'].split('+')
-                    datecreated = dtcreated[0] + "+" + dtcreated[1].replace(':','')
-                    datecreated = datetime.strptime(datecreated, '%Y-%m-%dT%H:%M:%S%z')
-                    logging.info(f"{mbr['Id']} | {datecreated.strftime(fmt)} | {mbr['SensorType']} | {mbr['Message']} | {mbr['EntryCode']} ")
-        elif value == "selclear":
-            if 'Self' in url:
-                endpoint = endpoint.replace('SEL', 'BIOS')
-            body = {}
-            logging.debug(f"redfish/redfish_do: {url} {endpoint} {body}")
-            response = get_response(url, endpoint, auth, data=body)
-        elif value == "poweron":
-            body = {"ResetType" : "On"}
-            logging.debug(f"redfish/redfish_do: {url} {endpoint} {body}")
-            response = get_response(url, endpoint, auth, data=body)
-        elif value == "poweroff":
-            body  = {"ResetType" : "ForceOff"}
-            logging.debug(f"redfish/redfish_do: {url} {endpoint} {body}")
-            response = get_response(url, endpoint, auth, data=body)
-        elif value == "powerreboot":
-            body  = {"ResetType" : "ForceRestart"}
-            response = get_response(url, endpoint, auth, data=body)
-        elif value == "bootdevpxe":
-            body = {"Boot": { "BootSourceOverrideEnabled": "Continuous", "BootSourceOverrideTarget": "Pxe"}}
-            response = get_response(url, endpoint, auth, data=body, method="PATCH")
-        elif value == "bootdevdflt":
-            body = {"Boot": { "BootSourceOverrideEnabled": "Disabled", "BootSourceOverrideTarget": "None"}}
-            response = get_response(url, endpoint, auth, data=body, method="PATCH")
-        elif value == "bootdevbios":
-            body = {"Boot": { "BootSourceOverrideEnabled": "Continuous", "BootSourceOverrideTarget": "BiosSetup"}}
-            response = get_response(url, endpoint, auth, data=body, method="PATCH")
-        elif value == "bootdevhdd":
-            body = {"Boot": { "BootSourceOverrideEnabled": "Continuous", "BootSourceOverrideTarget": "Hdd"}}
-            response = get_response(url, endpoint, auth, data=body, method="PATCH")
+            return [f"{host} OK: Chassis Power is {redfishtool[0]}"]
+        if value in ("sellist", "selclear") and 'Self' in url:
+            path = path.replace('SEL', 'BIOS')
+        if value == "sellist":
+            return sel_lines(host, url, client.get(url + path))
+        method, body = actions[value]
+        logging.debug(f"redfish/redfish_do: {host} {url} {path} {body}")
+        client.request(url + path, body, method)
+        return [f"{host} OK"]
+
+    with redfish_pool() as pool:
+        results = pool.run([bmc_hostname(host) for host in nodeset],
+                           with_topology(cache, host_do), log_result)
+    cache.save()
+    report(hosts, results)
+    return results
 
 def main():
     logging.debug(sys.argv)
@@ -257,7 +392,7 @@ def main():
         _opts['parallel'] = int(dargs['--p'])
     # Read the value from the config file and use 1 if it hasn't been set
     elif has_config_value("redfish", "parallel"):
-        _opts['parallel'] = int(get_from_config("redfish", "parallel"))
+        _opts['parallel'] = get_int_from_config("redfish", "parallel")
     else:
         logging.debug("parallel hasn't been set in config.ini, using 1 as default")
 
@@ -269,6 +404,11 @@ def main():
         redfish_do(dargs['<hostlist>'], "sel", "list")
     elif dargs['selclear']:
         redfish_do(dargs['<hostlist>'], "sel", "clear")
+    elif dargs['selsync']:
+        selsync(dargs['<hostlist>'])
+    elif dargs['selquery']:
+        selstore.query(sel_store_path(), dargs['<hostlist>'], dargs['--sensor'],
+                       dargs['--since'], dargs['--until'])
     elif dargs['ping']:
         do_ping(dargs['<hostlist>'])
     elif dargs['on']:
@@ -285,6 +425,10 @@ def main():
         redfish_do(dargs['<hostlist>'], "chassis", "bootdev", "bios")
     elif dargs['disk']:
         redfish_do(dargs['<hostlist>'], "chassis", "bootdev", "disk")
+    elif dargs['discover']:
+        discover(dargs['<hostlist>'])
+    elif dargs['invalidate']:
+        invalidate(dargs['<hostlist>'])
 
 if __name__ == '__main__':
     main()
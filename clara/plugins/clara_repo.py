@@ -69,12 +69,6 @@ import shutil
 import docopt
 from clara.utils import clara_exit, run, get_from_config, get_from_config_or, value_from_file, conf, os_distribution, os_major_version, do_print
 
-try:
-    from prettytable import PrettyTable as prettytable
-except:
-    print("[WARN] PLS raise 'pip install prettytable' or install 'python3-prettytable' package!")
-    pass
-
 _opt = {'dist': None}
 
 def do_update(dist, path_repo=None, makecache=True):
@@ -542,6 +536,8 @@ def copy_jenkins(job, arch, flags=None, build="lastSuccessfulBuild", distro=None
 
     if dry_run:
         try:
+            # imported here as it is slow to load
+            from prettytable import PrettyTable as prettytable
             table = prettytable()
             table.field_names = ['Job', 'Path', 'Build', 'Package']
         except:
@@ -750,6 +746,8 @@ def main():
                 do_list(dist=_opt['dist'])
     elif dargs['search']:
         try:
+            # imported here as it is slow to load
+            from prettytable import PrettyTable as prettytable
             table = prettytable()
             table.field_names = ['Packages', 'Version', 'Repository', 'Archs']
         except:
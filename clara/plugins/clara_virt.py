@@ -36,13 +36,15 @@
 Manages VMs used in a cluster.
 
 Usage:
-    clara virt list [--details] [--legacy] [--color] [--host=<host>] [--virt-config=<path>]
-    clara virt define <vm_names> --host=<host> [--template=<template_name>] [--virt-config=<path>]
-    clara virt undefine <vm_names> [--host=<host>] [--virt-config=<path>]
-    clara virt start <vm_names> [--host=<host>] [--wipe] [--virt-config=<path>]
-    clara virt stop <vm_names> [--host=<host>] [--hard] [--virt-config=<path>]
-    clara virt migrate [<vm_names>] [--dest-host=<dest_host>] [--host=<host>] [--virt-config=<path>] [--dry-run] [--quiet] [--yes-i-really-really-mean-it] [--exclude=<exclude>] [--include=<include>]
+    clara virt list [--details] [--legacy] [--color] [--host=<host>] [--format=<format>] [--virt-config=<path>] [--no-agent]
+    clara virt define <vm_names> [--host=<host>] [--template=<template_name>] [--virt-config=<path>] [--dry-run]
+    clara virt undefine <vm_names> [--host=<host>] [--virt-config=<path>] [--no-agent]
+    clara virt start <vm_names> [--host=<host>] [--wipe] [--parallel=<n>] [--virt-config=<path>] [--no-agent]
+    clara virt stop <vm_names> [--host=<host>] [--hard] [--parallel=<n>] [--virt-config=<path>] [--no-agent]
+    clara virt migrate [<vm_names>] [--dest-host=<dest_host>] [--host=<host>] [--virt-config=<path>] [--dry-run] [--quiet] [--yes-i-really-really-mean-it] [--exclude=<exclude>] [--include=<include>] [--parallel=<n>] [--no-agent]
     clara virt getmacs <vm_names> [--template=<template_name>] [--virt-config=<path>]
+    clara virt wait <vm_names> [--state=<state>] [--timeout=<seconds>] [--virt-config=<path>]
+    clara virt agent [--virt-config=<path>]
     clara virt -h | --help | help
 
 Options:
@@ -51,16 +53,21 @@ Options:
     --details                      Display details (hosts and volumes)
     --legacy                       Old School printing
     --color                        Colorize or not output
+    --format=<format>              Output format of list: table, json or csv [default: table]
     --wipe                         Wipe the content of the storage volume before starting
     --hard                         Perform a hard shutdown
     --dest-host=<dest_host>        Destination host of a migration
     --template=<template_name>     Use this template instead of the in config
     --virt-config=<path>           Path of the virt config file [default: /etc/clara/virt.ini]
     --quiet                        Proceed silencely. Don't ask any question!
-    --dry-run                      Just simulate migrate action! Don't really do anything
+    --dry-run                      Just simulate migrate and define actions! Don't really do anything
     --yes-i-really-really-mean-it  Force migrate action execution without any further validation
     --exclude=<exclude>            Exclude pattern in VMs [default: service]
     --include=<include>            Include pattern in VMs
+    --parallel=<n>                 Number of migrations, starts or stops run at once (default in virt config)
+    --no-agent                     Connect to the hosts even if a virt agent is running
+    --state=<state>                State to wait for: RUNNING, SHUTOFF, PAUSED, CRASHED, PMSUSPENDED or MISSING [default: RUNNING]
+    --timeout=<seconds>            Maximum time to wait for the state, in seconds [default: 300]
 
 """
 
@@ -71,319 +78,78 @@ import os.path
 import ClusterShell
 import re
 import json
+import time
 from clara import utils
 
-try:
-    import operator
-    from prettytable import PrettyTable as prettytable
-except:
-    print("[WARN] PLS raise 'pip install prettytable' or install 'python3-prettytable' package!")
-    pass
-
-
-# Version 10.2.9 is Debian Jessie
-# earlier versions might work but are not tested.
-# Debian Squeeze is not OK though
-try:
-    import libvirt
-except ImportError:
-    utils.clara_exit("LibVirt Missing, needs version >= 10.2.9.")
-
-libvirt_version = libvirt.getVersion()
-if libvirt_version < 1002009:
-    utils.clara_exit("LibVirt too old (%d.%d.%d), needs version >= 10.2.9." % (
-        libvirt_version / 1000000,
-        (libvirt_version % 1000000) / 1000,
-        libvirt_version % 1000
-    ))
 
+from clara.virt.actions import ActionRunner, get_stages, print_summary
+from clara.virt.agent import Agent, AgentError, AgentUnavailable, request, replay
 from clara.virt.conf.virtconf import VirtConf
-from clara.virt.libvirt.nodegroup import NodeGroup
+from clara.virt.placement import Placement, print_plan
+from clara.virt.report import RENDERERS, build_report
+from clara.virt.watcher import STATES, StateWatcher
 from clara.virt.exceptions import VirtConfigurationException
 
-from clara.utils import Colorizer, yes_or_no, do_print
+from clara.utils import yes_or_no
 
 logger = logging.getLogger(__name__)
 
-def do_list(conf, details=False, legacy=False, host_name=None, color=False):
-    # Define print format
-    if details:
-        vm_line = "VM:{:16} State:{:12} Host:{:16} Total:{:4} Cpus:{:3}"
-    else:
-        vm_line = "VM:{:16} State:{:12} Host:{:16}"
-    host_line = "    Host:{:16} HostState:{:16}"
-    vol_line = "    Volume:{:32} Pool:{:16} Capacity:{:12}"
-
-    group = NodeGroup(conf)
-    vms = group.get_vms()
-
-    if details:
-        # Retrieve KVM server host memory et CPUs information
-        memory, cpus = group.get_nodeinfo()
-    else:
-        memory = cpus = {}
-
-    if legacy:
-        table = vm_line
-    else:
-        try:
-            table = prettytable()
-            data = ['Fake', 'Host', 'VM', 'State']
-            if details:
-                data += ['memory', 'cpus']
-            if details:
-                data += ['Volume', 'Pool', 'Capacity']
-            if not legacy:
-                table.field_names = data
-        except:
-            table = vm_line
-
-    # simple antiaffinity rule base on VM node role, following bellow scheme:
-    # vm_name = <prefix (any 2 caracters)><role><arbitrar integer digits>
-    # antiaffinity stand for a VM placement relative of carateristics or labels like role
-    pattern = re.compile(r"[a-z]{2}([a-z0-9]*[a-z]+)\d+")
-    antiaffinity = {}
-    vmname = {}
-    vmstate = {}
-    hoststates = {}
-    vmrole = {}
-    vmhost = {}
-    vm_free = {}
-    vm_usage = {}
-    done = {}
-    max_mem = {}
-    vcpus = {}
-    total_mem = {}
-    total_cpu = {}
-
-    # Go through all VMs a first time to retrieve needfull informations like antiaffinity
-    for vm in vms.values():
-        host_states = vm.get_host_state()
-        vm_name = vm.get_name()
-        vm_state = vm.get_state()
-        if len(host_states) == 1:
-            host = list(host_states.keys())[0]
-        elif legacy:
-            host = ''
-        else:
-            host = '__empty__'
-
-        vmhost[vm] = host
-
-        hoststates[vm] = host_states
-        vmname[vm] = vm_name
-        vmstate[vm] = vm_state
-
-        if vm_state == 'RUNNING':
-            #If VM is UP and RUNNING, we retrieve his memory & CPU usage
-            _, max_mem[vm], _, vcpus[vm], _ = vm.get_info()
-            max_mem[vm] = int(max_mem[vm] / 1024 / 1024)
-            total_mem[host] = total_mem[host] + max_mem[vm] if host in total_mem else max_mem[vm]
-            total_cpu[host] = total_cpu[host] + vcpus[vm] if host in total_cpu else vcpus[vm]
-
-        # if host is RUNNING, try to figure out if it's up on same KVM
-        # server host than another VM with same role! Same role stand
-        # of VM with the same <prefix> whitch is arbitrary the first 2
-        # digits
-        if len(host) > 1 and not host == '__empty__':
-            if host not in antiaffinity:
-                antiaffinity[host] = {}
-            match = pattern.search(vm_name);
-            if match and vm_state == 'RUNNING':
-                role = match.group(1)
-                if role != 'service':
-                   vmrole[vm] = role
-                   if role in antiaffinity[host]:
-                       antiaffinity[host][role] += 1
-                   else:
-                       antiaffinity[host][role] = 1
-
-    # Go again one more time through all VMs, but using previously retrieved data!
-    # So we avoid doing job two times!
-    for vm in vms.values():
-        # Retrieve previously collected VM data
-        host_states = hoststates[vm]
-        host = vmhost[vm]
-        vm_name = vmname[vm]
-        vm_state = vmstate[vm]
-
-        _max_mem = _vcpus = ''
-
-        # Add some colorization, if --color is used!
-        if vm_state == 'MISSING':
-            vm_state = Colorizer.red(vm_state, color=color)
-        elif vm_state == 'SHUTOFF':
-            vm_state = Colorizer.blue(vm_state, color=color)
-
-        if vm in vmrole and host in antiaffinity and role in antiaffinity[host]:
-            role = vmrole[vm]
-            if antiaffinity[host][role] > 1:
-                 vm_name = Colorizer.red(vm_name, color=color)
-
-        vm_info = []
-        if details:
-            if vm_state == 'RUNNING':
-                #If VM is UP and RUNNING, we retrieve his memory & CPU usage
-                _max_mem = max_mem[vm]
-                _vcpus = vcpus[vm]
-                vm_info = [_max_mem, _vcpus]
-            else:
-                #Can't figure out a way to retieve simply not RUNNING VM information
-                vm_info = ['', '']
-
-        # Use somle tricks here to print KVM server host just one time
-        # For slim printing!
-        if host in done:
-            _host = '__empty__'
-        else:
-            _memory = _cpu_usage = _cpus = ''
-            _host = host
-            if host in total_mem and host in memory and host in cpus and host in total_cpu:
-                # total KVM server host memory
-                _host_mem = int(memory[host] / 1024)
-                _memory = "%s/%s" % (total_mem[host], _host_mem)
-                # number of CPUs of KVM server host
-                _cpus = cpus[host]
-                # KVM server host CPUs usage
-                _cpu_usage = "%s/%s" % (total_cpu[host], _cpus)
-                if total_cpu[host] > _cpus:
-                    _host = Colorizer.red(host, color=color)
-                    _cpu_usage = Colorizer.red(_cpu_usage, color=color)
-
-                if total_mem[host] > _host_mem:
-                    _host = Colorizer.red(host, color=color)
-                    _memory = Colorizer.red(_memory, color=color)
-
-            if not legacy:
-                done[host] = 0
-                data = [host, _host, '', '']
-                if details:
-                    data += [ _memory, _cpu_usage, '', '', '']
-                if host != '':
-                    do_print(table, data, legacy)
-
-        data = []
-        if legacy:
-            table = vm_line
-
-        if host_name:
-            if host_name == host:
-                if legacy:
-                    data = [vm_name, vm_state, host]
-                    if details:
-                        data += vm_info
-                else:
-                    data = [host, '', vm_name, vm_state ] + vm_info
-        else:
-            if legacy:
-                data = [vm_name, vm_state, host]
-                if details:
-                    data += vm_info
-            else:
-                data = [host, '', vm_name, vm_state] + vm_info
-
-        if details:
-            if host_name:
-                for host, state in host_states.items():
-                    if host_name == host:
-                        if legacy:
-                            table += "\n  Hosts:\n%s\n  Volumes:" % host_line
-                            data += [host, state]
-            else:
-                if legacy:
-                    table += "\n  Hosts:\n"
-                for host, state in host_states.items():
-                    if legacy:
-                        table += "%s\n  Volumes:" % host_line
-                        data += [host, state]
-
-            count = 1
-            if legacy:
-                table += vol_line
-            if host_name:
-                for vol in vm.get_volumes():
-                    vol_name = vol.get_name()
-                    if vol_name == vmname[vm] + "_system" and host_name == host:
-                        data += [vol_name, vol.get_pool().get_name(), vol.get_capacity()]
-                        count = 0
-            else:
-                for vol in vm.get_volumes():
-                    vol_name = vol.get_name()
-                    if vol_name == vmname[vm] + "_system":
-                        data += [vol_name, vol.get_pool().get_name(), vol.get_capacity()]
-                        count = 0
-            if count and len(data):
-                data += ['', '', '']
-
-        if len(data):
-            do_print(table, data, legacy)
 
+def check_libvirt():
+    """Exit if the libvirt module is missing or too old. It is only imported
+       by the commands connecting to the hosts, not by the ones sent to the
+       agent."""
+    # Version 10.2.9 is Debian Jessie
+    # earlier versions might work but are not tested.
+    # Debian Squeeze is not OK though
     try:
-        if table._get_rows({'oldsortslice': False,'start': 0, 'end': 1, 'sortby': False}):
-            table.align["VM"] = "l"
-            table.align["Host"] = "r"
-
-            table_txt = ''
-            match_line = 0
-            empty_cell = False
-            pattern = re.compile(r"service|__empty__")
-            # simulate here some tricks not yet supported by prettytable used version!
-            for number, line in enumerate(table.get_string(sort_key=operator.itemgetter(0, 1), sortby = "Fake", fields = table.field_names[1:]).split('\n')):
-                if number == 0:
-                    horizontal = line
-                elif number == 1:
-                    header = line.replace('Host', '    ')
-                # retrieve second cell content
-                cell = ''.join([l for n, l in enumerate(line.split('|')) if n == 1])
-                # New service node info start here!
-                # before writing service node, insert horizontal line!
-                if pattern.search(cell) and empty_cell:
-                    empty_cell = False
-                    if host_name:
-                        if re.search(host_name, cell):
-                            line = line.replace('__empty__', '         ')
-                            table_txt = '%s%s\n' % (table_txt, horizontal)
-                    else:
-                        table_txt = '%s%s\n' % (table_txt, horizontal)
-                # writing here service node line
-                if pattern.search(cell):
-                    if not re.search('__empty__', line):
-                        if host_name:
-                            if re.search(host_name, cell):
-                                table_txt = '%s%s\n' % (table_txt, line)
-                        else:
-                            table_txt = '%s%s\n' % (table_txt, line)
-                else:
-                    table_txt = '%s%s\n' % (table_txt, line)
-                if pattern.search(cell):
-                    # Now, we are after service node line,
-                    # so we insert separate horizontal line!
-                    empty_cell = False
-                    match_line = number
-                    if not re.search('__empty__', line):
-                        if host_name:
-                            if re.search(host_name, cell):
-                                table_txt = '%s%s\n' % (table_txt, horizontal)
-                        else:
-                            table_txt = '%s%s\n' % (table_txt, horizontal)
-                elif re.search(r"^\s+$", cell):
-                    # we found here second empty cell! Meaning new service start here!
-                    empty_cell = True
-            print(table_txt)
-    except:
-        pass
-
-
-def do_action(conf, params, action):
-    group = NodeGroup(conf)
-    if 'wipe' in params.keys():
-        wipe = params['wipe']
-    else:
-        wipe = False
-    if 'hard' in params.keys():
-        hard = params['hard']
-    else:
-        hard = False
+        import libvirt
+    except ImportError:
+        utils.clara_exit("LibVirt Missing, needs version >= 10.2.9.")
+
+    libvirt_version = libvirt.getVersion()
+    if libvirt_version < 1002009:
+        utils.clara_exit("LibVirt too old (%d.%d.%d), needs version >= 10.2.9." % (
+            libvirt_version / 1000000,
+            (libvirt_version % 1000000) / 1000,
+            libvirt_version % 1000
+        ))
+
+
+def new_group(conf, events=False):
+    """Connect to the hosts of the default node group. With events, the
+       libvirt event loop is registered first, to watch the events of the
+       group."""
+    check_libvirt()
+    from clara.virt.libvirt.libvirtclient import start_event_loop
+    from clara.virt.libvirt.nodegroup import NodeGroup
+
+    if events:
+        start_event_loop()
+    return NodeGroup(conf)
+
+def do_list(conf, details=False, legacy=False, host_name=None, color=False, group=None,
+            output_format='table'):
+    if group is None:
+        group = new_group(conf)
+    if output_format not in RENDERERS:
+        utils.clara_exit("Unknown output format: %s, use one of %s"
+                   % (output_format, ', '.join(sorted(RENDERERS))))
+    if legacy and output_format == 'table':
+        output_format = 'legacy'
+
+    # the hosts, their VMs and the volumes of the VMs are gathered once and
+    # then rendered in the requested format
+    report = build_report(group, details, host_name)
+    output = RENDERERS[output_format](report, details, color)
+    if output:
+        print(output)
+
+
+def do_action(conf, params, action, group=None):
+    if group is None:
+        # the stages of start and stop wait for the lifecycle events of the VMs
+        group = new_group(conf, events=action in ActionRunner.actions)
 
     host = params['host']
     if action == 'migrate':
@@ -425,20 +191,33 @@ def do_action(conf, params, action):
         if 'vm_names' not in params:
             utils.clara_exit("Without provided VM to migrate, you need to use --host switch")
 
+        if not params['dest_host'] and not isinstance(params['vm_names'], dict):
+            message = "Migration needs a destination host, but you haven't provided it!\n"
+            logger.warn("%s" % message)
+            message += "We can choose one automatically for you! Let continue ?\n"
+            if force or params['quiet'] or dry_run or yes_or_no(message):
+                # elect the destination hosts of all the VMs at once, so that
+                # each election takes the previous moves into account
+                placement = Placement.from_group(group)
+                sources = {vm_name: placement.host_of(vm_name) for vm_name in params['vm_names']}
+                plan = placement.plan(params['vm_names'])
+                print_plan(plan, placement, sources)
+                params['vm_names'] = dict(plan)
+
+        if not dry_run and (force or params['quiet']):
+            # no question to ask, the migrations are run by the scheduler
+            do_migrations(conf, group, params)
+            return
+
+
+    if action in ActionRunner.actions:
+        do_start_stop(conf, group, params, action)
+        return
 
     for vm_name in params['vm_names']:
         logging.info("Action: %s on %s.", action, vm_name)
         machine = group.get_vm(vm_name)
-        if action == 'start':
-            if wipe:
-                success = machine.wipe()
-                if not success:
-                    logger.error("Wipe failed, not starting %s", vm_name)
-                    continue
-            machine.start(host)
-        elif action == 'stop':
-            machine.stop(host, hard)
-        elif action == 'undefine':
+        if action == 'undefine':
             machine.undefine(host)
         elif action == 'migrate':
             quiet = params['quiet']
@@ -448,15 +227,6 @@ def do_action(conf, params, action):
                 dest_host = params['vm_names'][vm_name]
             else:
                 dest_host = None
-                message = "Migration needs a destination host, but you haven't provided it!\n"
-                logger.warn("%s" % message)
-                message += "We can choose one automatically for you! Let continue ?\n"
-                if force or quiet or dry_run:
-                    dest_host = group.elect_dest_host(machine)
-                    logger.info("You had chosen automatic election of destination host: %s!\n",
-                                 dest_host)
-                elif yes_or_no(message):
-                    dest_host = group.elect_dest_host(machine)
             if dest_host is None:
                 logger.error('Migration needs a destination host. You must provide one!')
                 continue
@@ -474,16 +244,68 @@ def do_action(conf, params, action):
             exit(1)
 
 
+def do_start_stop(conf, group, params, action):
+    """Start or stop params['vm_names'] concurrently, by order of their roles"""
+    start = time.monotonic()
+    vm_names = list(params['vm_names'])
+    results = {}
+    if action == 'start' and params.get('wipe'):
+        # wipe the volumes of all the VMs at once, before starting them
+        vms = group.get_vms()
+        for vm_name in group.wipe_vms([vms[vm_name] for vm_name in vm_names]):
+            logger.error("Wipe failed, not starting %s", vm_name)
+            results[vm_name] = (False, 0.0)
+            vm_names.remove(vm_name)
+
+    parallel = int(params['parallel']) if params.get('parallel') else conf.get_actions_parallel()
+    stages = get_stages(vm_names, conf.get_role_order(), reverse=(action == 'stop'))
+    runner = ActionRunner(group, parallel, conf.get_stage_timeout())
+    results.update(runner.run(action, stages, host=params['host'], hard=params.get('hard', False)))
+    failed = print_summary(action, results, time.monotonic() - start)
+    if failed:
+        utils.clara_exit("Failed to %s VM(s): %s" % (action, ClusterShell.NodeSet.fold(",".join(failed))))
+
+
+def do_migrations(conf, group, params):
+    """Run the migrations of params['vm_names'] concurrently"""
+    migration_params = conf.get_migration_params()
+    if params.get('parallel'):
+        migration_params['parallel'] = int(params['parallel'])
+    plan = []
+    for vm_name in params['vm_names']:
+        if params['dest_host']:
+            dest_host = params['dest_host']
+        elif isinstance(params['vm_names'], dict):
+            dest_host = params['vm_names'][vm_name]
+        else:
+            dest_host = None
+        if dest_host is None:
+            logger.error("Migration of VM %s needs a destination host. You must provide one!",
+                         vm_name)
+            continue
+        source = params['host'] if params['host'] else group.get_vm_host(vm_name)
+        if source is None:
+            logger.error("No host found with VM %s", vm_name)
+            continue
+        plan.append((vm_name, source, dest_host))
+
+    from clara.virt.migration import MigrationScheduler
+
+    failed = MigrationScheduler(group, **migration_params).run(plan)
+    if failed:
+        utils.clara_exit("Failed to migrate VM(s): %s" % ClusterShell.NodeSet.fold(",".join(failed)))
+
+
 def do_define(conf, params):
-    group = NodeGroup(conf)
+    group = new_group(conf)
     vm_names = params['vm_names']
     template_dir = params['template_dir']
     host = params['host']
     template_name = params['template']
+    placement = None
+    plan = []
+    definitions = []
     for vm_name in vm_names:
-        if host is None:
-            logger.error("Need a physical host to define a VM.")
-            continue
         config_template = conf.get_template_for_vm(vm_name)
         if template_name is None:
             if config_template is not None:
@@ -491,14 +313,56 @@ def do_define(conf, params):
             else:
                 template_name = conf.get_template_default()
 
-        machine = group.get_vm(vm_name, create=True)
-
-        machine.create_volumes(template_name, template_dir)
-        machine.define(template_name, template_dir, host)
+        vm_host = host
+        if vm_host is None:
+            # elect the host with the resources needed by the VM, the
+            # previous VMs are accounted on their hosts
+            if placement is None:
+                placement = Placement.from_group(group)
+            vm_params = conf.get_template_vm_params(template_name)
+            vm_params.update(conf.get_vm_params(vm_name))
+            memory = vm_params['memory_kib'] // 1024
+            cpus = vm_params['core_count']
+            vm_host = placement.elect(vm_name, memory, cpus)
+            plan.append((vm_name, vm_host))
+            if vm_host is None:
+                logger.error("No host has enough resources to define VM %s", vm_name)
+                continue
+            placement.place(vm_name, vm_host, memory, cpus)
+            logger.info("VM %s placed on host %s", vm_name, vm_host)
+
+        definitions.append((vm_name, template_name, vm_host))
+
+    if params['dry_run']:
+        if placement is not None:
+            print_plan(plan, placement)
+        return
+
+    # create the volumes of all the VMs at once, then define the VMs on all
+    # the hosts at once
+    machines = group.get_vm_list([vm_name for vm_name, _, _ in definitions], create=True)
+    xml_descs = []
+    for machine, (_, template_name, _) in zip(machines, definitions):
+        xml_descs += machine.get_missing_volumes(template_name, template_dir)
+    for xml_desc, err in group.get_pool().create_volumes(xml_descs):
+        logger.error("Failed to create volume: %s\n%s", err, xml_desc)
+
+    vm_descs = {}
+    for machine, (vm_name, template_name, vm_host) in zip(machines, definitions):
+        machine.refresh()
+        try:
+            xml_desc = machine.render(template_name, template_dir)
+        except KeyError:
+            logger.error("Volumes of VM %s missing, not defining it", vm_name)
+            continue
+        if xml_desc is not None:
+            vm_descs.setdefault(vm_host, []).append((vm_name, xml_desc))
+    for vm_name, err in group.define_vms(vm_descs):
+        logger.error("Failed to define VM %s: %s", vm_name, err)
 
 
 def do_getmacs(conf, params):
-    group = NodeGroup(conf)
+    group = new_group(conf)
     vm_names = params['vm_names']
     template_name = params['template']
     for vm_name in vm_names:
@@ -515,6 +379,71 @@ def do_getmacs(conf, params):
             print("  %s: %s" % (net, mac))
 
 
+def agent_commands(conf):
+    """Commands served by the agent, with the node group it keeps connected"""
+    return {
+        'list': lambda group, params: do_list(conf, group=group, **params),
+        'action': lambda group, params: do_action(conf, params['params'],
+                                                  params['action'], group=group),
+    }
+
+
+def do_wait(conf, params):
+    state = params['state'].upper()
+    if state not in STATES:
+        utils.clara_exit("Unknown state: %s, use one of %s" % (params['state'], ', '.join(STATES)))
+    try:
+        timeout = float(params['timeout'])
+    except ValueError:
+        utils.clara_exit("Invalid timeout: %s" % params['timeout'])
+
+    group = new_group(conf, events=True)
+    try:
+        watcher = StateWatcher(group, params['vm_names'])
+        pending = watcher.wait(state, timeout)
+    finally:
+        group.close()
+    if pending:
+        utils.clara_exit("VM(s) not %s after %ss: %s" % (
+            state, params['timeout'], ", ".join(
+                "%s (%s)" % (vm_name, watcher.get_state(vm_name)) for vm_name in pending)))
+    logger.info("VM(s) %s: %s", state, ClusterShell.NodeSet.fold(",".join(params['vm_names'])))
+
+
+def run_agent(conf, config_file):
+    check_libvirt()
+    agent = Agent(conf.get_agent_socket(), config_file, agent_commands(conf),
+                  lambda: new_group(conf))
+    agent.run()
+
+
+def agent_request(conf, config_file, command, params):
+    """Run the command with the agent, return False if no agent can run it"""
+    try:
+        reply = request(conf.get_agent_socket(), config_file, command, params)
+    except AgentUnavailable as err:
+        logger.debug("Running the command without agent: %s", err)
+        return False
+    except AgentError as err:
+        # the command is not run again, it may have been run by the agent
+        utils.clara_exit("Command %s failed in the agent, it may have partly run: %s" % (command, err))
+    status = replay(reply)
+    if status:
+        sys.exit(status)
+    return True
+
+
+def run_action(conf, config_file, params, action, use_agent):
+    if use_agent:
+        agent_params = dict(params)
+        if isinstance(params.get('vm_names'), ClusterShell.NodeSet.NodeSet):
+            agent_params['vm_names'] = list(params['vm_names'])
+        if agent_request(conf, config_file, 'action',
+                         {'params': agent_params, 'action': action}):
+            return
+    do_action(conf, params, action)
+
+
 def main():
     logging.debug(sys.argv)
     dargs = docopt.docopt(__doc__)
@@ -532,7 +461,14 @@ def main():
         'template_dir': template_dir,
     }
 
-    if dargs['list']:
+    # The agent only serves the clients using the same configuration file
+    config_file = os.path.abspath(dargs['--virt-config'])
+    use_agent = not dargs['--no-agent']
+
+    if dargs['agent']:
+        run_agent(virt_conf, config_file)
+
+    elif dargs['list']:
         details = dargs['--details']
         legacy = dargs['--legacy']
         color = dargs['--color']
@@ -542,7 +478,11 @@ def main():
         else:
             host_name = None
 
-        do_list(virt_conf, details, legacy, host_name, color)
+        list_params = {'details': details, 'legacy': legacy,
+                       'host_name': host_name, 'color': color,
+                       'output_format': dargs['--format']}
+        if not (use_agent and agent_request(virt_conf, config_file, 'list', list_params)):
+            do_list(virt_conf, **list_params)
 
     else:
         params['force'] = dargs['--yes-i-really-really-mean-it']
@@ -554,10 +494,10 @@ def main():
             # when VM list had been provided, no default to dry run mode
             # so usage it's as legacy one!
             params['force'] = True
-            params['dry_run'] = False
+            params['dry_run'] = dargs['--dry-run']
         elif dargs['migrate']:
             # when no VM had been provided, use dry run mode
-            params['dry_run'] = False if params['force'] else True
+            params['dry_run'] = dargs['--dry-run'] or not params['force']
             if params['dry_run']:
                 message = "migrate action is in dry run mode by default\n"
                 message += "when you had not provided involved VM(s)!\n"
@@ -572,22 +512,31 @@ def main():
             params['template'] = dargs['--template']
             do_define(virt_conf, params)
         elif dargs['undefine']:
-            do_action(virt_conf, params, 'undefine')
+            run_action(virt_conf, config_file, params, 'undefine', use_agent)
         elif dargs['start']:
             params['wipe'] = dargs['--wipe']
-            do_action(virt_conf, params, 'start')
+            params['parallel'] = dargs['--parallel']
+            run_action(virt_conf, config_file, params, 'start', use_agent)
         elif dargs['stop']:
             params['hard'] = dargs['--hard']
-            do_action(virt_conf, params, 'stop')
+            params['parallel'] = dargs['--parallel']
+            run_action(virt_conf, config_file, params, 'stop', use_agent)
         elif dargs['migrate']:
             params['quiet'] = dargs['--quiet']
             params['dest_host'] = dargs['--dest-host']
             params['exclude'] = dargs['--exclude']
             params['include'] = dargs['--include']
-            do_action(virt_conf, params, 'migrate')
+            params['parallel'] = dargs['--parallel']
+            # the questions of an interactive migration can not be asked by the agent
+            use_agent = use_agent and (params['force'] or params['quiet'])
+            run_action(virt_conf, config_file, params, 'migrate', use_agent)
         elif dargs['getmacs']:
             params['template'] = dargs['--template']
             do_getmacs(virt_conf, params)
+        elif dargs['wait']:
+            params['state'] = dargs['--state']
+            params['timeout'] = dargs['--timeout']
+            do_wait(virt_conf, params)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2014-2016 EDF SA                                            #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
+# Default time in seconds given to a BMC to answer a request
+REDFISH_TIMEOUT = 5
+# Default time in seconds during which a discovered topology is used
+TOPOLOGY_TTL = 86400
+
+
+class RedfishError(Exception):
+    """Error of a Redfish request, with the HTTP status of the answer when
+       the BMC answered"""
+
+    def __init__(self, message, status=None):
+        super(RedfishError, self).__init__(message)
+        self.status = status
+
+
+class RedfishClient:
+    """Class which sends the Redfish requests of a BMC
+
+       The requests share a single keep-alive HTTPS connection, so the TCP
+       and TLS handshakes are only done once per BMC.
+    """
+    def __init__(self, host, auth, timeout=REDFISH_TIMEOUT, verify=False):
+        self.host = host
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.verify = verify
+
+    def request(self, path, data=None, method=None):
+        """Send a request to the BMC and return the decoded JSON answer, or
+           the response if it has no JSON body. Raise RedfishError on
+           failure."""
+        if method is None:
+            method = 'GET' if data is None else 'POST'
+        url = "https://{0}{1}".format(self.host, path)
+        logging.debug("redfish/request: {0} {1} {2}".format(method, url, data if data is not None else ""))
+        try:
+            response = self.session.request(method, url, json=data, timeout=self.timeout)
+        except requests.exceptions.RequestException as error:
+            raise RedfishError(str(error))
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            raise RedfishError(str(error), response.status_code)
+        try:
+            return response.json()
+        except ValueError:
+            return response
+
+    def get(self, path):
+        return self.request(path)
+
+    def post(self, path, data):
+        return self.request(path, data)
+
+    def patch(self, path, data):
+        return self.request(path, data, method="PATCH")
+
+    def close(self):
+        self.session.close()
+
+
+class RedfishPool:
+    """Class which runs Redfish operations on many BMCs concurrently
+
+       Each BMC gets its own RedfishClient, and at most `parallel`
+       operations are run at the same time. A failing BMC never stops the
+       others: its error is returned as its result.
+    """
+    def __init__(self, auth, parallel=1, timeout=REDFISH_TIMEOUT, verify=False):
+        self.auth = auth
+        self.parallel = max(parallel, 1)
+        self.timeout = timeout
+        self.verify = verify
+        self.clients = {}
+        self._lock = threading.Lock()
+        requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def client(self, host):
+        with self._lock:
+            if host not in self.clients:
+                self.clients[host] = RedfishClient(host, self.auth, self.timeout, self.verify)
+            return self.clients[host]
+
+    def _run(self, host, operation):
+        try:
+            return operation(self.client(host), host)
+        except RedfishError as error:
+            return error
+        except (KeyError, IndexError, ValueError) as error:
+            # a malformed answer of a BMC is reported like its other errors
+            return RedfishError("unexpected answer: {0}: {1}".format(type(error).__name__, error))
+
+    def run(self, hosts, operation, callback=None):
+        """Run operation(client, host) for each host, call callback(host,
+           result) as soon as each host is done and return the results by
+           host, the result of a failed host being its RedfishError."""
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            futures = {executor.submit(self._run, host, operation): host for host in hosts}
+            for future in as_completed(futures):
+                host = futures[future]
+                results[host] = future.result()
+                if callback is not None:
+                    callback(host, results[host])
+        return results
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+
+
+def discover(client):
+    """Return the topology of a BMC: its vendor, the paths of its system
+       and manager and of the Ethernet interfaces of the node."""
+    root = client.get("/redfish/v1")
+    vendor = root.get('Vendor') or next(iter(root.get('Oem', {})), "")
+    system = client.get("/redfish/v1/Systems")['Members'][0]['@odata.id']
+    managers = client.get("/redfish/v1/Managers").get('Members', [])
+    manager = managers[0]['@odata.id'] if managers else ""
+    # The BMCs whose system is named Self expose the interfaces of the node
+    # with the manager
+    base = manager if "Self" in system and manager else system
+    response = client.get(base + "/EthernetInterfaces")
+    interfaces = [member['@odata.id'] for member in response.get('Members', [])]
+    return {'vendor': vendor, 'system': system, 'manager': manager, 'interfaces': interfaces}
+
+
+class TopologyCache:
+    """Class which stores the topology discovered on each BMC in a JSON
+       file, so that the following commands skip the discovery requests.
+       The entries older than ttl seconds are discovered again."""
+    def __init__(self, path, ttl=TOPOLOGY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.changed = False
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as cache_file:
+                    self.entries = json.load(cache_file)
+            except (OSError, ValueError) as error:
+                logging.warning("redfish/cache: ignoring {0}: {1}".format(path, error))
+
+    def get(self, host):
+        with self._lock:
+            entry = self.entries.get(host)
+        if entry is None or time.time() - entry.get('time', 0) > self.ttl:
+            return None
+        return entry
+
+    def set(self, host, topology):
+        with self._lock:
+            self.entries[host] = dict(topology, time=time.time())
+            self.changed = True
+
+    def invalidate(self, hosts=None):
+        with self._lock:
+            if hosts is None:
+                self.entries = {}
+            else:
+                for host in hosts:
+                    self.entries.pop(host, None)
+            self.changed = True
+
+    def topology(self, client, host, refresh=False):
+        """Return the topology of host, from the cache if it is there"""
+        entry = None if refresh else self.get(host)
+        if entry is None:
+            logging.debug("redfish/cache: discovering {0}".format(host))
+            entry = discover(client)
+            self.set(host, entry)
+        return entry
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as cache_file:
+                json.dump(self.entries, cache_file, indent=1)
+            os.replace(tmp_path, self.path)
+            self.changed = False
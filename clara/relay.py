@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2014-2016 EDF SA                                            #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+import logging
+import os
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Command run on a relay host to forward a file to another host
+RELAY_COMMAND = "ssh -o BatchMode=yes {host} mkdir -p {directory} && " \
+                "scp -p -o BatchMode=yes {file} {host}:{directory}/"
+
+
+class Relay:
+    """Class which distributes files to hosts by relaying them from host to host
+
+       At each hop, the admin node sends the files with SFTP to `fanout`
+       hosts while every host which already has the files forwards them to
+       `fanout` other hosts, so the number of hops grows logarithmically
+       with the number of hosts.
+    """
+    def __init__(self, sftp_client, fanout, command=RELAY_COMMAND):
+        self.sftp_client = sftp_client
+        self.fanout = fanout
+        self.command = command
+
+    def _relay(self, assignments, files, destination):
+        """Run the relay commands on the source hosts, each one forwarding
+           the files to its targets. Returns the lists of the targets reached
+           and of the failed ones."""
+        from ClusterShell.Task import task_self
+
+        task = task_self()
+        workers = {}
+        for source, targets in assignments.items():
+            for target in targets:
+                cmd = " && ".join(
+                    self.command.format(file=shlex.quote(os.path.join(destination, os.path.basename(f))),
+                                        host=target,
+                                        directory=shlex.quote(destination))
+                    for f in files)
+                logging.debug("relay/push: %s: %s", source, cmd)
+                workers[target] = (source, task.shell(cmd, nodes=source))
+        task.resume()
+
+        reached = []
+        failed = []
+        for target, (source, worker) in workers.items():
+            try:
+                retcode = worker.node_retcode(source)
+            except KeyError:
+                retcode = None
+            if retcode == 0:
+                logging.debug("relay/push: %s -> %s: OK", source, target)
+                reached.append(target)
+            else:
+                logging.error("relay/push: %s failed to forward files to %s", source, target)
+                failed.append(target)
+        return reached, failed
+
+    def upload(self, files, destination, mode=None):
+        """Distribute files in the destination directory of the hosts of the
+           SFTP client and return the list of hosts where it failed."""
+        relay_files = list(files)
+        if self.sftp_client.chunk_size:
+            # keep the manifests along so that next chunked pushes stay incremental
+            relay_files += [f + ".manifest" for f in files]
+
+        pending = list(self.sftp_client.hosts)
+        sources = []
+        failed = []
+        hop = 0
+        while pending:
+            hop += 1
+            start = time.time()
+            targets, pending = pending[:self.fanout], pending[self.fanout:]
+            assignments = {}
+            for source in sources:
+                if not pending:
+                    break
+                assignments[source], pending = pending[:self.fanout], pending[self.fanout:]
+
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                relayed = executor.submit(self._relay, assignments, relay_files, destination)
+                sftp_failed = self.sftp_client.upload(files, destination, mode, hosts=targets)
+                reached, relay_failed = relayed.result()
+
+            reached += [host for host in targets if host not in sftp_failed]
+            failed += sftp_failed + relay_failed
+            sources += reached
+            logging.info("relay/push: hop %d: %d/%d hosts reached from %d relays in %.1fs, %d remaining",
+                         hop, len(reached), len(reached) + len(sftp_failed) + len(relay_failed),
+                         len(assignments) + 1, time.time() - start, len(pending))
+
+        if failed:
+            logging.warning("relay/push: distribution failed on %d hosts: %s",
+                            len(failed), ",".join(failed))
+        return failed
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2014-2016 EDF SA                                            #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+"""
+Local store of the System Event Logs (SEL) of the nodes, filled
+incrementally by the selsync commands of clara ipmi and clara redfish and
+queried without contacting the BMCs.
+"""
+
+import logging
+import os
+import sqlite3
+
+import ClusterShell.NodeSet
+
+# Format of the creation time of the entries in the store
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    node TEXT NOT NULL,
+    source TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    created TEXT,
+    sensor_type TEXT,
+    message TEXT,
+    code TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS entries_key
+    ON entries (node, source, id, IFNULL(created, ''), IFNULL(message, ''));
+CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+CREATE INDEX IF NOT EXISTS entries_sensor_type ON entries (sensor_type);
+CREATE TABLE IF NOT EXISTS nodes (
+    node TEXT NOT NULL,
+    source TEXT NOT NULL,
+    last_sync TEXT,
+    last_id INTEGER,
+    last_created TEXT,
+    PRIMARY KEY (node, source)
+);
+"""
+
+# Columns added to the nodes table of the stores created by older versions
+NODES_COLUMNS = {'last_id': 'INTEGER', 'last_created': 'TEXT'}
+
+
+def default_path():
+    if os.geteuid() == 0:
+        return "/var/lib/clara/sel.db"
+    return "%s/.local/share/clara/sel.db" % os.environ["HOME"]
+
+
+class SelStore:
+    """Class which stores the SEL entries of the nodes in a SQLite database
+
+       The entries are identified by the node, the source they were read
+       from (ipmi or redfish), their id in the SEL of the node, their
+       creation time and their message: the BMCs reuse the ids when the SEL
+       wraps or is cleared.
+    """
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        # the entries of the stores created by older versions are identified
+        # by their id only
+        old_key = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = "
+                                  "'sqlite_autoindex_entries_1'").fetchone() is not None
+        if old_key:
+            self.db.executescript("ALTER TABLE entries RENAME TO entries_old; "
+                                  "DROP INDEX IF EXISTS entries_created; "
+                                  "DROP INDEX IF EXISTS entries_sensor_type;")
+        self.db.executescript(SCHEMA)
+        if old_key:
+            with self.db:
+                self.db.execute("INSERT INTO entries SELECT * FROM entries_old")
+                self.db.execute("DROP TABLE entries_old")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(nodes)")]
+        for column, column_type in NODES_COLUMNS.items():
+            if column not in columns:
+                self.db.execute("ALTER TABLE nodes ADD COLUMN {0} {1}".format(column, column_type))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def count(self, node, source):
+        """Return the number of entries stored for the node"""
+        return self.db.execute("SELECT COUNT(*) FROM entries WHERE node = ? AND source = ?",
+                               (node, source)).fetchone()[0]
+
+    def last(self, node, source):
+        """Return the id and the creation time of the last entry of the SEL
+           of the node seen by the previous synchronization, None and None
+           if there is none."""
+        row = self.db.execute("SELECT last_id, last_created FROM nodes WHERE node = ? AND source = ?",
+                              (node, source)).fetchone()
+        return (None, None) if row is None else row
+
+    def reset(self, node, source):
+        """Forget the entries of the node, when its SEL has been cleared"""
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE node = ? AND source = ?", (node, source))
+            self.db.execute("UPDATE nodes SET last_id = NULL, last_created = NULL "
+                            "WHERE node = ? AND source = ?", (node, source))
+
+    def add(self, node, source, entries, sync_time):
+        """Store new entries of the node, oldest first, return the number of
+           entries which were not already stored. The last one is remembered
+           as the last entry seen in the SEL of the node."""
+        last_id, last_created = (entries[-1]['id'], entries[-1]['created']) if entries else (None, None)
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(node, source, entry['id'], entry['created'], entry['sensor_type'],
+                  entry['message'], entry['code']) for entry in entries])
+            added = self.db.total_changes - before
+            self.db.execute(
+                "INSERT INTO nodes VALUES (?, ?, ?, ?, ?) ON CONFLICT (node, source) DO UPDATE "
+                "SET last_sync = excluded.last_sync, "
+                "last_id = COALESCE(excluded.last_id, last_id), "
+                "last_created = COALESCE(excluded.last_created, last_created)",
+                (node, source, sync_time, last_id, last_created))
+        return added
+
+    def query(self, nodes=None, sensor_type=None, since=None, until=None):
+        """Return the stored entries, optionally only the ones of the nodes,
+           of a sensor type or created in a time window"""
+        clauses = []
+        params = []
+        if nodes is not None:
+            clauses.append("node IN ({0})".format(",".join("?" * len(nodes))))
+            params.extend(nodes)
+        if sensor_type is not None:
+            clauses.append("sensor_type LIKE ?")
+            params.append(sensor_type)
+        if since is not None:
+            clauses.append("created >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("created <= ?")
+            params.append(until)
+        sql = "SELECT node, source, id, created, sensor_type, message, code FROM entries"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY created, node, id"
+        return self.db.execute(sql, params).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def new_entries(entries, last_id, last_created, whole):
+    """Compare the last entries of the SEL of a node, oldest first, with the
+       last entry seen by the previous synchronization. whole tells whether
+       entries is the whole SEL. Return whether the SEL has been cleared
+       since, whether the comparison is possible and the new entries.
+
+       The SEL has been cleared if the id of the last entry seen was reused
+       by a newer entry, or if the newest entry of the whole SEL is older
+       than the last entry seen. The comparison needs more entries if the
+       last entry seen is not in a part of the SEL."""
+    if last_id is None:
+        return False, True, entries
+    for position in range(len(entries) - 1, -1, -1):
+        if entries[position]['id'] == last_id:
+            if entries[position]['created'] != last_created:
+                return True, whole, entries
+            return False, True, entries[position + 1:]
+    if not whole:
+        return False, False, []
+    if not entries:
+        return True, True, []
+    newest = entries[-1]
+    if (newest['created'] and last_created and newest['created'] < last_created) or \
+            (isinstance(newest['id'], int) and isinstance(last_id, int) and newest['id'] < last_id):
+        return True, True, entries
+    # the last entry seen has been overwritten by newer ones
+    return False, True, entries
+
+
+def format_entry(row):
+    node, source, entry_id, created, sensor_type, message, code = row
+    return "{0} | {1} | {2} | {3} | {4} | {5} | {6}".format(node, source, entry_id, created,
+                                                        sensor_type, message, code)
+
+
+def query(path, hosts=None, sensor_type=None, since=None, until=None):
+    """Log the stored entries matching the filters, of all the nodes if
+       hosts is None"""
+    nodes = None if hosts is None else list(ClusterShell.NodeSet.NodeSet(hosts))
+    with SelStore(path) as store:
+        rows = store.query(nodes, sensor_type, since, until)
+    for row in rows:
+        logging.info(format_entry(row))
+    return rows
@@ -33,20 +33,89 @@
 #                                                                            #
 ##############################################################################
 
+import hashlib
+import json
 import logging
 
 import os
 import paramiko
+import shlex
 import stat
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import humanize
+
+# Default size of the chunks compared by chunked transfers
+CHUNK_SIZE = 4 * 1024 * 1024
+# Number of chunks written between two saves of a partial transfer state
+CHECKPOINT_CHUNKS = 16
+
+
+def build_manifest(path, chunk_size=CHUNK_SIZE):
+    """Return the block-level manifest of a local file: its size, the SHA256
+       of each chunk and of the full file. The manifest is stored beside the
+       file and reused as long as the file is unchanged."""
+    manifest_path = path + ".manifest"
+    st = os.stat(path)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['size'] == st.st_size and manifest['mtime'] == st.st_mtime \
+           and manifest['chunk_size'] == chunk_size:
+            return manifest
+    except (IOError, ValueError, KeyError):
+        pass
+
+    logging.debug("sftp/manifest: computing manifest of %s", path)
+    chunks = []
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+            chunks.append(hashlib.sha256(data).hexdigest())
+    manifest = {'size': st.st_size,
+                'mtime': st.st_mtime,
+                'chunk_size': chunk_size,
+                'chunks': chunks,
+                'digest': digest.hexdigest()}
+    try:
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+    except IOError as e:
+        logging.debug("sftp/manifest: can't store manifest %s: %s", manifest_path, e)
+    return manifest
 
 
 class Sftp:
-    """Class which sends files of SFTP"""
-    def __init__(self, hosts, username, private_key, passphrase=None):
+    """Class which sends files of SFTP
+
+       One authenticated transport is kept per host for the lifetime of the
+       object, so successive uploads reuse the same SSH sessions. Hosts are
+       processed concurrently by a pool of at most `parallel` threads (one
+       thread per host when parallel is None).
+    """
+    def __init__(self, hosts, username, private_key, passphrase=None, parallel=None,
+                 chunk_size=None):
         self.hosts = hosts
         self.username = username
         self.private_key = paramiko.RSAKey.from_private_key_file(private_key, password=passphrase)
+        self.parallel = parallel
+        self.chunk_size = chunk_size
+        self.clients = {}
+        self.manifests = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     @staticmethod
     def _is_dir(sftp_client, path):
@@ -66,8 +135,46 @@ class Sftp:
         sftp_client.mkdir(path)
         sftp_client.chmod(path, dirmode)
 
+    def _connect(self, host):
+        """Return the SFTP client for host, opening and authenticating the
+           transport on first use. Returns None if the host can't be reached.
+        """
+        with self._lock:
+            sftp_client = self.clients.get(host)
+        if sftp_client is not None:
+            return sftp_client
+
+        try:
+            transport = paramiko.Transport((host, 22))
+            try:
+                transport.connect(username=self.username, pkey=self.private_key)
+            except Exception:
+                # do not leak the socket and the thread of the transport
+                transport.close()
+                raise
+        except socket.gaierror as e:
+            logging.error("sftp/push: Failed to connect to host %s" % host)
+            logging.info("sftp/push: Connection error: %s." % e)
+            return None
+        except paramiko.ssh_exception.SSHException as e:
+            logging.error("sftp/push: SSH failed to %s@%s" % (self.username, host))
+            logging.info("sftp/push: SSH error: %s." % e)
+            return None
+        except socket.error as e:
+            logging.error("sftp/push: Failed to connect to host %s" % host)
+            logging.info("sftp/push: Connection error: %s." % e)
+            return None
+        sftp_client = paramiko.SFTPClient.from_transport(transport)
+
+        with self._lock:
+            self.clients[host] = sftp_client
+        return sftp_client
+
     def _upload(self, source_paths, sftp_client, remote_host, destination_path, mode, dirmode):
+        """Upload source_paths to destination_path on remote_host and return
+           the number of bytes sent."""
         hostname = socket.gethostname()
+        sent = 0
         # Upload the files
         for source_file_path in source_paths:
             source_dir_path = os.path.dirname(source_file_path)
@@ -80,27 +187,250 @@ class Sftp:
                 # Create remote directory if necessary
                 logging.info("sftp/upload: uploading %s to %s:%s" % (source_file_path, remote_host, dest_file_path))
                 Sftp._mkdir(sftp_client, destination_path, dirmode)
-                sftp_client.put(source_file_path, dest_file_path)
-                if mode:
-                    sftp_client.chmod(dest_file_path, mode)
+                if self.chunk_size:
+                    sent += self._chunked_put(sftp_client, remote_host, source_file_path,
+                                              dest_file_path, mode)
+                else:
+                    # the manifest of a previous chunked transfer is stale
+                    Sftp._remove(sftp_client, dest_file_path + ".manifest")
+                    sftp_client.put(source_file_path, dest_file_path)
+                    if mode:
+                        sftp_client.chmod(dest_file_path, mode)
+                    sent += os.path.getsize(source_file_path)
+        return sent
 
-    def upload(self, files, destination, mode=None, dirmode=0o0755):
-        logging.info("sftp/push: pushing data on hosts %s", self.hosts)
+    @staticmethod
+    def _exec(sftp_client, cmd):
+        """Run a command on the remote host over the SFTP transport and return
+           its output, or None if it can't be run or fails."""
+        try:
+            channel = sftp_client.get_channel().get_transport().open_session()
+            channel.exec_command(cmd)
+            output = channel.makefile('r').read()
+            status = channel.recv_exit_status()
+            channel.close()
+        except (paramiko.ssh_exception.SSHException, EOFError, socket.error) as e:
+            logging.debug("sftp/exec: '%s' failed: %s", cmd, e)
+            return None
+        if status != 0:
+            return None
+        if isinstance(output, bytes):
+            output = output.decode()
+        return output
+
+    @staticmethod
+    def _read_manifest(sftp_client, path):
+        try:
+            with sftp_client.open(path, 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_manifest(sftp_client, path, manifest):
+        with sftp_client.open(path + ".tmp", 'w') as f:
+            f.write(json.dumps(manifest))
+        Sftp._rename(sftp_client, path + ".tmp", path)
+
+    @staticmethod
+    def _remove(sftp_client, path):
+        try:
+            sftp_client.remove(path)
+        except IOError:
+            pass
 
-        for host in self.hosts:
+    @staticmethod
+    def _rename(sftp_client, source, destination):
+        try:
+            sftp_client.posix_rename(source, destination)
+        except IOError:
+            # server without the posix-rename extension
             try:
-                transport = paramiko.Transport((host, 22))
-                transport.connect(username=self.username, pkey=self.private_key)
-            except socket.gaierror as e:
-                logging.error("sftp/push: Failed to connect to host %s" % host)
-                logging.info("sftp/push: Connection error: %s." % e)
-                continue
-            except paramiko.ssh_exception.SSHException as e:
-                logging.error("sftp/push: SSH failed to %s@%s" % (self.username, host))
-                logging.info("sftp/push: SSH error: %s." % e)
-                continue
-            sftp_client = paramiko.SFTPClient.from_transport(transport)
-
-            logging.debug("sftp/push: copying files")
-            self._upload(files, sftp_client, host, destination, mode, dirmode)
+                sftp_client.remove(destination)
+            except IOError:
+                pass
+            sftp_client.rename(source, destination)
+
+    @staticmethod
+    def _remote_digest(sftp_client, path):
+        """Return the SHA256 of a remote file, computed on the remote host
+           when possible, by reading the file back otherwise."""
+        output = Sftp._exec(sftp_client, "sha256sum %s" % shlex.quote(path))
+        if output:
+            return output.split()[0]
+        digest = hashlib.sha256()
+        with sftp_client.open(path, 'r') as f:
+            f.prefetch()
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+        return digest.hexdigest()
+
+    def _chunked_put(self, sftp_client, remote_host, source_file_path, dest_file_path, mode,
+                     reuse=True):
+        """Send only the chunks of source_file_path which differ from the
+           remote copy, in a partial file which is renamed into place once
+           its digest matches. An interrupted transfer is resumed from the
+           state of the partial file. If the digest does not match, the
+           remote manifests are dropped and the whole file is sent once
+           again, without reuse. Returns the number of bytes sent."""
+        manifest = self.manifests[source_file_path]
+        chunk_size = manifest['chunk_size']
+        part_path = dest_file_path + ".part"
+        part_manifest_path = part_path + ".manifest"
+
+        # What is already on the remote host: either an interrupted transfer
+        # or the previous version of the file.
+        state = None
+        part = self._read_manifest(sftp_client, part_manifest_path) if reuse else None
+        if part is not None and part.get('chunk_size') == chunk_size \
+           and self._is_file(sftp_client, part_path):
+            logging.info("sftp/upload: resuming transfer of %s to %s", dest_file_path, remote_host)
+            state = part['chunks']
+        elif reuse:
+            remote = self._read_manifest(sftp_client, dest_file_path + ".manifest")
+            if remote is not None and remote.get('chunk_size') == chunk_size \
+               and self._size(sftp_client, dest_file_path) == remote.get('size') \
+               and self._exec(sftp_client, "cp -f %s %s" % (shlex.quote(dest_file_path),
+                                                           shlex.quote(part_path))) is not None:
+                state = remote['chunks']
+        if state is None:
+            state = []
+            sftp_client.open(part_path, 'w').close()
+
+        # Forget the chunks which are going to be rewritten before touching
+        # them, so that an interruption never leaves a stale hash behind.
+        chunks = manifest['chunks']
+        state = [state[i] if i < len(state) and state[i] == chunks[i] else None
+                 for i in range(len(chunks))]
+        todo = [i for i, chunk in enumerate(chunks) if state[i] != chunk]
+        self._write_manifest(sftp_client, part_manifest_path,
+                             {'chunk_size': chunk_size, 'chunks': state})
+        logging.info("sftp/upload: %d/%d chunks to send to %s:%s", len(todo), len(chunks),
+                     remote_host, dest_file_path)
+
+        sent = 0
+        with open(source_file_path, 'rb') as source, sftp_client.open(part_path, 'r+') as dest:
+            dest.set_pipelined(True)
+            for count, i in enumerate(todo, 1):
+                source.seek(i * chunk_size)
+                data = source.read(chunk_size)
+                dest.seek(i * chunk_size)
+                dest.write(data)
+                sent += len(data)
+                state[i] = chunks[i]
+                if count % CHECKPOINT_CHUNKS == 0:
+                    dest.flush()
+                    self._write_manifest(sftp_client, part_manifest_path,
+                                         {'chunk_size': chunk_size, 'chunks': state})
+            dest.flush()
+            dest.truncate(manifest['size'])
+        self._write_manifest(sftp_client, part_manifest_path,
+                             {'chunk_size': chunk_size, 'chunks': state})
+
+        if self._remote_digest(sftp_client, part_path) != manifest['digest']:
+            # The remote copy was modified behind the manifests, start from
+            # scratch
+            sftp_client.remove(part_manifest_path)
+            sftp_client.remove(part_path)
+            self._remove(sftp_client, dest_file_path + ".manifest")
+            if not reuse:
+                raise IOError("checksum mismatch on %s:%s" % (remote_host, part_path))
+            logging.warning("sftp/upload: checksum mismatch on %s:%s, sending the whole file",
+                            remote_host, part_path)
+            return sent + self._chunked_put(sftp_client, remote_host, source_file_path,
+                                            dest_file_path, mode, reuse=False)
+
+        if mode:
+            sftp_client.chmod(part_path, mode)
+        self._rename(sftp_client, part_path, dest_file_path)
+        self._write_manifest(sftp_client, dest_file_path + ".manifest", manifest)
+        sftp_client.remove(part_manifest_path)
+        return sent
+
+    @staticmethod
+    def _size(sftp_client, path):
+        try:
+            return sftp_client.stat(path).st_size
+        except IOError:
+            return None
+
+    @staticmethod
+    def _is_file(sftp_client, path):
+        try:
+            return stat.S_ISREG(sftp_client.stat(path).st_mode)
+        except IOError:
+            return False
+
+    def _upload_host(self, host, files, destination, mode, dirmode):
+        """Upload files on one host and return a (bytes, seconds, error)
+           tuple describing the transfer."""
+        start = time.time()
+        sftp_client = self._connect(host)
+        if sftp_client is None:
+            return 0, time.time() - start, "connection failed"
+
+        logging.debug("sftp/push: copying files to %s", host)
+        try:
+            sent = self._upload(files, sftp_client, host, destination, mode, dirmode)
+        except (IOError, paramiko.ssh_exception.SSHException) as e:
+            logging.error("sftp/push: Failed to upload files to %s: %s" % (host, e))
+            return 0, time.time() - start, str(e)
+        return sent, time.time() - start, None
+
+    @staticmethod
+    def _summary(results):
+        """Log the throughput and the failures of each host."""
+        for host, (sent, elapsed, error) in results.items():
+            if error is not None:
+                logging.warning("sftp/push: %s: FAILED (%s)", host, error)
+            else:
+                rate = sent / elapsed if elapsed > 0 else 0
+                logging.info("sftp/push: %s: %s in %.1fs (%s/s)", host,
+                             humanize.naturalsize(sent), elapsed,
+                             humanize.naturalsize(rate))
+        failed = [host for host, result in results.items() if result[2] is not None]
+        if failed:
+            logging.warning("sftp/push: upload failed on %d/%d hosts: %s",
+                            len(failed), len(results), ",".join(failed))
+
+    def upload(self, files, destination, mode=None, dirmode=0o0755, hosts=None):
+        """Upload files in the destination directory of all hosts (or only
+           of the given subset) and return the list of hosts where the upload
+           failed."""
+        if hosts is None:
+            hosts = self.hosts
+        logging.info("sftp/push: pushing data on hosts %s", hosts)
+        if not hosts:
+            return []
+
+        if self.chunk_size:
+            for source_file_path in files:
+                if source_file_path not in self.manifests:
+                    self.manifests[source_file_path] = build_manifest(source_file_path,
+                                                                      self.chunk_size)
+
+        workers = len(hosts)
+        if self.parallel:
+            workers = min(workers, self.parallel)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {host: executor.submit(self._upload_host, host, files,
+                                             destination, mode, dirmode)
+                       for host in hosts}
+        results = {host: future.result() for host, future in futures.items()}
+
+        self._summary(results)
+        return [host for host, result in results.items() if result[2] is not None]
+
+    def close(self):
+        """Close all the SFTP sessions and their transports."""
+        with self._lock:
+            clients = list(self.clients.values())
+            self.clients = {}
+        for sftp_client in clients:
+            transport = sftp_client.get_channel().get_transport()
             sftp_client.close()
+            transport.close()
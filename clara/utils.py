@@ -39,26 +39,17 @@ import os
 import subprocess
 import configparser
 import sys
-try:
-    import distro
-except ImportError as e:
-    import platform
 
 import ClusterShell.NodeSet
-import ClusterShell.Task
 
 import json
 import shlex
+from collections.abc import Mapping
+from types import MappingProxyType
 
-try:
-    from requests.packages.urllib3.exceptions import InsecureRequestWarning
-    import requests
-except:
-    print("[WARN] PLS raise 'pip install requests' or install 'python3-requests' package, need by redfish!")
-    pass
-
-import distutils
-from distutils import util
+# The modules which are slow to import (requests, ClusterShell.Task, distro)
+# are imported by the functions which need them, to keep the startup of
+# clara fast.
 
 class Conf:
     """Class which contains runtime variables"""
@@ -152,6 +143,8 @@ def do_print(table, data, legacy=None):
 
 
 def get_response(url, endpoint, headers, data=None, method=None, verify=False):
+    import requests
+    from requests.packages.urllib3.exceptions import InsecureRequestWarning
     try:
         if data == None and method == None:
             method = 'GET'
@@ -178,9 +171,10 @@ def get_response(url, endpoint, headers, data=None, method=None, verify=False):
         sys.exit(1)
 
 def clush(hosts, cmds):
+    from ClusterShell.Task import task_self
     logging.debug("utils/clush: {0} {1}".format(cmds, hosts))
 
-    task = ClusterShell.Task.task_self()
+    task = task_self()
     task.run(cmds, nodes=hosts)
 
     for output, nodes in task.iter_buffers():
@@ -227,64 +221,207 @@ def run(cmd, exit_on_error=True, stdin=None, input=None, stdout=None, stderr=Non
         return output.rstrip().decode(), error.rstrip().decode()
 
 
-def get_from_config(section, value, dist=''):
-    """ Read a value from config.ini and return it"""
-    if dist == '':
-        try:
-            return getconfig().get(section, value).strip()
-        except:
-            clara_exit("Value '{0}' not found in the section '{1}'".format(value, section))
+class ConfigView(Mapping):
+    """Immutable view of a section of config.ini for a distribution: the values
+       of the section-dist override section take precedence over the values of
+       the section."""
+
+    def __init__(self, section, dist, values):
+        self.section = section
+        self.dist = dist
+        self._values = values
+
+    def __getitem__(self, value):
+        return self._values[value]
+
+    def __iter__(self):
+        return iter(self._values)
 
-    elif dist in getconfig().get("common", "allowed_distributions"):
-        or_section = section + "-" + dist
+    def __len__(self):
+        return len(self._values)
 
-        # If the value is not in the override section, return the base value
-        if getconfig().has_option(or_section, value):
+    def __repr__(self):
+        return "ConfigView({0!r}, {1!r}, {2!r})".format(self.section, self.dist, self._values)
+
+    def _where(self):
+        if self.dist:
+            return "section '{0}' for '{1}'".format(self.section, self.dist)
+        return "section '{0}'".format(self.section)
+
+    def get_bool(self, value, default=False):
+        if value not in self._values:
+            return default
+        try:
+            return strtobool(self._values[value])
+        except ValueError:
+            clara_exit("Value '{0}' of {1} is not a boolean".format(value, self._where()))
+
+    def get_int(self, value, default=None):
+        if value not in self._values:
+            return default
+        try:
+            return int(self._values[value])
+        except ValueError:
+            clara_exit("Value '{0}' of {1} is not an integer".format(value, self._where()))
+
+
+# The typed values of config.ini, checked when the configuration is compiled
+CONFIG_TYPES = {
+    ("chroot", "gpg_check"): "bool",
+    ("images", "gpg_check"): "bool",
+    ("images", "initrd_parallel"): "int",
+    ("images", "push_fanout"): "int",
+    ("images", "sftp_chunk_size"): "int",
+    ("images", "sftp_chunked"): "bool",
+    ("images", "sftp_parallel"): "int",
+    ("ipmi", "parallel"): "int",
+    ("ipmi", "port"): "int",
+    ("ipmi", "retries"): "int",
+    ("ipmi", "ssh_jump_host"): "bool",
+    ("ipmi", "timeout"): "int",
+    ("redfish", "cache_ttl"): "int",
+    ("redfish", "parallel"): "int",
+    ("redfish", "timeout"): "int",
+}
+
+
+class CompiledConfig:
+    """The sections of config.ini parsed once, with the values stripped and
+       interpolated. The views of the sections for each distribution are built
+       on first use and cached."""
+
+    def __init__(self, config):
+        self.sections = {}
+        for section in config.sections():
             try:
-                return getconfig().get(or_section, value).strip()
-            except:
-                clara_exit("Value '{0}' not found in section '{1}'".format(value, section))
-        else:
-            if getconfig().has_option(section, value):
-                return getconfig().get(section, value).strip()
-            else:
-                # we specify a certain values that can accept a None as a value
-                if (value=="trg_dir" or value=="trg_img" or value=="mirror_local"):
-                    return None
-                else:
-                    clara_exit("Value '{0}' not found in section '{1}'".format(value, section))
-    else:
+                self.sections[section] = {key: value.strip()
+                                          for key, value in config.items(section)}
+            except configparser.Error as err:
+                clara_exit("Invalid section '{0}' in the configuration: {1}".format(section, err))
+        self.distributions = tuple(
+            d.strip() for d in self.sections.get("common", {}).get("allowed_distributions", "").split(",")
+            if d.strip())
+        self._views = {}
+        for (section, value), kind in CONFIG_TYPES.items():
+            for dist in ('',) + self.distributions:
+                getattr(self.view(section, dist), "get_" + kind)(value)
+
+    def view(self, section, dist=''):
+        key = (section, dist)
+        if key not in self._views:
+            values = dict(self.sections.get(section, {}))
+            if dist:
+                values.update(self.sections.get(section + "-" + dist, {}))
+            self._views[key] = ConfigView(section, dist, MappingProxyType(values))
+        return self._views[key]
+
+
+def compiled_config():
+    """Return the compiled form of the configuration returned by getconfig(),
+       compiling it on first use. Configuration errors make clara exit."""
+    config = getconfig()
+    # ConfigParser objects are not hashable, the compiled form is kept with
+    # the object so that it is dropped with it. ClaraConfigParser drops it
+    # when the object is modified.
+    if getattr(config, "clara_compiled", None) is None:
+        config.clara_compiled = CompiledConfig(config)
+    return config.clara_compiled
+
+
+def get_distributions():
+    """Return the tuple of the allowed distributions"""
+    return compiled_config().distributions
+
+
+def config_view(section, dist=''):
+    """Return the ConfigView of a section for the distribution dist, exit if
+       the distribution is not allowed."""
+    compiled = compiled_config()
+    if dist and dist not in compiled.distributions:
         clara_exit("{0} is not a known distribution".format(dist))
+    return compiled.view(section, dist)
 
-def get_from_config_or(section, value, dist='', default=''):
-    """ Read a value from config.ini and return it"""
-    try:
-        if dist == '':
-            return getconfig().get(section, value).strip()
 
-        elif dist in getconfig().get("common", "allowed_distributions"):
-            or_section = section + "-" + dist
+def get_from_config(section, value, dist=''):
+    """ Read a value from config.ini and return it"""
+    view = config_view(section, dist)
+    if value in view:
+        return view[value]
+    # we specify a certain values that can accept a None as a value
+    if dist and value in ("trg_dir", "trg_img", "mirror_local"):
+        return None
+    clara_exit("Value '{0}' not found in section '{1}'".format(value, section))
 
-            # If the value is not in the override section, return the base value
-            if getconfig().has_option(or_section, value):
-                return getconfig().get(or_section, value).strip()
-            else:
-                return getconfig().get(section, value).strip()
-    except:
+def get_from_config_or(section, value, dist='', default=''):
+    """ Read a value from config.ini and return it"""
+    compiled = compiled_config()
+    if dist and dist not in compiled.distributions:
         return default
+    return compiled.view(section, dist).get(value, default)
 
 def get_bool_from_config_or(section, value, dist='', default=False):
     """ Read a boolean value from config.ini and return it"""
-    string_value = get_from_config_or(section, value, dist, None)
-    if string_value is None:
+    compiled = compiled_config()
+    if dist and dist not in compiled.distributions:
+        return default
+    return compiled.view(section, dist).get_bool(value, default)
+
+def get_int_from_config(section, value, dist=''):
+    """ Read an integer value from config.ini and return it"""
+    get_from_config(section, value, dist)
+    return config_view(section, dist).get_int(value)
+
+def get_int_from_config_or(section, value, dist='', default=None):
+    """ Read an integer value from config.ini and return it"""
+    compiled = compiled_config()
+    if dist and dist not in compiled.distributions:
         return default
-    return distutils.util.strtobool(string_value) == 1
+    return compiled.view(section, dist).get_int(value, default)
+
+def strtobool(value):
+    """Convert a string representation of truth to True or False"""
+    value = value.lower()
+    if value in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    elif value in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError("invalid truth value {0!r}".format(value))
 
 def has_config_value(section, value, dist=''):
     """Return True if value is found in config.ini"""
     return (get_from_config_or(section, value, dist, None) is not None)
 
 
+class ClaraConfigParser(configparser.ConfigParser):
+    """ConfigParser dropping its compiled form when it is modified"""
+
+    clara_compiled = None
+
+    def read(self, *args, **kwargs):
+        self.clara_compiled = None
+        return super(ClaraConfigParser, self).read(*args, **kwargs)
+
+    def read_file(self, *args, **kwargs):
+        self.clara_compiled = None
+        super(ClaraConfigParser, self).read_file(*args, **kwargs)
+
+    def add_section(self, *args, **kwargs):
+        self.clara_compiled = None
+        super(ClaraConfigParser, self).add_section(*args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        self.clara_compiled = None
+        super(ClaraConfigParser, self).set(*args, **kwargs)
+
+    def remove_option(self, *args, **kwargs):
+        self.clara_compiled = None
+        return super(ClaraConfigParser, self).remove_option(*args, **kwargs)
+
+    def remove_section(self, *args, **kwargs):
+        self.clara_compiled = None
+        return super(ClaraConfigParser, self).remove_section(*args, **kwargs)
+
+
 def getconfig():
     # Set a default configuration file in /usr as a backup conf file where it loads ONLY
     # the configuration params that are missing in the provided conf file /etc/clara/config.ini
@@ -294,7 +431,7 @@ def getconfig():
         files.append(conf.config)
 
     if getconfig.config is None:
-        getconfig.config = configparser.ConfigParser()
+        getconfig.config = ClaraConfigParser()
         getconfig.config.read(files)
 
     return getconfig.config
@@ -354,17 +491,21 @@ def initialize_logger(debug):
 
 
 def os_distribution():
-    if 'platform' in sys.modules:
+    try:
+        import distro
+    except ImportError:
+        import platform
         return platform.dist()[0]
-    else:
-        return distro.distro_release_info()['id']
+    return distro.distro_release_info()['id']
 
 
 def os_major_version():
-    if 'platform' in sys.modules:
+    try:
+        import distro
+    except ImportError:
+        import platform
         return int(platform.dist()[1].split('.')[0])
-    else:
-        return int(distro.major_version())
+    return int(distro.major_version())
 
 def makedirs_mode(path, mode):
     """Create directory recursively and set specific mode, no matter the
@@ -387,6 +528,39 @@ def clara_exit(msg):
     logging.error(msg)
     sys.exit(1)
 
+
+def profile_imports(modules, top=15):
+    """Import the modules in a new interpreter with '-X importtime' and return
+       the total import time and the slowest modules, as a list of
+       (cumulative time, module name) tuples. The times are in microseconds."""
+    code = "; ".join("import {0}".format(module) for module in modules)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        errors = proc.stderr.strip().splitlines()
+        clara_exit("Failed to import {0}: {1}".format(", ".join(modules),
+                                                      errors[-1] if errors else proc.returncode))
+
+    times = []
+    total = 0
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue  # header line
+        name = fields[2].rstrip()
+        times.append((cumulative, name.strip()))
+        # the modules imported by other modules are indented
+        if not name.startswith("  "):
+            total += cumulative
+    times.sort(reverse=True)
+    return total, times[:top]
+
 def module(command, *arguments, **kwargs):
     """
     Execute a regular Lmod command and apply environment changes to
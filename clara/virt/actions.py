@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2016 EDF SA                                                 #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+"""
+Start and stop of VMs on the hosts of a node group, several at once, in the
+order of the roles of the VMs.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from clara.virt.placement import vm_role
+from clara.virt.watcher import StateWatcher
+
+logger = logging.getLogger(__name__)
+
+
+def get_stages(vm_names, role_order, reverse=False):
+    """Split the VMs in lists of VMs to run one after the other: the VMs whose
+       roles have the lowest order first, the VMs whose roles have no order
+       last. The lists are returned in the reverse order with reverse."""
+    stages = {}
+    for vm_name in vm_names:
+        stages.setdefault(role_order.get(vm_role(vm_name)), []).append(vm_name)
+    orders = sorted(stages, key=lambda order: (order is None, order or 0), reverse=reverse)
+    return [stages[order] for order in orders]
+
+
+class ActionRunner:
+    """Run an action (start or stop) on VMs of a node group, at most parallel
+       VMs at once. The hosts of the VMs are looked up once in the inventory
+       of the group. The next stage is run once the VMs of the stage reached
+       the state of the action, within stage_timeout seconds. The libvirt
+       event loop must have been started before the group was created."""
+
+    actions = ['start', 'stop']
+    # state of the VMs once the action is done
+    action_state = {'start': 'RUNNING', 'stop': 'SHUTOFF'}
+
+    def __init__(self, group, parallel=4, stage_timeout=None):
+        self.group = group
+        self.parallel = max(1, parallel)
+        self.stage_timeout = stage_timeout
+
+    def _run(self, action, vm_name, host, hard):
+        start = time.monotonic()
+        if action == 'start':
+            success = self.group.vm_start(vm_name, host)
+        else:
+            success = self.group.vm_stop(vm_name, host, hard)
+        return bool(success), time.monotonic() - start
+
+    def run(self, action, stages, host=None, hard=False):
+        """Run the action on the VMs of the stages, a stage is started when
+           the VMs of the previous one reached the state of the action. If
+           they do not, the next stages are not run. Return the result and
+           the elapsed time of the action for each VM."""
+        if action not in self.actions:
+            raise ValueError("Action %s not supported" % action)
+        results = {}
+        hosts = {}
+        vm_names = [vm_name for stage in stages for vm_name in stage]
+        for vm_name in vm_names:
+            hosts[vm_name] = host if host else self.group.get_vm_host(vm_name)
+            if hosts[vm_name] not in self.group.get_clients():
+                logger.error("No host found with VM %s", vm_name)
+                results[vm_name] = (False, 0.0)
+
+        # the events are watched before the actions, not to miss any
+        watcher = StateWatcher(self.group, vm_names) if len(stages) > 1 else None
+        state = self.action_state[action]
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                for index, stage in enumerate(stages):
+                    stage = [vm_name for vm_name in stage if vm_name not in results]
+                    if not stage:
+                        continue
+                    logger.info("Action: %s on %s.", action, ", ".join(stage))
+                    futures = [executor.submit(self._run, action, vm_name, hosts[vm_name], hard)
+                               for vm_name in stage]
+                    for vm_name, future in zip(stage, futures):
+                        try:
+                            results[vm_name] = future.result()
+                        except Exception as err:
+                            logger.error("Failed to %s VM %s: %s", action, vm_name, err)
+                            results[vm_name] = (False, 0.0)
+
+                    later = [vm_name for next_stage in stages[index + 1:]
+                             for vm_name in next_stage if vm_name not in results]
+                    if not later:
+                        break
+                    # a failed VM already in the state, like a VM which was
+                    # not running, does not hold the next stages
+                    failed = [vm_name for vm_name in stage if not results[vm_name][0]]
+                    pending = watcher.pending(state, failed) or \
+                        watcher.wait(state, self.stage_timeout, stage)
+                    for vm_name in pending:
+                        logger.error("VM %s is %s instead of %s", vm_name,
+                                     watcher.get_state(vm_name), state)
+                        results[vm_name] = (False, results[vm_name][1])
+                    if pending:
+                        # the next roles must not run before this one is done
+                        for vm_name in later:
+                            logger.error("Not running %s on VM %s, the previous stage failed",
+                                         action, vm_name)
+                            results[vm_name] = (False, 0.0)
+                        break
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+        # the states of the VMs changed, the inventory must be fetched again
+        self.group.inventory = None
+        return results
+
+
+def print_summary(action, results, elapsed):
+    """Print the result of the action on each VM and the total elapsed time"""
+    for vm_name, (success, duration) in results.items():
+        print("%-16s %-7s %s in %.1fs" % (vm_name, action, "OK" if success else "FAILED", duration))
+    failed = [vm_name for vm_name, (success, _) in results.items() if not success]
+    print("%s: %d VM(s) in %.1fs, %d failed" % (action, len(results), elapsed, len(failed)))
+    return failed
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2016 EDF SA                                                 #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+"""
+Agent of clara virt which keeps the libvirt connections to the hosts of a node
+group open and serves the commands of the CLI on a local Unix socket.
+
+The requests and replies are JSON documents, one per line. A request contains
+the name of a command, its parameters and the path of the virt configuration
+file of the client. The reply contains the status of the command, its output
+and its log records, which the client prints as if the command had run
+locally.
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from clara.virt.exceptions import VirtRuntimeError
+
+logger = logging.getLogger(__name__)
+
+# Time to wait for the agent to accept a request. Once the request is sent,
+# the reply is awaited as long as the agent is alive: migrations are long.
+AGENT_CONNECT_TIMEOUT = 10
+
+
+class AgentUnavailable(VirtRuntimeError):
+
+    """The agent can not serve the request, the command must be run locally"""
+
+    def __init__(self, msg):
+
+        super(AgentUnavailable, self).__init__(msg)
+
+
+class AgentError(VirtRuntimeError):
+
+    """The agent failed after receiving the request, the command may have run"""
+
+    def __init__(self, msg):
+
+        super(AgentError, self).__init__(msg)
+
+
+class _RecordsHandler(logging.Handler):
+    """Logging handler keeping the records of a request, to send them back"""
+
+    def __init__(self):
+        super(_RecordsHandler, self).__init__(logging.INFO)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append([record.levelno, record.name, record.getMessage()])
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        # a request cut by the client is not run
+        if not line.endswith(b"\n"):
+            return
+        try:
+            request = json.loads(line.decode())
+        except ValueError:
+            return
+        reply = self.server.agent.serve(request)
+        self.wfile.write((json.dumps(reply) + "\n").encode())
+
+
+class Agent:
+    """Agent serving the commands on the Unix socket at path.
+
+       commands maps the names of the commands to functions called with the
+       node group and the parameters of the request. new_group() returns a
+       new node group, its connections are kept open until they are lost.
+    """
+    def __init__(self, path, config, commands, new_group):
+        self.path = path
+        self.config = config
+        self.commands = commands
+        self.new_group = new_group
+        self.group = None
+        # the node group is not thread safe, the requests are served one by one
+        self.lock = threading.Lock()
+
+    def _group(self):
+        if self.group is not None and self.group.broken:
+            logger.info("Reconnecting to the hosts of the node group")
+            self.group.close()
+            self.group = None
+        if self.group is None:
+            self.group = self.new_group()
+            self.group.watch_events()
+        return self.group
+
+    def serve(self, request):
+        """Run the command of a request and return the reply"""
+        if request.get('config') != self.config:
+            return {'error': "agent uses configuration file %s" % self.config}
+        command = self.commands.get(request.get('command'))
+        if command is None:
+            return {'error': "unknown command %s" % request.get('command')}
+
+        records = _RecordsHandler()
+        output = io.StringIO()
+        root = logging.getLogger()
+        level = root.level
+        root.setLevel(logging.INFO)
+        root.addHandler(records)
+        status = 0
+        try:
+            with self.lock, contextlib.redirect_stdout(output):
+                try:
+                    command(self._group(), request.get('params', {}))
+                finally:
+                    # some changes are not reported by events (volumes)
+                    if self.group is not None:
+                        self.group.stale = True
+        except SystemExit as err:
+            status = err.code if isinstance(err.code, int) else 1
+        except Exception:
+            logger.exception("Command %s failed", request['command'])
+            status = 1
+        finally:
+            root.removeHandler(records)
+            root.setLevel(level)
+        return {'status': status, 'output': output.getvalue(), 'records': records.records}
+
+    def run(self):
+        """Serve the requests until the agent is interrupted"""
+        from clara.virt.libvirt.libvirtclient import start_event_loop
+
+        # the event loop must be registered before opening the connections
+        start_event_loop()
+        self._group()
+
+        server = self.listen()
+        logger.info("Agent listening on %s", self.path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.path)
+            if self.group is not None:
+                self.group.close()
+
+    def listen(self):
+        """Create the Unix socket of the agent and return its server"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socketserver.UnixStreamServer(self.path, _RequestHandler)
+        server.agent = self
+        # the socket accepts commands on the VMs, only its owner can use it
+        os.chmod(self.path, 0o600)
+        return server
+
+
+def request(path, config, command, params):
+    """Send a command to the agent listening on path and return its reply.
+       Raise AgentUnavailable if there is no agent or if it can not run the
+       command, it can then be run locally. Raise AgentError if the agent
+       failed once the command was sent, the command may have run."""
+    if not os.path.exists(path):
+        raise AgentUnavailable("no agent socket %s" % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(AGENT_CONNECT_TIMEOUT)
+    try:
+        try:
+            sock.connect(path)
+            message = {'command': command, 'params': params, 'config': config}
+            sock.sendall((json.dumps(message) + "\n").encode())
+        except OSError as err:
+            raise AgentUnavailable("agent not reachable on %s: %s" % (path, err))
+        sock.settimeout(None)
+        try:
+            with sock.makefile('rb') as stream:
+                line = stream.readline()
+        except OSError as err:
+            raise AgentError("connection to agent on %s lost: %s" % (path, err))
+    finally:
+        sock.close()
+    if not line:
+        raise AgentError("agent on %s closed the connection without reply" % path)
+    try:
+        reply = json.loads(line.decode())
+    except ValueError:
+        raise AgentError("invalid reply from agent on %s" % path)
+    if 'error' in reply:
+        raise AgentUnavailable(reply['error'])
+    return reply
+
+
+def replay(reply):
+    """Print the output and log the records of a reply, return its status"""
+    for level, name, message in reply['records']:
+        logging.getLogger(name).log(level, message)
+    print(reply['output'], end='')
+    return reply['status']
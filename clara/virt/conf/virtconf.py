@@ -244,6 +244,51 @@ class VirtConf(configparser.ConfigParser):
         return self.get(
             section, 'vol_pattern', fallback='\%(vm_name)s_\%(vol_role)%')
 
+    def get_migration_params(self):
+        """Get the parameters of the live migrations. Section [migration]
+        """
+        section = 'migration'
+        return {
+            'parallel': self.getint(section, 'parallel', fallback=2),
+            'per_host': self.getint(section, 'per_host', fallback=1),
+            'bandwidth': self.getint(section, 'bandwidth', fallback=0),
+            'compressed': self.getboolean(section, 'compressed', fallback=False),
+            'auto_converge': self.getboolean(section, 'auto_converge', fallback=False),
+            'retries': self.getint(section, 'retries', fallback=1),
+        }
+
+    def get_actions_parallel(self):
+        """Get the number of VMs started or stopped at once. Section [actions]
+        """
+        return self.getint('actions', 'parallel', fallback=4)
+
+    def get_stage_timeout(self):
+        """Get the time in seconds to wait for the VMs of a role to be started
+        or stopped before the next role. Section [actions]
+        """
+        return self.getint('actions', 'stage_timeout', fallback=300)
+
+    def get_role_order(self):
+        """Get the order in which the VMs of each role are started, the VMs
+        are stopped in the reverse order. Sections [role:XXX]
+        """
+        role_order = {}
+        for section in self.sections():
+            if section.startswith("role:"):
+                role_order[section[5:]] = self.getint(section, 'order', fallback=0)
+        return role_order
+
+    def get_agent_socket(self):
+        """Get the path of the Unix socket of the virt agent. Section [agent]
+        """
+        return self.get('agent', 'socket', fallback='/run/clara/virt.sock')
+
+    def get_pool_wipe(self, pool_name):
+        """Get the strategy used to wipe the volumes of the pool
+        """
+        section = "pool:%s" % pool_name
+        return self.get(section, 'wipe', fallback='recreate')
+
     def get_network_list(self):
         """Get the list of all network names. Sections [network:XXX]
         """
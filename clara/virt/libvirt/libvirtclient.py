@@ -34,11 +34,33 @@
 ##############################################################################
 
 import logging
+import subprocess
+import threading
 import libvirt
 from libvirt import libvirtError
 
 logger = logging.getLogger(__name__)
 
+_event_loop = None
+
+
+def start_event_loop():
+    """Register the default libvirt event loop and run it in a background
+       thread, once. It must be started before opening the connections whose
+       events are watched."""
+    global _event_loop
+    if _event_loop is not None:
+        return
+
+    libvirt.virEventRegisterDefaultImpl()
+
+    def event_loop():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    _event_loop = threading.Thread(target=event_loop, name="libvirt-events", daemon=True)
+    _event_loop.start()
+
 
 class LibVirtClient:
     state_name = {
@@ -51,12 +73,29 @@ class LibVirtClient:
         libvirt.VIR_DOMAIN_PMSUSPENDED: 'PMSUSPENDED'
     }
 
+    # state of a domain after a lifecycle event, a defined domain is SHUTOFF
+    # unless it was already defined, the other events do not change it
+    event_state = {
+        libvirt.VIR_DOMAIN_EVENT_DEFINED:     'DEFINED',
+        libvirt.VIR_DOMAIN_EVENT_UNDEFINED:   'MISSING',
+        libvirt.VIR_DOMAIN_EVENT_STARTED:     'RUNNING',
+        libvirt.VIR_DOMAIN_EVENT_SUSPENDED:   'PAUSED',
+        libvirt.VIR_DOMAIN_EVENT_RESUMED:     'RUNNING',
+        libvirt.VIR_DOMAIN_EVENT_STOPPED:     'SHUTOFF',
+        libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: 'PMSUSPENDED',
+        libvirt.VIR_DOMAIN_EVENT_CRASHED:     'CRASHED'
+    }
+
     """Libvirt client to a particular host.
     """
     def __init__(self, conf, hostname):
         self.conf = conf
         self.hostname = hostname
         self.conn = None
+        # libvirt keeps a single close callback per connection, registered
+        # once, it calls these
+        self.close_listeners = []
+        self.close_registered = False
 
     def _connect(self):
         if self.conn is None:
@@ -86,6 +125,62 @@ class LibVirtClient:
         else:
             return True
 
+    def register_events(self, on_change, on_close):
+        """Call on_change(hostname) on the lifecycle events of the domains and
+           storage pools of the host, and on_close(hostname) when the
+           connection is lost. The libvirt event loop must have been
+           registered before the connection was opened.
+        """
+        self.register_domain_events(lambda host, vm_name, state: on_change(host), on_close)
+        self.conn.storagePoolEventRegisterAny(
+            None, libvirt.VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE,
+            lambda conn, pool, event, detail, opaque: on_change(self.hostname), None)
+
+    def register_domain_events(self, on_event, on_close):
+        """Call on_event(hostname, vm_name, state) on the lifecycle events of
+           the domains of the host, with the state of event_state or None,
+           and on_close(hostname) when the connection is lost. The libvirt
+           event loop must have been registered before the connection was
+           opened.
+        """
+        self._connect()
+        callback_id = self.conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+            lambda conn, dom, event, detail, opaque: on_event(
+                self.hostname, dom.name(), LibVirtClient.event_state.get(event)), None)
+        if not self.close_registered:
+            self.conn.registerCloseCallback(lambda conn, reason, opaque: self._on_close(), None)
+            # detect the dead connections, instead of waiting for the TCP timeout
+            self.conn.setKeepAlive(5, 3)
+            self.close_registered = True
+        self.close_listeners.append(on_close)
+        return callback_id
+
+    def deregister_domain_events(self, callback_id, on_close):
+        """Stop the calls registered by register_domain_events(), which
+           returned callback_id."""
+        if on_close in self.close_listeners:
+            self.close_listeners.remove(on_close)
+        if self.conn is not None:
+            try:
+                self.conn.domainEventDeregisterAny(callback_id)
+            except libvirtError:
+                pass
+
+    def _on_close(self):
+        for on_close in list(self.close_listeners):
+            on_close(self.hostname)
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except libvirtError:
+                pass
+            self.conn = None
+            self.close_listeners = []
+            self.close_registered = False
+
     def get_pool_list(self):
         self._connect()
         pool_list = []
@@ -97,6 +192,31 @@ class LibVirtClient:
         pool = self._get_storage_pool(pool_name)
         return pool.listVolumes()
 
+    @staticmethod
+    def _vol_details(vol):
+        _, capacity, allocation = vol.info()
+        return {'capacity': capacity, 'allocation': allocation, 'path': vol.path()}
+
+    def get_volumes(self, pool_name):
+        """Return the capacity, allocation and path of all the volumes of a
+           pool, by volume name. The pool is listed with a single call.
+        """
+        pool = self._get_storage_pool(pool_name)
+        volumes = {}
+        for vol in pool.listAllVolumes():
+            volumes[vol.name()] = self._vol_details(vol)
+        return volumes
+
+    def get_volume(self, pool_name, vol_name):
+        """Return the capacity, allocation and path of a volume, None if it
+           does not exist.
+        """
+        try:
+            vol = self._get_storage_vol(pool_name, vol_name)
+        except libvirtError:
+            return None
+        return self._vol_details(vol)
+
     def get_vol_capacity_bytes(self, pool_name, vol_name):
         vol = self._get_storage_vol(pool_name, vol_name)
         info = vol.info()
@@ -111,13 +231,45 @@ class LibVirtClient:
         vol = self._get_storage_vol(pool_name, vol_name)
         return vol.path()
 
-    def vol_wipe(self, pool_name, vol_name):
+    def _wipe_recreate(self, pool_name, vol):
         # vol.wipe() would be nice if it was supported by ceph pools
-        vol = self._get_storage_vol(pool_name, vol_name)
         xml_desc = vol.XMLDesc()
         vol.delete()
         self.vol_create(pool_name, xml_desc)
 
+    def _wipe_zero(self, pool_name, vol):
+        # zeroed by the host, without transferring the data
+        vol.wipePattern(libvirt.VIR_STORAGE_VOL_WIPE_ALG_ZERO)
+
+    def _wipe_discard(self, pool_name, vol):
+        # discard the blocks of the device on the host
+        cmd = ['ssh', self.hostname, 'blkdiscard', vol.path()]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True)
+        if proc.returncode != 0:
+            raise libvirtError("blkdiscard failed: %s" % proc.stdout.strip())
+
+    wipe_strategies = {
+        'recreate': _wipe_recreate,
+        'zero': _wipe_zero,
+        'discard': _wipe_discard,
+    }
+
+    def vol_wipe(self, pool_name, vol_name, strategy='recreate'):
+        """Wipe a volume with a strategy of wipe_strategies, return whether it
+           succeeded.
+        """
+        if strategy not in LibVirtClient.wipe_strategies:
+            logger.error("Unknown wipe strategy '%s' for pool %s", strategy, pool_name)
+            return False
+        try:
+            vol = self._get_storage_vol(pool_name, vol_name)
+            LibVirtClient.wipe_strategies[strategy](self, pool_name, vol)
+        except libvirtError as err:
+            logger.error("Failed to wipe volume %s: %s", vol_name, err)
+            return False
+        return True
+
     def vol_create(self, pool_name, xml_desc):
         pool = self._get_storage_pool(pool_name)
         pool.createXML(xml_desc)
@@ -133,6 +285,29 @@ class LibVirtClient:
             vm_list.append(domain.name())
         return vm_list
 
+    def get_domains(self):
+        """Return the states and info of all the domains of the host, fetched
+           with a single call.
+        """
+        self._connect()
+        stats = libvirt.VIR_DOMAIN_STATS_STATE | \
+                libvirt.VIR_DOMAIN_STATS_BALLOON | \
+                libvirt.VIR_DOMAIN_STATS_VCPU | \
+                libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+        domains = {}
+        for domain, record in self.conn.getAllDomainStats(stats):
+            state = record.get('state.state')
+            domains[domain.name()] = {
+                'state': LibVirtClient.state_name.get(state, 'UNKNOWN'),
+                # same layout as virDomain.info()
+                'info': [state,
+                         record.get('balloon.maximum', 0),
+                         record.get('balloon.current', 0),
+                         record.get('vcpu.current', 0),
+                         record.get('cpu.time', 0)],
+            }
+        return domains
+
     def get_vm_state(self, vm_name):
         domain = self._get_domain(vm_name)
         if domain:
@@ -192,10 +367,28 @@ class LibVirtClient:
         domain.undefine()
         return True
 
-    def vm_migrate(self, vm_name, dest_client):
+    def vm_migrate(self, vm_name, dest_client, bandwidth=0, compressed=False,
+                   auto_converge=False):
         domain = self._get_domain(vm_name)
         dest_conn = dest_client.conn
         flags = libvirt.VIR_MIGRATE_LIVE + \
                 libvirt.VIR_MIGRATE_PERSIST_DEST + \
                 libvirt.VIR_MIGRATE_UNDEFINE_SOURCE
-        return domain.migrate(dest_conn, flags)
+        if compressed:
+            flags += libvirt.VIR_MIGRATE_COMPRESSED
+        if auto_converge:
+            flags += libvirt.VIR_MIGRATE_AUTO_CONVERGE
+        return domain.migrate(dest_conn, flags, None, None, bandwidth)
+
+    def get_migration_progress(self, vm_name):
+        """Return the processed, total and remaining bytes of the migration
+           of a VM, None if it has no running job.
+        """
+        domain = self._get_domain(vm_name)
+        stats = domain.jobStats()
+        if stats.get('type', libvirt.VIR_DOMAIN_JOB_NONE) == libvirt.VIR_DOMAIN_JOB_NONE:
+            return None
+        if 'data_total' in stats:
+            return stats['data_processed'], stats['data_total'], stats['data_remaining']
+        return stats.get('memory_processed', 0), stats.get('memory_total', 0), \
+            stats.get('memory_remaining', 0)
@@ -34,12 +34,17 @@
 ##############################################################################
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from libvirt import libvirtError
 logger = logging.getLogger(__name__)
 
 from clara.virt.libvirt.libvirtclient import LibVirtClient
 from clara.virt.libvirt.vm import VM
 from clara.virt.libvirt.pool import Pool
 
+# Maximum number of hosts contacted at once
+MAX_WORKERS = 32
+
 
 class NodeGroup:
 
@@ -55,28 +60,89 @@ class NodeGroup:
             group_name = self.conf.get_nodegroup_default()
         self.name = group_name
         hosts = self.conf.get_nodegroup_host_list(self.name)
-        for host in hosts:
-            client = LibVirtClient(self.conf, host)
-            if client.test_connection():
-                self.clients[host] = client
+        # the SSH handshakes dominate, connect to all the hosts at once
+        clients = [LibVirtClient(self.conf, host) for host in hosts]
+        for client, connected in zip(clients, self._map(LibVirtClient.test_connection, clients)):
+            if connected:
+                self.clients[client.hostname] = client
         self.pools = {}
+        # states of the domains of all the hosts, by host and domain name
+        self.inventory = None
+        # When the group watches the libvirt events, the states of the VMs and
+        # pools are kept until an event reports a change.
+        self.watched = False
+        self.stale = True
+        self.broken = False
+
+    def watch_events(self):
+        """Keep the states of the VMs and pools between calls, until a libvirt
+           event reports a change on one of the hosts."""
+        for client in self.clients.values():
+            client.register_events(self._on_change, self._on_close)
+        self.watched = True
+
+    def _on_change(self, host):
+        logger.debug("Change reported by host %s", host)
+        self.stale = True
+
+    def _on_close(self, host):
+        logger.warning("Connection to host %s lost", host)
+        self.stale = True
+        self.broken = True
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
 
+    def update(self):
+        """Refresh the states of the VMs, unless the group watches the events
+           and none has been received since the last refresh."""
+        if self.watched:
+            if not self.stale:
+                return
+            # drop the VMs and volumes which may have been removed
+            self.vms = {}
+            self.pools = {}
+        # reset before refreshing, not to miss the events received meanwhile
+        self.stale = False
+        self.refresh()
+
+
+    @staticmethod
+    def _map(function, items):
+        """Call function on every item (clients or hosts) concurrently, return
+           the results in the order of the items."""
+        if len(items) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(items), MAX_WORKERS)) as executor:
+            return list(executor.map(function, items))
+
+    def get_inventory(self):
+        """Return the states of the domains of all the hosts, fetched with a
+           single call per host."""
+        if self.inventory is None:
+            clients = list(self.clients.values())
+            self.inventory = dict(zip(
+                [client.hostname for client in clients],
+                self._map(LibVirtClient.get_domains, clients)))
+        return self.inventory
 
     def get_nodeinfo(self):
         memory = {}
         cpus = {}
-        for client in self.clients.values():
+        clients = list(self.clients.values())
+        for client, nodeinfo in zip(clients, self._map(LibVirtClient.get_nodeinfo, clients)):
             host = client.hostname
-            _, memory[host], cpus[host], _, _, _, _, _ = client.get_nodeinfo()
+            _, memory[host], cpus[host], _, _, _, _, _ = nodeinfo
 
         return memory, cpus
 
     def refresh(self):
+        self.inventory = None
         pool = self.get_pool()
         # Get defined VMs
-        for client in self.clients.values():
-            vm_list = client.get_vm_list()
-            for vm_name in vm_list:
+        for domains in self.get_inventory().values():
+            for vm_name in domains:
                 if vm_name not in self.vms.keys():
                     self.vms[vm_name] = VM(self.conf, vm_name, self, [pool])
         # Get VMs with only a volume in the default pool
@@ -99,6 +165,8 @@ class NodeGroup:
         if host is None:
             host = self.get_vm_host(vm_name)
         if host is not None:
+            # the state of the VM changes, the inventory must be fetched again
+            self.inventory = None
             return self.clients[host].vm_start(vm_name)
         else:
             logger.error("No host found with VM %s", vm_name)
@@ -108,6 +176,7 @@ class NodeGroup:
         if host is None:
             host = self.get_vm_host(vm_name)
         if host is not None:
+            self.inventory = None
             return self.clients[host].vm_stop(vm_name, hard)
         else:
             logger.error("No host found with VM %s", vm_name)
@@ -117,6 +186,7 @@ class NodeGroup:
         if host is None:
             host = self.get_vm_host(vm_name)
         if host is not None:
+            self.inventory = None
             return self.clients[host].vm_undefine(vm_name)
         else:
             logger.error("No host found with VM %s", vm_name)
@@ -143,25 +213,26 @@ class NodeGroup:
 
     def get_vm_host_list(self, vm_name):
         hosts = []
-        for hostname, client in self.clients.items():
-            vm_list = client.get_vm_list()
-            if vm_name in vm_list:
+        for hostname, domains in self.get_inventory().items():
+            if vm_name in domains:
                 hosts.append(hostname)
         return hosts
 
     def get_vm_state(self, vm_name, host):
         if host is None:
             host = self.get_vm_host(vm_name)
-        if host is not None:
-            return self.clients[host].get_vm_state(vm_name)
+        domains = self.get_inventory().get(host, {})
+        if vm_name in domains:
+            return domains[vm_name]['state']
         else:
             return 'MISSING'
 
     def get_vm_info(self, vm_name, host=None):
         if host is None:
             host = self.get_vm_host(vm_name)
-        if host:
-            return self.clients[host].get_vm_info(vm_name)
+        domains = self.get_inventory().get(host, {})
+        if vm_name in domains:
+            return domains[vm_name]['info']
         else:
             return None
 
@@ -176,47 +247,78 @@ class NodeGroup:
         elif len(hosts) == 1:
             return hosts[0]
         else:
-            logger.warn("VM '%s' not found", vm_name)
+            logger.warning("VM '%s' not found", vm_name)
             return None
 
     def vm_define(self, host_name, xml_desc):
+        self.inventory = None
         self.clients[host_name].vm_define(xml_desc)
 
     def get_vms(self):
         """Return a list of VirPilotVM objects from this node group.
         """
-        self.refresh()
+        self.update()
         return self.vms
 
     def get_vm(self, vm_name, create=False):
         """Return a particular VirPilotVM object from this node group.
         """
-        self.refresh()
+        self.update()
         if create and vm_name not in self.vms.keys():
             self.vms[vm_name] = VM(self.conf, vm_name, self, [self.get_pool()])
             self.vms[vm_name].refresh()
 
         return self.vms[vm_name]
 
-    def get_clients(self):
-        return self.clients
+    def wipe_vms(self, vms):
+        """Wipe the volumes of all the VMs concurrently, return the names of
+           the VMs whose volumes could not be wiped."""
+        failed = set()
+        volumes = []
+        for vm in vms:
+            if vm.can_wipe():
+                volumes += [(vm.get_name(), vol) for vol in vm.get_volumes()]
+            else:
+                failed.add(vm.get_name())
+        if volumes:
+            with ThreadPoolExecutor(max_workers=min(len(volumes), MAX_WORKERS)) as executor:
+                results = executor.map(lambda volume: volume[1].wipe(), volumes)
+                for (vm_name, _), success in zip(volumes, results):
+                    if not success:
+                        failed.add(vm_name)
+        return failed
 
-    def get_dest_host(self, vm):
-        try:
-            dest_host = {
-                        host: len(client.get_vm_list())
-                        for host, client in self.clients.items()
-                        for _host, state in vm.get_host_state().items()
-                        if not host == _host and state == 'RUNNING'
-                        }
-            logger.debug("elected destination host: %s" % dest_host)
-            return dest_host
-        except:
-            return None
+    def get_vm_list(self, vm_names, create=False):
+        """Return the VM objects of vm_names, refreshing the group only once.
+        """
+        self.update()
+        vms = []
+        for vm_name in vm_names:
+            if create and vm_name not in self.vms.keys():
+                self.vms[vm_name] = VM(self.conf, vm_name, self, [self.get_pool()])
+                self.vms[vm_name].refresh()
+            vms.append(self.vms[vm_name])
+        return vms
 
-    def elect_dest_host(self, vm):
-        dest_host = self.get_dest_host(vm)
-        if dest_host:
-            return min(dest_host, key = dest_host.get)
-        else:
-            return None
+    def define_vms(self, xml_descs):
+        """Define the VMs concurrently on their hosts, xml_descs maps the host
+           names to lists of (VM name, XML description). The VMs of a host are
+           defined one after the other. Return the list of the failed
+           definitions, as (VM name, error)."""
+        def define(host):
+            errors = []
+            for vm_name, xml_desc in xml_descs[host]:
+                try:
+                    self.clients[host].vm_define(xml_desc)
+                except libvirtError as err:
+                    errors.append((vm_name, err))
+            return errors
+
+        self.inventory = None
+        failed = []
+        for errors in self._map(define, list(xml_descs)):
+            failed += errors
+        return failed
+
+    def get_clients(self):
+        return self.clients
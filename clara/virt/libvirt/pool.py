@@ -34,12 +34,18 @@
 ##############################################################################
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+from libvirt import libvirtError
 
 from clara.virt.exceptions import VirtRuntimeError
 from clara.virt.libvirt.volume import Volume
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of volumes created at once
+MAX_WORKERS = 16
+
 
 class Pool:
     """Virt Storage Pool
@@ -52,6 +58,7 @@ class Pool:
         self.group = group
         self.volumes = {}
         self.vol_pattern = self.conf.get_pool_vol_pattern(self.name)
+        self.wipe_strategy = self.conf.get_pool_wipe(self.name)
         re_pattern = self.vol_pattern.format(
             vm_name='(?P<vm_name>[a-zA-Z0-9_]+)',
             vol_role='(?P<vol_role>[a-zA-Z0-9_]+)'
@@ -70,8 +77,10 @@ class Pool:
         if self.name not in pool_list:
             raise VirtRuntimeError(
                 "Can't find pool %s in pool list (%s)" % (self.name, pool_list))
-        vol_list = self.client.get_vol_list(self.name)
-        for vol_name in vol_list:
+        # all the volumes are described at once, instead of looking them up
+        # by name one by one
+        vol_details = self.client.get_volumes(self.name)
+        for vol_name in vol_details:
             vol_info = self.parse_volume_name(vol_name)
             if vol_info is None:
                 logger.debug("%s does not match rules for pool %s",
@@ -80,8 +89,8 @@ class Pool:
             if vol_name not in self.volumes.keys():
                 self.volumes[vol_name] = Volume(
                     self.conf, vol_name, self.group, self)
-        for volume in self.volumes.values():
-            volume.refresh()
+        for vol_name, volume in self.volumes.items():
+            volume.update(self.client, vol_details.get(vol_name))
 
     def parse_volume_name(self, volume_name):
         match = self.vol_re.match(volume_name)
@@ -117,3 +126,22 @@ class Pool:
 
     def create_volume(self, xml_desc):
         self.client.vol_create(self.name, xml_desc)
+
+    def create_volumes(self, xml_descs, max_workers=MAX_WORKERS):
+        """Create the volumes concurrently, then refresh the pool once. Return
+           the list of the failed creations, as (XML description, error)."""
+        failed = []
+        if xml_descs:
+            def create(xml_desc):
+                try:
+                    self.create_volume(xml_desc)
+                except libvirtError as err:
+                    return err
+                return None
+
+            with ThreadPoolExecutor(max_workers=min(len(xml_descs), max_workers)) as executor:
+                for xml_desc, err in zip(xml_descs, executor.map(create, xml_descs)):
+                    if err is not None:
+                        failed.append((xml_desc, err))
+            self.refresh()
+        return failed
@@ -36,10 +36,23 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import functools
 import os.path
 from jinja2 import Template
 import hashlib
 
+
+@functools.lru_cache(maxsize=64)
+def _compile_template(template_path, mtime):
+    with open(template_path) as template_file:
+        return Template(template_file.read())
+
+
+def load_template(template_path):
+    """Read and compile a Jinja2 template, once per version of the file: the
+       agent picks up the edited templates"""
+    return _compile_template(template_path, os.stat(template_path).st_mtime_ns)
+
 class VM():
 
     """VirPilot Reporter application which generates usage report based on
@@ -115,23 +128,29 @@ class VM():
 
            Only works if the machine is 'SHUTOFF' or 'MISSING'
         """
-        if self.state in ['SHUTOFF', 'MISSING']:
-            for vol in self.get_volumes():
-                vol.wipe()
-            return True
+        if self.can_wipe():
+            return all([vol.wipe() for vol in self.get_volumes()])
         else:
-            logger.warning("Bad state to wipe disks (%s) for VM %s",
-                        self.state, self.name)
             return False
 
+    def can_wipe(self):
+        if self.state in ['SHUTOFF', 'MISSING']:
+            return True
+        logger.warning("Bad state to wipe disks (%s) for VM %s",
+                    self.state, self.name)
+        return False
+
     def migrate(self, dest_host, host=None, dry_run=False):
         """Migrate the virtual machine to dest_host
         """
         self.group.vm_migrate(self.name, dest_host, host, dry_run)
 
-    def create_volumes(self, template_name, template_dir):
+    def get_missing_volumes(self, template_name, template_dir):
+        """Return the XML descriptions of the volumes of the VM which do not
+           exist in the pool."""
         vol_roles = self.conf.get_template_vol_roles(template_name)
         pool = self.group.get_pool()
+        xml_descs = []
         for vol_role, role_params in vol_roles.items():
             try:
                 volume = pool.get_volume(self.name, vol_role)
@@ -151,26 +170,30 @@ class VM():
                 'volume',
                 'default.xml'
             )
-            template_file = open(template_path)
-            template_str = template_file.read()
-            template_file.close()
-
-            template = Template(template_str)
-            xml_desc = template.render(
+            template = load_template(template_path)
+            xml_descs.append(template.render(
                 vol_name=vol_name,
                 vol_capacity_bytes=role_params['capacity']
-            )
+            ))
+        return xml_descs
+
+    def create_volumes(self, template_name, template_dir):
+        pool = self.group.get_pool()
+        xml_descs = self.get_missing_volumes(template_name, template_dir)
+        for xml_desc in xml_descs:
             pool.create_volume(xml_desc)
+        if xml_descs:
             pool.refresh()
         self.refresh()
 
-    def define(self, template_name, template_dir, host):
+    def render(self, template_name, template_dir):
+        """Return the XML description of the VM, None if it already exists.
+           The volumes of the VM must exist in the pool."""
         pool = self.group.get_pool()
-        pool.refresh()
         vol_roles = self.conf.get_template_vol_roles(template_name)
         if self.state != 'MISSING':
             logger.info("VM %s already exists.", self.name)
-            return False
+            return None
         template_params = self.conf.get_template_vm_params(template_name)
         vm_params = self.conf.get_vm_params(self.name)
         params = template_params.copy()
@@ -201,17 +224,20 @@ class VM():
             'vm',
             self.conf.get_template_xml_name(template_name)
         )
-        template_file = open(template_path)
-        template_str = template_file.read()
-        template_file.close()
 
         logger.debug("Generating template with parameters: %s", params)
-        template = Template(template_str)
+        template = load_template(template_path)
         xml_desc = template.render(params)
 
         logger.debug("Rendered XML: %s", xml_desc)
-        self.group.vm_define(host, xml_desc)
+        return xml_desc
 
+    def define(self, template_name, template_dir, host):
+        self.group.get_pool().refresh()
+        xml_desc = self.render(template_name, template_dir)
+        if xml_desc is None:
+            return False
+        self.group.vm_define(host, xml_desc)
 
     def get_info(self):
         return self.group.get_vm_info(self.name)
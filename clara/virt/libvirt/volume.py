@@ -34,6 +34,7 @@
 ##############################################################################
 
 import logging
+import time
 import humanize
 
 from clara.virt.exceptions import VirtRuntimeError
@@ -68,16 +69,18 @@ class Volume:
         if len(clients) == 0:
             raise VirtRuntimeError(
                 "Volume discovery needs at least one client in the node group.")
-        self.client = clients[0]
-        pool_name = self.pool.get_name()
-        vol_list = self.client.get_vol_list(pool_name)
-        if self.name in vol_list:
+        client = clients[0]
+        self.update(client, client.get_volume(self.pool.get_name(), self.name))
+
+    def update(self, client, details):
+        """Update the volume with its details returned by the client, None if
+           the volume does not exist."""
+        self.client = client
+        if details is not None:
             self.state = "PRESENT"
-            self.capacity_bytes = self.client.get_vol_capacity_bytes(
-                pool_name, self.name)
-            self.allocation_bytes = self.client.get_vol_allocation_bytes(
-                pool_name, self.name)
-            self.path = self.client.get_vol_path(pool_name, self.name)
+            self.capacity_bytes = details['capacity']
+            self.allocation_bytes = details['allocation']
+            self.path = details['path']
         else:
             self.state = "MISSING"
             self.capacity_bytes = 0
@@ -85,7 +88,12 @@ class Volume:
             self.path = ""
 
     def wipe(self):
-        result = self.client.vol_wipe(self.pool.get_name(), self.name)
+        start = time.time()
+        result = self.client.vol_wipe(self.pool.get_name(), self.name,
+                                      self.pool.wipe_strategy)
+        if result:
+            logger.info("Volume %s wiped in %.1fs (%s)", self.name,
+                        time.time() - start, self.pool.wipe_strategy)
         self.refresh()
         return result
 
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2016 EDF SA                                                 #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+"""
+Scheduler running several live migrations at once, with a limit on the number
+of migrations in total and towards each destination host.
+"""
+
+import logging
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from libvirt import libvirtError
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two reports of the progress of the running migrations
+PROGRESS_INTERVAL = 10
+# Seconds to wait before retrying a failed migration
+RETRY_DELAY = 5
+
+
+class MigrationScheduler:
+    """Run the migrations of a plan on the hosts of a node group.
+
+       parallel: maximum number of migrations running at once
+       per_host: maximum number of migrations towards the same host
+       bandwidth: bandwidth limit of each migration in MiB/s, 0 for none
+       compressed, auto_converge: libvirt migration flags
+       retries: number of times a failed migration is retried
+    """
+    def __init__(self, group, parallel=2, per_host=1, bandwidth=0,
+                 compressed=False, auto_converge=False, retries=1,
+                 interval=PROGRESS_INTERVAL, retry_delay=RETRY_DELAY):
+        self.group = group
+        self.parallel = max(parallel, 1)
+        self.per_host = max(per_host, 1)
+        self.bandwidth = bandwidth
+        self.compressed = compressed
+        self.auto_converge = auto_converge
+        self.retries = retries
+        self.interval = interval
+        self.retry_delay = retry_delay
+
+    def _migrate(self, vm_name, source, dest_host):
+        client = self.group.get_clients()[source]
+        dest_client = self.group.get_clients()[dest_host]
+        attempts = self.retries + 1
+        for attempt in range(1, attempts + 1):
+            try:
+                client.vm_migrate(vm_name, dest_client, bandwidth=self.bandwidth,
+                                  compressed=self.compressed,
+                                  auto_converge=self.auto_converge)
+                logger.info("VM %s migrated from %s to %s", vm_name, source, dest_host)
+                return True
+            except libvirtError as err:
+                logger.warning("Migration of VM %s to %s failed (attempt %d/%d): %s",
+                               vm_name, dest_host, attempt, attempts, err)
+            if attempt < attempts:
+                time.sleep(self.retry_delay)
+        return False
+
+    def _report(self, migrations):
+        for vm_name, source, dest_host in migrations:
+            try:
+                progress = self.group.get_clients()[source].get_migration_progress(vm_name)
+            except libvirtError:
+                continue
+            if progress is None:
+                continue
+            processed, total, remaining = progress
+            logger.info("VM %s -> %s: %d%% migrated, %d MiB remaining",
+                        vm_name, dest_host, 100 * processed // total if total else 0,
+                        remaining // 1024 // 1024)
+
+    def run(self, plan):
+        """Run the migrations of the plan, a list of (VM, source host,
+           destination host). Return the list of the VMs whose migration
+           failed."""
+        failed = []
+        pending = []
+        for vm_name, source, dest_host in plan:
+            if source not in self.group.get_clients() or dest_host not in self.group.get_clients():
+                logger.error("No active connection to host %s or %s, can't migrate VM %s",
+                             source, dest_host, vm_name)
+                failed.append(vm_name)
+            else:
+                pending.append((vm_name, source, dest_host))
+
+        running = {}
+        per_host = Counter()
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            while pending or running:
+                # start the migrations allowed by the limits, in the order of the plan
+                for migration in list(pending):
+                    if len(running) >= self.parallel:
+                        break
+                    if per_host[migration[2]] >= self.per_host:
+                        continue
+                    pending.remove(migration)
+                    per_host[migration[2]] += 1
+                    logger.info("Migrating VM %s from %s to %s", *migration)
+                    running[executor.submit(self._migrate, *migration)] = migration
+                done, _ = wait(running, timeout=self.interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    migration = running.pop(future)
+                    per_host[migration[2]] -= 1
+                    if not future.result():
+                        failed.append(migration[0])
+                if not done:
+                    self._report(running.values())
+
+        # the VMs moved, the inventory must be fetched again
+        self.group.inventory = None
+        return failed
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2016 EDF SA                                                 #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+"""
+Placement of the VMs on the hosts of a node group, based on the memory and the
+CPUs of the hosts, the allocation of the running VMs and the anti-affinity of
+their roles.
+"""
+
+import logging
+import re
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# vm_name = <prefix (any 2 caracters)><role><arbitrar integer digits>, the VMs
+# with the same role should not run on the same host
+ROLE_PATTERN = re.compile(r"[a-z]{2}([a-z0-9]*[a-z]+)\d+")
+
+# Score added for each VM with the same role on a host, it outweighs the
+# memory and CPU usage ratios which are usually below 1
+ANTI_AFFINITY_PENALTY = 10
+
+
+def vm_role(vm_name):
+    """Return the role of a VM, None if it has none or if it is a service VM"""
+    match = ROLE_PATTERN.search(vm_name)
+    if match and match.group(1) != 'service':
+        return match.group(1)
+    return None
+
+
+class HostLoad:
+    """Capacity of a host and allocation of the VMs running on it, the memory
+       is in MiB."""
+
+    def __init__(self, name, memory, cpus):
+        self.name = name
+        self.memory = memory
+        self.cpus = cpus
+        self.vms = {}
+        self.roles = Counter()
+
+    def used_memory(self):
+        return sum(memory for memory, _ in self.vms.values())
+
+    def used_cpus(self):
+        return sum(cpus for _, cpus in self.vms.values())
+
+    def add(self, vm_name, memory, cpus):
+        self.vms[vm_name] = (memory, cpus)
+        role = vm_role(vm_name)
+        if role:
+            self.roles[role] += 1
+
+    def remove(self, vm_name):
+        del self.vms[vm_name]
+        role = vm_role(vm_name)
+        if role:
+            self.roles[role] -= 1
+
+
+class Placement:
+    """Placement of the running VMs on the hosts, the moves are simulated to
+       compute plans involving several VMs."""
+
+    def __init__(self, hosts):
+        self.hosts = {host.name: host for host in hosts}
+
+    @classmethod
+    def from_group(cls, group):
+        """Build the placement of the running VMs of a node group"""
+        memory, cpus = group.get_nodeinfo()
+        hosts = {name: HostLoad(name, memory[name], cpus[name]) for name in memory}
+        for host_name, domains in group.get_inventory().items():
+            for vm_name, domain in domains.items():
+                if domain['state'] != 'RUNNING' or host_name not in hosts:
+                    continue
+                # maximum memory in KiB and number of vCPUs of virDomain.info()
+                hosts[host_name].add(vm_name, domain['info'][1] // 1024, domain['info'][3])
+        return cls(hosts.values())
+
+    def host_of(self, vm_name):
+        for host in self.hosts.values():
+            if vm_name in host.vms:
+                return host.name
+        return None
+
+    def score(self, host_name, vm_name, memory, cpus):
+        """Score of the host for the VM, lower is better. None if the memory
+           of the host is not sufficient."""
+        host = self.hosts[host_name]
+        used_memory = host.used_memory() + memory
+        if used_memory > host.memory:
+            return None
+        role = vm_role(vm_name)
+        same_role = host.roles[role] if role else 0
+        return ANTI_AFFINITY_PENALTY * same_role \
+            + used_memory / host.memory \
+            + (host.used_cpus() + cpus) / host.cpus
+
+    def elect(self, vm_name, memory=None, cpus=None, exclude=()):
+        """Return the best host for the VM, None if no host can run it. The
+           memory and CPUs of a VM which is not running must be given."""
+        source = self.host_of(vm_name)
+        if source is not None:
+            memory, cpus = self.hosts[source].vms[vm_name]
+        scores = {}
+        for host_name in self.hosts:
+            if host_name == source or host_name in exclude:
+                continue
+            score = self.score(host_name, vm_name, memory, cpus)
+            if score is not None:
+                scores[host_name] = score
+        logger.debug("Scores of the hosts for %s: %s", vm_name, scores)
+        if not scores:
+            return None
+        return min(scores, key=scores.get)
+
+    def place(self, vm_name, dest_host, memory=None, cpus=None):
+        """Simulate the move of a running VM, or the start of a new one, on
+           dest_host"""
+        source = self.host_of(vm_name)
+        if source is not None:
+            memory, cpus = self.hosts[source].vms[vm_name]
+            self.hosts[source].remove(vm_name)
+        self.hosts[dest_host].add(vm_name, memory, cpus)
+
+    def plan(self, vm_names):
+        """Compute the plan moving the running VMs in vm_names to other hosts.
+           Return the list of (VM, destination) pairs, the destination is None
+           if no host can run the VM or if the VM is not running. The biggest
+           VMs are placed first."""
+        sizes = {}
+        for vm_name in vm_names:
+            source = self.host_of(vm_name)
+            sizes[vm_name] = self.hosts[source].vms[vm_name] if source else (0, 0)
+        plan = []
+        for vm_name in sorted(sizes, key=sizes.get, reverse=True):
+            dest_host = None
+            if self.host_of(vm_name) is not None:
+                dest_host = self.elect(vm_name)
+            if dest_host is not None:
+                self.place(vm_name, dest_host)
+            plan.append((vm_name, dest_host))
+        return plan
+
+    def utilisation(self):
+        """Return the list of (host, used memory, memory, used CPUs, CPUs,
+           number of VMs) of the hosts"""
+        return [(host.name, host.used_memory(), host.memory,
+                 host.used_cpus(), host.cpus, len(host.vms))
+                for host in sorted(self.hosts.values(), key=lambda host: host.name)]
+
+
+def print_plan(plan, placement, sources=None):
+    """Print a plan and the projected utilisation of the hosts"""
+    for vm_name, dest_host in plan:
+        source = sources.get(vm_name, '') if sources else ''
+        print("VM:{:16} {:16} -> {:16}".format(
+            vm_name, source, dest_host if dest_host else 'NO HOST AVAILABLE'))
+    print("Projected utilisation:")
+    for host, used_memory, memory, used_cpus, cpus, count in placement.utilisation():
+        print("    Host:{:16} Memory(MiB):{:>8}/{:<8} ({:3.0f}%) Cpus:{:>4}/{:<4} VMs:{}".format(
+            host, used_memory, memory, 100.0 * used_memory / memory if memory else 0,
+            used_cpus, cpus, count))
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2016 EDF SA                                                 #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+"""
+Machine-readable description of the hosts of a node group, their VMs and the
+volumes of the VMs, built in a single pass over the inventory of the group.
+"""
+
+import csv
+import io
+import json
+import humanize
+
+from clara.utils import Colorizer
+from clara.virt.placement import vm_role
+
+CSV_FIELDS = ['host', 'vm', 'state', 'role', 'anti_affinity', 'memory', 'cpus', 'volumes']
+
+
+def build_report(group, details=False, host_name=None):
+    """Return the list of the hosts of the group with their VMs. The VMs which
+       are not defined on exactly one host are reported with a host named
+       None. The memory is in MiB, the host capacity is only given with
+       details. Only the host host_name is reported if it is given."""
+    vms = group.get_vms()
+    memory, cpus = group.get_nodeinfo() if details else ({}, {})
+
+    hosts = {}
+    for name in group.get_clients():
+        hosts[name] = {'name': name, 'memory': memory.get(name), 'cpus': cpus.get(name),
+                       'used_memory': 0, 'used_cpus': 0, 'vms': []}
+    for vm in vms.values():
+        host_states = vm.get_host_state()
+        host = list(host_states)[0] if len(host_states) == 1 else None
+        if host not in hosts:
+            hosts[host] = {'name': host, 'memory': None, 'cpus': None,
+                           'used_memory': 0, 'used_cpus': 0, 'vms': []}
+        entry = {'name': vm.get_name(), 'state': vm.get_state(), 'hosts': host_states,
+                 'role': vm_role(vm.get_name()), 'anti_affinity': False,
+                 'memory': None, 'cpus': None,
+                 'volumes': [{'name': vol.get_name(), 'pool': vol.get_pool().get_name(),
+                              'capacity': vol.capacity_bytes}
+                             for vol in vm.get_volumes()]}
+        if entry['state'] == 'RUNNING':
+            # maximum memory in KiB and number of vCPUs of virDomain.info()
+            info = vm.get_info()
+            entry['memory'] = info[1] // 1024
+            entry['cpus'] = info[3]
+            hosts[host]['used_memory'] += entry['memory']
+            hosts[host]['used_cpus'] += entry['cpus']
+        hosts[host]['vms'].append(entry)
+
+    for host in hosts.values():
+        host['vms'].sort(key=lambda entry: entry['name'])
+        # the running VMs sharing their role with another running VM of the host
+        roles = [entry['role'] for entry in host['vms']
+                 if entry['role'] and entry['state'] == 'RUNNING']
+        for entry in host['vms']:
+            entry['anti_affinity'] = host['name'] is not None and entry['state'] == 'RUNNING' \
+                and entry['role'] is not None and roles.count(entry['role']) > 1
+
+    report = sorted(hosts.values(), key=lambda host: (host['name'] is None, host['name'] or ''))
+    if host_name:
+        report = [host for host in report if host['name'] == host_name]
+    return report
+
+
+def render_json(report, details=False, color=False):
+    return json.dumps({'hosts': report}, indent=2)
+
+
+def render_csv(report, details=False, color=False):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    for host in report:
+        for entry in host['vms']:
+            row = {field: entry.get(field) for field in CSV_FIELDS}
+            row['host'] = host['name'] or ''
+            row['vm'] = entry['name']
+            row['volumes'] = ' '.join(vol['name'] for vol in entry['volumes'])
+            writer.writerow(row)
+    return output.getvalue()
+
+
+def _system_volume(entry):
+    for vol in entry['volumes']:
+        if vol['name'] == entry['name'] + '_system':
+            return [vol['name'], vol['pool'], humanize.naturalsize(vol['capacity'])]
+    return ['', '', '']
+
+
+def _vm_cells(entry, color):
+    name, state = entry['name'], entry['state']
+    if entry['anti_affinity']:
+        name = Colorizer.red(name, color=color)
+    if state == 'MISSING':
+        state = Colorizer.red(state, color=color)
+    elif state == 'SHUTOFF':
+        state = Colorizer.blue(state, color=color)
+    return name, state
+
+
+def _host_cells(host, color):
+    """Return the name, memory usage and CPU usage of a host, in red if the
+       running VMs exceed the capacity of the host"""
+    name = host['name']
+    if host['memory'] is None or host['cpus'] is None:
+        return name, '', ''
+    used_memory, memory = host['used_memory'] // 1024, host['memory'] // 1024
+    memory_usage = "%s/%s" % (used_memory, memory)
+    cpu_usage = "%s/%s" % (host['used_cpus'], host['cpus'])
+    if host['used_cpus'] > host['cpus']:
+        name = Colorizer.red(name, color=color)
+        cpu_usage = Colorizer.red(cpu_usage, color=color)
+    if used_memory > memory:
+        name = Colorizer.red(name, color=color)
+        memory_usage = Colorizer.red(memory_usage, color=color)
+    return name, memory_usage, cpu_usage
+
+
+def render_table(report, details=False, color=False):
+    """Render the report with a row for each host followed by the rows of its
+       VMs, the blocks are separated with horizontal rules."""
+    try:
+        # imported here as it is slow to load
+        from prettytable import PrettyTable as prettytable
+    except ImportError:
+        return render_legacy(report, details, color)
+
+    table = prettytable()
+    table.field_names = ['Host', 'VM', 'State'] + \
+        (['memory', 'cpus', 'Volume', 'Pool', 'Capacity'] if details else [])
+    table.align["VM"] = "l"
+    table.align["Host"] = "r"
+    # indexes of the rows followed by a horizontal rule
+    rules = []
+    for host in report:
+        if host['name'] is not None:
+            name, memory_usage, cpu_usage = _host_cells(host, color)
+            table.add_row([name, '', ''] + ([memory_usage, cpu_usage, '', '', ''] if details else []))
+            rules.append(len(table.rows) - 1)
+        for entry in host['vms']:
+            name, state = _vm_cells(entry, color)
+            row = ['', name, state]
+            if details:
+                if entry['memory'] is None:
+                    row += ['', '']
+                else:
+                    row += [entry['memory'] // 1024, entry['cpus']]
+                row += _system_volume(entry)
+            table.add_row(row)
+        if host['vms']:
+            rules.append(len(table.rows) - 1)
+
+    if not table.rows:
+        return ''
+    lines = table.get_string().split('\n')
+    # top rule, header and header rule come before the first row
+    horizontal = lines[0]
+    output = lines[:3]
+    for number, line in enumerate(lines[3:-1]):
+        output.append(line)
+        if number in rules:
+            output.append(horizontal)
+    if output[-1] != horizontal:
+        output.append(horizontal)
+    return '\n'.join(output)
+
+
+def render_legacy(report, details=False, color=False):
+    if details:
+        vm_line = "VM:{:16} State:{:12} Host:{:16} Total:{:4} Cpus:{:3}"
+    else:
+        vm_line = "VM:{:16} State:{:12} Host:{:16}"
+    host_line = "    Host:{:16} HostState:{:16}"
+    vol_line = "    Volume:{:32} Pool:{:16} Capacity:{:12}"
+
+    lines = []
+    for host in report:
+        for entry in host['vms']:
+            name, state = _vm_cells(entry, color)
+            data = [name, state, host['name'] or '']
+            if details:
+                data += ['', ''] if entry['memory'] is None else [entry['memory'] // 1024, entry['cpus']]
+            lines.append(vm_line.format(*data))
+            if details:
+                lines.append("  Hosts:")
+                for host_state in entry['hosts'].items():
+                    lines.append(host_line.format(*host_state))
+                lines.append("  Volumes:")
+                for vol in entry['volumes']:
+                    lines.append(vol_line.format(vol['name'], vol['pool'],
+                                                 humanize.naturalsize(vol['capacity'])))
+    return '\n'.join(lines)
+
+
+RENDERERS = {
+    'table': render_table,
+    'legacy': render_legacy,
+    'json': render_json,
+    'csv': render_csv,
+}
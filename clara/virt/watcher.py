@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright (C) 2016 EDF SA                                                 #
+#                                                                            #
+#  This file is part of Clara                                                #
+#                                                                            #
+#  This software is governed by the CeCILL-C license under French law and    #
+#  abiding by the rules of distribution of free software. You can use,       #
+#  modify and/ or redistribute the software under the terms of the CeCILL-C  #
+#  license as circulated by CEA, CNRS and INRIA at the following URL         #
+#  "http://www.cecill.info".                                                 #
+#                                                                            #
+#  As a counterpart to the access to the source code and rights to copy,     #
+#  modify and redistribute granted by the license, users are provided only   #
+#  with a limited warranty and the software's author, the holder of the      #
+#  economic rights, and the successive licensors have only limited           #
+#  liability.                                                                #
+#                                                                            #
+#  In this respect, the user's attention is drawn to the risks associated    #
+#  with loading, using, modifying and/or developing or reproducing the       #
+#  software by the user in light of its specific status of free software,    #
+#  that may mean that it is complicated to manipulate, and that also         #
+#  therefore means that it is reserved for developers and experienced        #
+#  professionals having in-depth computer knowledge. Users are therefore     #
+#  encouraged to load and test the software's suitability as regards their   #
+#  requirements in conditions enabling the security of their systems and/or  #
+#  data to be ensured and, more generally, to use and operate it in the      #
+#  same conditions as regards security.                                      #
+#                                                                            #
+#  The fact that you are presently reading this means that you have had      #
+#  knowledge of the CeCILL-C license and that you accept its terms.          #
+#                                                                            #
+##############################################################################
+
+"""
+Tracking of the states of VMs with the lifecycle events of the domains of the
+hosts of a node group, to wait for a state without polling the hosts.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# States which can be waited for, MISSING means undefined on all the hosts
+STATES = ['RUNNING', 'SHUTOFF', 'PAUSED', 'CRASHED', 'PMSUSPENDED', 'MISSING']
+
+
+class StateWatcher:
+    """States of VMs on the hosts of a node group, updated by the lifecycle
+       events of the domains. The libvirt event loop must have been started
+       before the group was created. The events are watched until close()."""
+
+    def __init__(self, group, vm_names):
+        self.group = group
+        self.vm_names = list(vm_names)
+        # states of the VMs by host, updated by the events
+        self.host_states = {vm_name: {} for vm_name in self.vm_names}
+        self.closed = []
+        self.callbacks = {}
+        self.condition = threading.Condition()
+        with self.condition:
+            for host, client in group.get_clients().items():
+                self.callbacks[host] = client.register_domain_events(self._on_event, self._on_close)
+            # the events received meanwhile are applied after the inventory
+            for host, domains in group.get_inventory().items():
+                for vm_name in self.vm_names:
+                    if vm_name in domains:
+                        self.host_states[vm_name][host] = domains[vm_name]['state']
+
+    def _on_event(self, host, vm_name, state):
+        if vm_name not in self.host_states or state is None:
+            return
+        with self.condition:
+            states = self.host_states[vm_name]
+            if state == 'DEFINED':
+                state = states.get(host, 'MISSING')
+                if state == 'MISSING':
+                    state = 'SHUTOFF'
+            logger.debug("VM %s is %s on host %s", vm_name, state, host)
+            states[host] = state
+            self.condition.notify_all()
+
+    def _on_close(self, host):
+        with self.condition:
+            logger.warning("Connection to host %s lost", host)
+            self.closed.append(host)
+            self.condition.notify_all()
+
+    def get_state(self, vm_name):
+        """Return the state of a VM like VM.get_state()"""
+        hosts = [host for host, state in self.host_states[vm_name].items() if state != 'MISSING']
+        if len(hosts) == 0:
+            return 'MISSING'
+        elif len(hosts) == 1:
+            return self.host_states[vm_name][hosts[0]]
+        return 'INCONSISTENT'
+
+    def pending(self, state, vm_names=None):
+        """Return the names of the VMs, or of vm_names, which are not in state"""
+        if vm_names is None:
+            vm_names = self.vm_names
+        return [vm_name for vm_name in vm_names if self.get_state(vm_name) != state]
+
+    def wait(self, state, timeout=None, vm_names=None):
+        """Wait until all the VMs, or vm_names, are in state, or until the
+           timeout in seconds expires or a connection is lost. Return the names
+           of the VMs which are not in state."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while not self.closed:
+                pending = self.pending(state, vm_names)
+                if not pending:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.pending(state, vm_names)
+
+    def close(self):
+        """Stop watching the events"""
+        clients = self.group.get_clients()
+        for host, callback_id in self.callbacks.items():
+            if host in clients:
+                clients[host].deregister_domain_events(callback_id, self._on_close)
+        self.callbacks = {}
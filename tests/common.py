@@ -3,6 +3,8 @@
 from configparser import ConfigParser
 import os
 
+from clara.utils import ClaraConfigParser
+
 repo_dir, _ = os.path.split(os.path.dirname(__file__))
 
 
@@ -13,6 +15,6 @@ class FakeConfig(ConfigParser):
 
 
 def fakeconfig():
-    config = ConfigParser()
+    config = ClaraConfigParser()
     config.read(os.path.join(repo_dir,'example-conf/config.ini'))
     return config
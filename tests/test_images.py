@@ -1,5 +1,6 @@
 from configparser import ConfigParser
-from clara.plugins.clara_images import base_install, mount_chroot, umount_chroot, system_install, genimg
+from clara.plugins.clara_images import base_install, mount_chroot, umount_chroot, system_install, genimg, squashfs_opts, build_chroot, edit, geninitrd
+import concurrent.futures
 import tempfile
 import os
 import pytest
@@ -63,3 +64,127 @@ def test_genimg(mocker):
     # This error should be Fixed, img parameter should be checked before
     with pytest.raises(FileNotFoundError):
         genimg('calibre9.img', '/test', 'calibre9')
+
+
+def test_squashfs_opts(mocker):
+    config = fakeconfig()
+    config.set("images", "squashfs_profile_dev", "-comp zstd -Xcompression-level 1")
+    config.set("images-calibre9", "squashfs_profile", "release")
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_images.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_images.os.cpu_count", return_value=4)
+
+    assert squashfs_opts('calibre8') == ["-no-exports", "-noappend", "-processors", "4"]
+    assert squashfs_opts('calibre9') == ["-no-exports", "-noappend", "-processors", "4",
+                                         "-comp", "xz", "-Xbcj", "x86", "-b", "1M"]
+    assert squashfs_opts('calibre9', 'dev')[4:] == ["-comp", "zstd", "-Xcompression-level", "1"]
+    with pytest.raises(SystemExit):
+        squashfs_opts('calibre9', 'unknown')
+
+
+def test_build_chroot_cache(mocker, tmpdir):
+    script = tmpdir.join("script")
+    script.write("echo 1")
+    config = fakeconfig()
+    config.set("images", "build_cache_dir", str(tmpdir.join("cache")))
+    config.set("images", "script_post_image_creation", str(script))
+    mocker.patch("clara.utils.getconfig", return_value=config)
+
+    def fake_stage(work_dir, dist):
+        open(os.path.join(work_dir, "stage"), "a").write("x")
+
+    m_base = mocker.patch("clara.plugins.clara_images.base_install", side_effect=fake_stage)
+    m_files = mocker.patch("clara.plugins.clara_images.install_files", side_effect=fake_stage)
+    m_system = mocker.patch("clara.plugins.clara_images.system_install", side_effect=fake_stage)
+
+    build_chroot(str(tmpdir.mkdir("build1")), 'calibre9')
+    assert (m_base.call_count, m_files.call_count, m_system.call_count) == (1, 1, 1)
+
+    # only the post-creation script changed, the last snapshot is restored
+    script.write("echo 2")
+    build_chroot(str(tmpdir.mkdir("build2")), 'calibre9')
+    assert (m_base.call_count, m_files.call_count, m_system.call_count) == (1, 1, 1)
+    assert tmpdir.join("build2", "stage").read() == "xxx"
+
+    # the package list changed, the installation of packages is run again
+    config.set("images-calibre9", "extra_packages_image", "vim,emacs")
+    build_chroot(str(tmpdir.mkdir("build3")), 'calibre9')
+    assert (m_base.call_count, m_files.call_count, m_system.call_count) == (1, 1, 2)
+    assert len(tmpdir.join("cache", "calibre9").listdir()) == 3
+
+    build_chroot(str(tmpdir.mkdir("build4")), 'calibre9', use_cache=False)
+    assert (m_base.call_count, m_files.call_count, m_system.call_count) == (2, 2, 3)
+
+
+def test_edit_overlay_delta(mocker, tmpdir):
+    mocker.patch("clara.utils.getconfig", side_effect=fakeconfig)
+    image = tmpdir.join("calibre9.squashfs")
+    image.write("")
+    work_dir = tmpdir.mkdir("work")
+    m_run = mocker.patch("clara.plugins.clara_images.run")
+    m_mksquashfs = mocker.patch("clara.plugins.clara_images.mksquashfs")
+    mocker.patch("clara.plugins.clara_images.os.chmod")
+    mocker.patch("clara.plugins.clara_images.os.path.ismount", return_value=True)
+    mocker.patch("clara.plugins.clara_images.input", create=True, return_value="y")
+
+    def fake_shell(argv):
+        work_dir.join("upper", "modified").write("")
+    mocker.patch("clara.plugins.clara_images.pty.spawn", side_effect=fake_shell)
+
+    edit(str(image), str(work_dir), 'calibre9', delta=True)
+    m_run.assert_any_call(["mount", "-t", "squashfs", "-o", "loop,ro", str(image),
+                           str(work_dir.join("lower"))])
+    m_run.assert_any_call(["umount", str(work_dir.join("merged"))])
+    m_mksquashfs.assert_called_once_with(str(work_dir.join("upper")),
+                                         str(image) + ".delta", 'calibre9')
+
+
+def test_geninitrd_kernels(mocker, tmpdir):
+    config = fakeconfig()
+    image = tmpdir.join("calibre9.squashfs")
+    image.write("")
+    config.set("images-calibre9", "trg_img", str(image))
+    config.set("images-calibre9", "trg_dir", str(tmpdir.mkdir("boot")))
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_images.get_osRelease", return_value=("debian", "8"))
+    mocker.patch("clara.plugins.clara_images.mount_chroot")
+    mocker.patch("clara.plugins.clara_images.umount_chroot")
+    m_crun = mocker.patch("clara.plugins.clara_images.run_chroot")
+    mocker.patch("clara.plugins.clara_images.docopt.docopt", return_value={'--no-sync': True})
+    mocker.patch("clara.plugins.clara_images.concurrent.futures.ProcessPoolExecutor",
+                 concurrent.futures.ThreadPoolExecutor)
+
+    def fake_run(cmd, exit_on_error=True):
+        if cmd[0] == "unsquashfs":
+            os.makedirs(os.path.join(cmd[-2], "tmp"))
+            os.makedirs(os.path.join(cmd[-2], "boot"))
+        elif cmd[2] == "mkinitramfs":
+            open(os.path.join(cmd[1], "tmp", "initrd-" + cmd[-1]), "w").close()
+            open(os.path.join(cmd[1], "boot", "vmlinuz-" + cmd[-1]), "w").close()
+    m_run = mocker.patch("clara.plugins.clara_images.run", side_effect=fake_run)
+
+    work_dir = str(tmpdir.mkdir("work"))
+    geninitrd(None, work_dir, ['calibre9'], "4.9.0-1-amd64,4.19.0-1-amd64")
+    # the image is unpacked once and the kernels installed together
+    assert [c[0][0][0] for c in m_run.call_args_list].count("unsquashfs") == 1
+    m_crun.assert_any_call(["chroot", os.path.join(work_dir, "calibre9"), "apt-get", "install",
+                            "--no-install-recommends", "--yes", "--force-yes",
+                            "linux-image-4.9.0-1-amd64", "linux-image-4.19.0-1-amd64"],
+                           os.path.join(work_dir, "calibre9"))
+    assert sorted(tmpdir.join("boot").listdir()) == sorted(
+        tmpdir.join("boot", f) for f in ["initrd-4.9.0-1-amd64", "vmlinuz-4.9.0-1-amd64",
+                                         "initrd-4.19.0-1-amd64", "vmlinuz-4.19.0-1-amd64"])
+
+
+def test_clean_and_exit_dists(mocker, tmpdir):
+    from clara.plugins import clara_images
+    work_dir = tmpdir.mkdir("work")
+    work_dir.mkdir("calibre8")
+    m_umount = mocker.patch("clara.plugins.clara_images.umount_chroot")
+    mocker.patch("clara.plugins.clara_images.umount_overlay")
+    clara_images._opts['keep_chroot_dir'] = False
+
+    # the chroot of calibre9 was not prepared yet
+    clara_images.clean_and_exit(str(work_dir), ['calibre8', 'calibre9'])
+    assert [c[0][0] for c in m_umount.call_args_list] == [str(work_dir.join("calibre8")), str(work_dir)]
+    assert not work_dir.check()
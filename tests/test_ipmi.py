@@ -1,8 +1,8 @@
 from configparser import ConfigParser
 from clara.plugins.clara_ipmi import (do_connect, getmac, do_ping, do_ssh)
 import clara.plugins.clara_ipmi as clara_ipmi
-from subprocess import Popen, PIPE
 from tests.common import fakeconfig
+import asyncio
 import os
 
 
@@ -25,16 +25,6 @@ def fake_task():
     return FakeTask()
 
 
-def fake_popen(cmd = None, stdout=None, stderr=None, universal_newlines=None):
-    if "-e!" in cmd:
-        return Popen('echo \"Chassis Power is on\"',
-                     stdout=PIPE, shell=True, universal_newlines=True)
-
-    fake_ipmi_cmd = 'python3 {}/data/bin/impi'.format(os.path.dirname(__file__))
-
-    return Popen(fake_ipmi_cmd, stdout=PIPE, shell=True, universal_newlines=True)
-
-
 def test_do_coonect(mocker):
     mocker.patch("clara.utils.getconfig", side_effect=fakeconfig)
     mocker.patch("clara.plugins.clara_ipmi.do_connect_ipmi")
@@ -66,10 +56,22 @@ def test_do_coonect(mocker):
     m_logging.assert_called_with('The host is an IP adddres: 192.168.1.2. Using ipmitool without conman.')
 
 
+def fake_fru_exec(unreachable_hosts, warning=""):
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def fake(*cmd, **kwargs):
+        if cmd[cmd.index("-H") + 1] in unreachable_hosts:
+            return await create_subprocess_exec("sh", "-c", "echo Unable to establish IPMI v2 session >&2; exit 1",
+                                                **kwargs)
+        return await create_subprocess_exec("sh", "-c", "echo '{0}' >&2; exec python3 {1}/data/bin/impi".format(
+                                                warning, os.path.dirname(__file__)), **kwargs)
+    return fake
+
+
 def test_getmac(mocker):
     mocker.patch("clara.utils.getconfig", side_effect=fakeconfig)
     mocker.patch("clara.plugins.clara_ipmi.value_from_file", side_effect=lambda f, k: 'password')
-    mocker.patch("clara.plugins.clara_ipmi.subprocess.Popen", side_effect=fake_popen)
+    mocker.patch("clara.plugins.clara_ipmi.asyncio.create_subprocess_exec", side_effect=fake_fru_exec([]))
     m_logging = mocker.patch("clara.plugins.clara_ipmi.logging.info")
 
     getmac('host1')
@@ -77,10 +79,57 @@ def test_getmac(mocker):
     m_logging.assert_called_with("  eth0's MAC address is 12:34:56:78:90:12\n  eth1's MAC address is 34:56:78:9A:B:")
 
 
+def test_getmac_stderr_warning(mocker, capsys):
+    mocker.patch("clara.utils.getconfig", side_effect=fakeconfig)
+    mocker.patch("clara.plugins.clara_ipmi.value_from_file", side_effect=lambda f, k: 'password')
+    mocker.patch("clara.plugins.clara_ipmi.asyncio.create_subprocess_exec",
+                 side_effect=fake_fru_exec([], "Get HPM.x Capabilities request failed"))
+
+    # the warnings of ipmitool do not shift the lines of fru print
+    rows = getmac('host1', "csv")
+    assert rows[0]["eth0"] == "12:34:56:78:90:12"
+
+
+def test_getmac_csv(mocker, capsys):
+    mocker.patch("clara.utils.getconfig", side_effect=fakeconfig)
+    mocker.patch("clara.plugins.clara_ipmi.value_from_file", side_effect=lambda f, k: 'password')
+    mocker.patch("clara.plugins.clara_ipmi.asyncio.create_subprocess_exec",
+                 side_effect=fake_fru_exec(["immhost2"]))
+
+    rows = getmac('host[1-3]', "csv")
+
+    # the unreachable host does not stop the others
+    assert [row["status"] == "ok" for row in rows] == [True, False, True]
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "node,bmc,eth0,eth1,status"
+    assert lines[1] == "host1,immhost1,12:34:56:78:90:12,34:56:78:9A:B:,ok"
+    assert lines[2] == "host2,immhost2,,,Host immhost2 can't be reached: Unable to establish IPMI v2 session"
+
+
+def test_parse_macs_unexpected_output():
+    parse_macs = clara_ipmi.parse_macs
+    lines = ["line {0}: value".format(n) for n in range(14)]
+    assert parse_macs("\n".join(lines + ["FRU device not present"])) is None
+    assert parse_macs("\n".join(lines + ["Error: FRU device not present"])) is None
+    assert parse_macs("\n".join(lines + [" Product Serial        :"])) is None
+    assert parse_macs("\n".join(lines + [" Product Serial        : 1234567890AB34567890CDEF"])) == \
+        ("12:34:56:78:90:AB", "34:56:78:90:CD:EF")
+
+
+def fake_exec(hung_hosts):
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def fake(*cmd, **kwargs):
+        if cmd[cmd.index("-H") + 1] in hung_hosts:
+            return await create_subprocess_exec("sleep", "10", **kwargs)
+        return await create_subprocess_exec("echo", "Chassis Power is on", **kwargs)
+    return fake
+
+
 def test_ipmido_status(mocker, capsys):
     mocker.patch("clara.utils.getconfig", side_effect=fakeconfig)
     mocker.patch("clara.plugins.clara_ipmi.value_from_file", side_effect=lambda f, k: 'password')
-    mocker.patch("clara.plugins.clara_ipmi.subprocess.Popen", side_effect=fake_popen)
+    mocker.patch("clara.plugins.clara_ipmi.asyncio.create_subprocess_exec", side_effect=fake_exec([]))
 
     clara_ipmi._opts['parallel'] = 2
     clara_ipmi.ipmi_do('host[1-2]', "power", "status")
@@ -88,6 +137,27 @@ def test_ipmido_status(mocker, capsys):
     captured = capsys.readouterr()
     assert "immhost1 OK" in captured.out
     assert "immhost2 OK" in captured.out
+    assert "immhost[1-2]: OK: Chassis Power is on" in captured.out
+
+
+def test_ipmido_timeout(mocker, capsys):
+    config = fakeconfig()
+    config.set("ipmi", "timeout", "1")
+    config.set("ipmi", "retries", "1")
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_ipmi.value_from_file", side_effect=lambda f, k: 'password')
+    m_exec = mocker.patch("clara.plugins.clara_ipmi.asyncio.create_subprocess_exec",
+                          side_effect=fake_exec(["immhost2"]))
+
+    clara_ipmi._opts['parallel'] = 3
+    results = clara_ipmi.ipmi_do('host[1-3]', "power", "status")
+
+    assert results["immhost2"] == "ERROR: no answer after 1s"
+    # the hung host is retried once, the others are not held back
+    assert m_exec.call_count == 4
+    captured = capsys.readouterr()
+    assert "immhost2: ERROR: no answer after 1s" in captured.out
+    assert "immhost[1,3]: OK: Chassis Power is on" in captured.out
 
 
 def test_doping(mocker):
@@ -101,6 +171,111 @@ def test_doping(mocker):
 def test_dossh(mocker):
     mocker.patch("clara.utils.getconfig", side_effect=fakeconfig)
     mocker.patch("clara.plugins.clara_ipmi.value_from_file", side_effect=lambda f, k: 'password')
-    mocker.patch("clara.plugins.clara_ipmi.ClusterShell.Task.task_self",side_effect=fake_task)
+    mocker.patch("ClusterShell.Task.task_self",side_effect=fake_task)
+
+    do_ssh('host[1-2]', 'date')
+
+def test_ipmido_native(mocker, capsys):
+    config = fakeconfig()
+    config.set("ipmi", "backend", "native")
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_ipmi.value_from_file", side_effect=lambda f, k: 'password')
+    m_exec = mocker.patch("clara.plugins.clara_ipmi.asyncio.create_subprocess_exec",
+                          side_effect=fake_exec([]))
 
-    do_ssh('host[1-2]', 'date')
\ No newline at end of file
+    async def fake_execute(host, username, password, args):
+        return "Chassis Power is on"
+    m_execute = mocker.patch("clara.lanplus.execute", side_effect=fake_execute)
+
+    clara_ipmi.ipmi_do('host[1-2]', "power", "status")
+    assert m_execute.call_count == 2
+    assert m_exec.call_count == 0
+    # commands not supported natively are run with ipmitool
+    clara_ipmi.ipmi_do('host[1-2]', "sel", "list")
+    assert m_exec.call_count == 2
+    assert "immhost[1-2]: OK: Chassis Power is on" in capsys.readouterr().out
+
+
+def fake_sel_exec(sel):
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def fake(*cmd, **kwargs):
+        if cmd[-2:] == ("sel", "info"):
+            output = "SEL Information\nVersion          : 1.5 (v1.5, v2 compliant)\nEntries          : {0}".format(len(sel))
+        else:
+            assert cmd[-4:-1] == ("sel", "list", "last")
+            output = "\n".join(sel[-int(cmd[-1]):])
+        return await create_subprocess_exec("echo", output, **kwargs)
+    return fake
+
+
+def test_selsync(mocker, tmpdir):
+    config = fakeconfig()
+    config.set("ipmi", "sel_store", str(tmpdir.join("sel.db")))
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_ipmi.value_from_file", side_effect=lambda f, k: 'password')
+    sel = ["   1 | 03/14/2023 | 08:12:33 | Power Supply #0x51 | Power Supply AC lost | Asserted",
+           "   2 | 03/14/2023 | 08:15:02 | Fan #0x30 | Lower Critical going low  | Asserted"]
+    m_exec = mocker.patch("clara.plugins.clara_ipmi.asyncio.create_subprocess_exec",
+                          side_effect=fake_sel_exec(sel))
+
+    clara_ipmi.selsync('host[1-2]')
+    sel.append("   3 | 03/15/2023 | 10:00:00 | Fan #0x30 | Lower Critical going low  | Deasserted")
+    clara_ipmi.selsync('host[1-2]')
+    # only the new entry and the last one seen are listed by the second synchronization
+    assert m_exec.call_args_list[-1][0][-4:] == ("sel", "list", "last", "2")
+
+    rows = clara_ipmi.selstore.query(str(tmpdir.join("sel.db")), 'host1', sensor_type="Fan")
+    assert [(row[0], row[2], row[3], row[6]) for row in rows] == [
+        ("host1", 2, "2023-03-14 08:15:02", "Asserted"), ("host1", 3, "2023-03-15 10:00:00", "Deasserted")]
+    rows = clara_ipmi.selstore.query(str(tmpdir.join("sel.db")), since="2023-03-15")
+    assert len(rows) == 2
+
+
+def test_selstore_old_schema(tmpdir):
+    import sqlite3
+    path = str(tmpdir.join("sel.db"))
+    db = sqlite3.connect(path)
+    db.executescript("CREATE TABLE entries (node TEXT NOT NULL, source TEXT NOT NULL, "
+                     "id INTEGER NOT NULL, created TEXT, sensor_type TEXT, message TEXT, "
+                     "code TEXT, PRIMARY KEY (node, source, id)); "
+                     "CREATE INDEX entries_created ON entries (created); "
+                     "INSERT INTO entries VALUES ('host1', 'ipmi', 1, '2023-03-14 08:00:00', "
+                     "'Fan', 'going low', 'Asserted');")
+    db.close()
+
+    # the entries are kept and the ids can be reused
+    with clara_ipmi.selstore.SelStore(path) as store:
+        entry = {'id': 1, 'created': '2023-03-15 08:00:00', 'sensor_type': 'Fan',
+                 'message': 'going low', 'code': 'Deasserted'}
+        assert store.add('host1', 'ipmi', [entry, entry], '2023-03-15 09:00:00') == 1
+        assert store.count('host1', 'ipmi') == 2
+
+
+def test_selsync_full_and_cleared(mocker, tmpdir):
+    config = fakeconfig()
+    config.set("ipmi", "sel_store", str(tmpdir.join("sel.db")))
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_ipmi.value_from_file", side_effect=lambda f, k: 'password')
+    line = "{0:4x} | 03/14/2023 | 08:{1:02d}:00 | Fan #0x30 | Lower Critical going low  | Asserted"
+    sel = [line.format(i, i) for i in range(1, 5)]
+    mocker.patch("clara.plugins.clara_ipmi.asyncio.create_subprocess_exec", side_effect=fake_sel_exec(sel))
+    path = str(tmpdir.join("sel.db"))
+
+    clara_ipmi.selsync('host1')
+    # the SEL is full and overwrites its oldest entries
+    sel[:] = sel[3:] + [line.format(i, i) for i in range(5, 8)]
+    clara_ipmi.selsync('host1')
+    assert [row[2] for row in clara_ipmi.selstore.query(path, 'host1')] == list(range(1, 8))
+
+    # the ids wrap around, the new entries reuse ids already stored
+    sel[:] = sel[-2:] + [line.format(i, 20 + i) for i in range(1, 3)]
+    clara_ipmi.selsync('host1')
+    assert [row[2] for row in clara_ipmi.selstore.query(path, 'host1')] == list(range(1, 8)) + [1, 2]
+
+    # the SEL is cleared and refilled past the number of stored entries
+    sel[:] = [line.format(i, 30 + i) for i in range(1, 10)]
+    clara_ipmi.selsync('host1')
+    rows = clara_ipmi.selstore.query(path, 'host1')
+    assert [row[2] for row in rows] == list(range(1, 10))
+    assert rows[0][3] == "2023-03-14 08:31:00"
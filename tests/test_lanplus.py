@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import struct
+
+import pytest
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from clara import lanplus
+
+
+def sha1(key, data):
+    return hmac.new(key, data, hashlib.sha1).digest()
+
+
+class FakeBMC(asyncio.DatagramProtocol):
+    """BMC answering the RMCP+ handshake of cipher suite 3 and a few commands"""
+
+    def __init__(self, username, password, power=0x01, drop=()):
+        self.username = username.encode()
+        self.password = password.encode()
+        self.power = power
+        # commands whose first answer is lost
+        self.drop = set(drop)
+        self.managed_sid = 0x1234
+        self.requests = []
+        self.sequences = []
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, payload_type, payload, addr, session_id=0):
+        header = struct.pack("<BBIIH", 0x06, payload_type, session_id, 0, len(payload))
+        self.transport.sendto(bytes([0x06, 0x00, 0xff, 0x07]) + header + payload, addr)
+
+    def datagram_received(self, data, addr):
+        payload_type = data[5]
+        length = struct.unpack("<H", data[14:16])[0]
+        payload = data[16:16 + length]
+        if payload_type == 0x10:
+            self.console_sid = struct.unpack("<I", payload[4:8])[0]
+            self.send(0x11, bytes([0, 0, 4, 0]) + struct.pack("<II", self.console_sid, self.managed_sid)
+                      + payload[8:], addr)
+        elif payload_type == 0x12:
+            self.rm, role = payload[8:24], payload[24]
+            self.user = bytes([role, payload[27]]) + payload[28:]
+            self.rc, self.guid = os.urandom(16), os.urandom(16)
+            if payload[28:] != self.username:
+                self.send(0x13, bytes([0, 0x0d, 0, 0]) + struct.pack("<I", self.console_sid), addr)
+                return
+            sids = struct.pack("<II", self.console_sid, self.managed_sid)
+            auth = sha1(self.password, sids + self.rm + self.rc + self.guid + self.user)
+            self.send(0x13, bytes([0, 0, 0, 0]) + struct.pack("<I", self.console_sid)
+                      + self.rc + self.guid + auth, addr)
+        elif payload_type == 0x14:
+            expected = sha1(self.password, self.rc + struct.pack("<I", self.console_sid) + self.user)
+            assert payload[8:28] == expected
+            self.sik = sha1(self.password, self.rm + self.rc + self.user)
+            self.k1, self.k2 = sha1(self.sik, b"\x01" * 20), sha1(self.sik, b"\x02" * 20)
+            icv = sha1(self.sik, self.rm + struct.pack("<I", self.managed_sid) + self.guid)[:12]
+            self.send(0x15, bytes([0, 0, 0, 0]) + struct.pack("<I", self.console_sid) + icv, addr)
+        elif payload_type == 0xc0:
+            assert sha1(self.k1, data[4:-12])[:12] == data[-12:]
+            decryptor = Cipher(algorithms.AES(self.k2[:16]), modes.CBC(payload[:16])).decryptor()
+            message = decryptor.update(payload[16:]) + decryptor.finalize()
+            message = message[:-(message[-1] + 1)]
+            netfn, rq_seq, cmd, request = message[1] >> 2, message[4], message[5], message[6:-1]
+            self.requests.append((netfn, cmd, request))
+            self.sequences.append((cmd, rq_seq))
+            if cmd in self.drop:
+                self.drop.remove(cmd)
+                return
+            response = {0x01: bytes([self.power, 0, 0, 0]), 0x3b: bytes([4]), 0x42: b"\x01\x00",
+                        0x47: b"\x01"}.get(cmd, b"")
+            if cmd == 0x3c:
+                self.closed = True
+            header = bytes([0x81, (netfn + 1) << 2])
+            body = bytes([0x20, rq_seq, cmd, 0]) + response
+            message = header + bytes([lanplus.checksum(header)]) + body + bytes([lanplus.checksum(body)])
+            pad = 15 - len(message) % 16
+            iv = os.urandom(16)
+            encryptor = Cipher(algorithms.AES(self.k2[:16]), modes.CBC(iv)).encryptor()
+            payload = iv + encryptor.update(message + bytes(range(1, pad + 1)) + bytes([pad])) \
+                + encryptor.finalize()
+            header = struct.pack("<BBIIH", 0x06, 0xc0, self.console_sid, 1, len(payload))
+            packet = bytes([0x06, 0x00, 0xff, 0x07]) + header + payload
+            integrity_pad = (4 - (len(packet) - 4 + 2) % 4) % 4
+            packet += b"\xff" * integrity_pad + bytes([integrity_pad, 0x07])
+            self.transport.sendto(packet + sha1(self.k1, packet[4:])[:12], addr)
+
+
+async def run_bmc(bmc, args, username="admin", password="secret"):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: bmc, local_addr=("127.0.0.1", 0))
+    port = transport.get_extra_info("sockname")[1]
+    try:
+        return await lanplus.execute("127.0.0.1", username, password, args, port)
+    finally:
+        transport.close()
+
+
+def test_power_status():
+    bmc = FakeBMC("admin", "secret")
+    assert asyncio.run(run_bmc(bmc, ["power", "status"])) == "Chassis Power is on"
+    # session privilege raised to administrator, then closed
+    assert bmc.requests[0] == (0x06, 0x3b, bytes([4]))
+    assert bmc.closed
+
+
+def test_power_on():
+    bmc = FakeBMC("admin", "secret", power=0)
+    assert asyncio.run(run_bmc(bmc, ["power", "on"])) == "Chassis Power Control: Up/On"
+    assert (0x00, 0x02, bytes([1])) in bmc.requests
+
+
+def test_power_reset_retransmit():
+    bmc = FakeBMC("admin", "secret", drop=[0x02])
+    assert asyncio.run(run_bmc(bmc, ["power", "reset"])) == "Chassis Power Control: Reset"
+    # the retransmit is the same request, the BMC can tell it was already run
+    sequences = [rq_seq for cmd, rq_seq in bmc.sequences if cmd == 0x02]
+    assert len(sequences) == 2 and sequences[0] == sequences[1]
+
+
+def test_wrong_password():
+    bmc = FakeBMC("admin", "secret")
+    with pytest.raises(lanplus.LanplusError, match="wrong password"):
+        asyncio.run(run_bmc(bmc, ["power", "status"], password="wrong"))
+
+
+def test_unsupported_command():
+    assert not lanplus.supported(["sel", "list"])
+    with pytest.raises(lanplus.LanplusUnsupported):
+        asyncio.run(lanplus.execute("127.0.0.1", "admin", "secret", ["sel", "list"]))
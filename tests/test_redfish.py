@@ -0,0 +1,208 @@
+import requests
+
+import clara.plugins.clara_redfish as clara_redfish
+from clara import redfish
+from tests.common import fakeconfig
+
+
+class FakeResponse:
+
+    def __init__(self, data, status=200):
+        self.data = data
+        self.status_code = status
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError("{0} Server Error".format(self.status_code))
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """Session answering the Redfish requests of hosts whose names contain
+       'down' with a connection error"""
+    sessions = []
+
+    def __init__(self):
+        self.requests = []
+        self.auth = None
+        self.verify = True
+        FakeSession.sessions.append(self)
+
+    def request(self, method, url, json=None, timeout=None):
+        self.requests.append((method, url, json))
+        if "down" in url:
+            raise requests.exceptions.ConnectionError("Connection refused")
+        path = url.split("/", 3)[3]
+        if path == "redfish/v1":
+            return FakeResponse({"Vendor": "Vendor"})
+        if path == "redfish/v1/Systems":
+            return FakeResponse({"Members": [{"@odata.id": "/redfish/v1/Systems/1"}]})
+        if path == "redfish/v1/Managers":
+            return FakeResponse({"Members": [{"@odata.id": "/redfish/v1/Managers/1"}]})
+        if path == "redfish/v1/Systems/1/EthernetInterfaces":
+            return FakeResponse({"Members": [{"@odata.id": "/redfish/v1/Systems/1/EthernetInterfaces/1"}]})
+        if path == "redfish/v1/Systems/1/EthernetInterfaces/1":
+            return FakeResponse({"MACAddress": "12-34-56-78-90-12"})
+        if path.startswith("redfish/v1/Systems/old"):
+            return FakeResponse({}, 404)
+        return FakeResponse({"PowerState": "On"})
+
+    def close(self):
+        pass
+
+
+def test_pool_reuses_sessions(mocker):
+    FakeSession.sessions = []
+    mocker.patch("clara.redfish.requests.Session", side_effect=FakeSession)
+    with redfish.RedfishPool(None, parallel=4) as pool:
+        results = pool.run(["bmc1", "bmc2", "bmc-down"],
+                           lambda client, host: [client.get("/a"), client.get("/b")])
+
+    # one keep-alive session per BMC, the failing BMC does not stop the others
+    assert len(FakeSession.sessions) == 3
+    assert results["bmc1"] == [{"PowerState": "On"}, {"PowerState": "On"}]
+    assert isinstance(results["bmc-down"], redfish.RedfishError)
+
+
+def test_pool_malformed_answer(mocker):
+    mocker.patch("clara.redfish.requests.Session", side_effect=FakeSession)
+    with redfish.RedfishPool(None, parallel=2) as pool:
+        results = pool.run(["bmc1", "bmc2"],
+                           lambda client, host: client.get("/a")["Members" if host == "bmc2" else "PowerState"])
+
+    # the KeyError of bmc2 does not lose the result of bmc1
+    assert results["bmc1"] == "On"
+    assert isinstance(results["bmc2"], redfish.RedfishError)
+    assert "KeyError" in str(results["bmc2"])
+
+
+def test_redfish_do_status(mocker, tmpdir):
+    FakeSession.sessions = []
+    config = fakeconfig()
+    config.set("redfish", "cache_file", str(tmpdir.join("redfish.json")))
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_redfish.get_authentication", return_value=("user", "password"))
+    mocker.patch("clara.redfish.requests.Session", side_effect=FakeSession)
+    m_info = mocker.patch("clara.plugins.clara_redfish.logging.info")
+    m_warning = mocker.patch("clara.plugins.clara_redfish.logging.warning")
+
+    clara_redfish._opts['parallel'] = 2
+    results = clara_redfish.redfish_do('host1,down2', "power", "status")
+
+    m_info.assert_called_with("immhost1 OK: Chassis Power is On")
+    assert isinstance(results["immdown2"], redfish.RedfishError)
+    m_warning.assert_called_with("redfish: failed on 1/2 hosts: immdown2")
+
+
+def test_topology_cache(mocker, tmpdir):
+    FakeSession.sessions = []
+    config = fakeconfig()
+    config.set("redfish", "cache_file", str(tmpdir.join("redfish.json")))
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_redfish.get_authentication", return_value=("user", "password"))
+    mocker.patch("clara.redfish.requests.Session", side_effect=FakeSession)
+    m_info = mocker.patch("clara.plugins.clara_redfish.logging.info")
+
+    clara_redfish.getmac('host1')
+    m_info.assert_called_with("eth0's MAC address is 12:34:56:78:90:12 ")
+    assert len(FakeSession.sessions[0].requests) == 5
+
+    # the discovery is skipped by the following commands
+    clara_redfish.redfish_do('host1', "power", "status")
+    assert [r[1] for r in FakeSession.sessions[1].requests] == ["https://immhost1/redfish/v1/Systems/1"]
+
+    clara_redfish.invalidate('host1')
+    clara_redfish.redfish_do('host1', "power", "status")
+    assert len(FakeSession.sessions[2].requests) == 5
+
+
+def test_topology_cache_partial(mocker, tmpdir):
+    FakeSession.sessions = []
+    config = fakeconfig()
+    cache_file = tmpdir.join("redfish.json")
+    config.set("redfish", "cache_file", str(cache_file))
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_redfish.get_authentication", return_value=("user", "password"))
+    mocker.patch("clara.redfish.requests.Session", side_effect=FakeSession)
+
+    # the entry of immhost1 has no system, the one of immhost2 is fine
+    cache = redfish.TopologyCache(str(cache_file))
+    cache.set("immhost1", {"vendor": "Vendor"})
+    cache.set("immhost2", {"vendor": "Vendor", "system": "/redfish/v1/Systems/1",
+                           "manager": "", "interfaces": []})
+    cache.save()
+
+    results = clara_redfish.redfish_do('host[1-2]', "power", "status")
+    assert results["immhost1"] == ["immhost1 OK: Chassis Power is On"]
+    assert results["immhost2"] == ["immhost2 OK: Chassis Power is On"]
+    assert redfish.TopologyCache(str(cache_file)).get("immhost1")["system"] == "/redfish/v1/Systems/1"
+
+    # the system of the cached topology of immhost1 was not found
+    cache = redfish.TopologyCache(str(cache_file))
+    cache.set("immhost1", {"vendor": "Vendor", "system": "/redfish/v1/Systems/old",
+                           "manager": "", "interfaces": []})
+    cache.set("immhost-down", {"vendor": "Vendor", "system": "/redfish/v1/Systems/1",
+                               "manager": "", "interfaces": []})
+    cache.save()
+    FakeSession.sessions = []
+    results = clara_redfish.redfish_do('host1', "power", "reboot")
+    assert results["immhost1"] == ["immhost1 OK"]
+    assert [r[0] for r in FakeSession.sessions[0].requests].count("POST") == 2
+
+    # a reboot which may have reached the BMC is not sent again
+    FakeSession.sessions = []
+    results = clara_redfish.redfish_do('host-down', "power", "reboot")
+    assert isinstance(results["immhost-down"], redfish.RedfishError)
+    assert len(FakeSession.sessions[0].requests) == 1
+
+
+def test_topology_cache_ttl(tmpdir):
+    path = str(tmpdir.join("cache", "redfish.json"))
+    cache = redfish.TopologyCache(path)
+    cache.set("bmc1", {"system": "/redfish/v1/Systems/1"})
+    cache.save()
+    assert redfish.TopologyCache(path).get("bmc1")["system"] == "/redfish/v1/Systems/1"
+    assert redfish.TopologyCache(path, ttl=-1).get("bmc1") is None
+
+
+class FakeSelSession(FakeSession):
+    entries = []
+
+    def request(self, method, url, json=None, timeout=None):
+        if "/LogServices/SEL/Entries" in url:
+            self.requests.append((method, url, json))
+            skip = int(url.split("$skip=")[1])
+            return FakeResponse({"Members@odata.count": len(self.entries),
+                                 "Members": self.entries[skip:]})
+        return super().request(method, url, json, timeout)
+
+
+def test_selsync(mocker, tmpdir):
+    FakeSession.sessions = []
+    config = fakeconfig()
+    config.set("redfish", "cache_file", str(tmpdir.join("redfish.json")))
+    config.set("redfish", "sel_store", str(tmpdir.join("sel.db")))
+    mocker.patch("clara.utils.getconfig", return_value=config)
+    mocker.patch("clara.plugins.clara_redfish.get_authentication", return_value=("user", "password"))
+    mocker.patch("clara.redfish.requests.Session", side_effect=FakeSelSession)
+    m_info = mocker.patch("clara.plugins.clara_redfish.logging.info")
+
+    entry = {"Id": "1", "Created": "2023-03-14T08:12:33+00:00", "SensorType": "Fan",
+             "Message": "Fan lower critical", "EntryCode": "Assert"}
+    FakeSelSession.entries = [entry, dict(entry, Id="2")]
+    clara_redfish.selsync('host1')
+    m_info.assert_called_with("host1: 2 new entries")
+
+    FakeSelSession.entries.append(dict(entry, Id="3"))
+    clara_redfish.selsync('host1')
+    m_info.assert_called_with("host1: 1 new entries")
+    # the last entry seen is fetched again to check the continuity
+    assert FakeSession.sessions[-1].requests[-1][1].endswith("?$skip=1")
+
+    # the SEL has been cleared
+    FakeSelSession.entries = [dict(entry, Id="1")]
+    clara_redfish.selsync('host1')
+    rows = clara_redfish.selstore.query(str(tmpdir.join("sel.db")), 'host1')
+    assert [row[2] for row in rows] == [1]
@@ -0,0 +1,53 @@
+from clara.relay import Relay
+from clara.sftp import Sftp
+
+
+class FakeWorker:
+
+    def __init__(self, retcode):
+        self.retcode = retcode
+
+    def node_retcode(self, node):
+        return self.retcode
+
+
+class FakeTask:
+
+    def __init__(self, failing):
+        self.failing = failing
+        self.commands = []
+
+    def shell(self, command, nodes=None):
+        self.commands.append((nodes, command))
+        return FakeWorker(1 if any(h in command for h in self.failing) else 0)
+
+    def resume(self):
+        pass
+
+
+def test_relay_hops(mocker, data_dir):
+    hosts = ['host%d' % i for i in range(10)]
+    task = FakeTask(failing=[])
+    mocker.patch("ClusterShell.Task.task_self", return_value=task)
+    m_upload = mocker.patch("clara.sftp.Sftp.upload", return_value=[])
+
+    sftp_client = Sftp(hosts, '', data_dir.id_rsa, '')
+    assert Relay(sftp_client, 2).upload(['/data/image.squashfs'], '/data') == []
+
+    # hop 1: admin -> 2 hosts, hop 2: admin -> 2 hosts and 2 relays -> 4 hosts,
+    # hop 3: admin -> last 2 hosts
+    sent = [call[1]['hosts'] for call in m_upload.call_args_list]
+    assert sent == [['host0', 'host1'], ['host2', 'host3'], ['host8', 'host9']]
+    relayed = sorted(nodes for nodes, _ in task.commands)
+    assert relayed == ['host0', 'host0', 'host1', 'host1']
+    assert "scp -p -o BatchMode=yes /data/image.squashfs host4:/data/" in task.commands[0][1]
+
+
+def test_relay_failure(mocker, data_dir):
+    hosts = ['host%d' % i for i in range(5)]
+    task = FakeTask(failing=['host2'])
+    mocker.patch("ClusterShell.Task.task_self", return_value=task)
+    mocker.patch("clara.sftp.Sftp.upload", return_value=[])
+
+    sftp_client = Sftp(hosts, '', data_dir.id_rsa, '')
+    assert Relay(sftp_client, 1).upload(['/data/image.squashfs'], '/data') == ['host2']
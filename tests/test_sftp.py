@@ -1,8 +1,81 @@
-from clara.sftp import Sftp
+from clara.sftp import Sftp, build_manifest
+import io
+import os
+import subprocess
 import pytest
 import paramiko
 
 
+class FakeChannel:
+    """ Fake paramiko.Channel running commands locally"""
+    def exec_command(self, cmd):
+        self.proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
+
+    def makefile(self, mode):
+        return io.BytesIO(self.proc.stdout)
+
+    def recv_exit_status(self):
+        return self.proc.returncode
+
+    def close(self):
+        pass
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return FakeChannel()
+
+
+class FakeFile(io.FileIO):
+    """ Fake paramiko.SFTPFile on a local file"""
+    def __init__(self, client, path, mode):
+        super(FakeFile, self).__init__(path, mode)
+        self.client = client
+        self.part = path.endswith('.part')
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self.part:
+            if self.client.fail_after == 0:
+                raise IOError("connection lost")
+            self.client.fail_after -= 1
+            self.client.written += len(data)
+        return super(FakeFile, self).write(data)
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def prefetch(self):
+        pass
+
+
+class FakeSFTPClient:
+    """ Fake paramiko.SFTPClient working on the local filesystem"""
+    def __init__(self):
+        self.written = 0
+        self.fail_after = -1
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def open(self, path, mode='r'):
+        return FakeFile(self, path, mode)
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def posix_rename(self, source, destination):
+        os.rename(source, destination)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def get_channel(self):
+        return FakeChannel()
+
+
 def test_init():
     with pytest.raises(TypeError):
         new_stfp = Sftp()
@@ -42,6 +115,95 @@ def test_upload_ssh_error(mocker, data_dir):
     mock_logger.assert_called_with("sftp/push: SSH failed to @localhost")
 
 
+def test_upload_closes_failed_transport(mocker, data_dir):
+    m_transport = mocker.patch("clara.sftp.paramiko.Transport")
+    m_transport.return_value.connect.side_effect = paramiko.ssh_exception.SSHException
+    mocker.patch("clara.sftp.Sftp._upload")
+
+    new_stfp = Sftp(['host1'], '', data_dir.id_rsa, '')
+    assert new_stfp.upload(["file"], 'destination') == ['host1']
+    m_transport.return_value.close.assert_called_once_with()
+
+
+def test_upload_reuse_transport(mocker, data_dir):
+    m_transport = mocker.patch("clara.sftp.paramiko.Transport")
+    mocker.patch("clara.sftp.paramiko.SFTPClient")
+    m_upload = mocker.patch("clara.sftp.Sftp._upload", return_value=0)
+
+    new_stfp = Sftp(['host1', 'host2', 'host3'], '', data_dir.id_rsa, '', parallel=2)
+    assert new_stfp.upload(["file"], 'destination') == []
+    assert new_stfp.upload(["file"], 'destination') == []
+    new_stfp.close()
+
+    # one transport per host for both uploads
+    assert m_transport.call_count == 3
+    assert m_upload.call_count == 6
+
+
+def test_upload_summary_failures(mocker, data_dir):
+    mocker.patch("clara.sftp.paramiko.Transport")
+    mocker.patch("clara.sftp.paramiko.SFTPClient")
+    mocker.patch("clara.sftp.Sftp._upload", side_effect=IOError("disk full"))
+    m_warning = mocker.patch("clara.sftp.logging.warning")
+
+    new_stfp = Sftp(['host1', 'host2'], '', data_dir.id_rsa, '')
+    assert sorted(new_stfp.upload(["file"], 'destination')) == ['host1', 'host2']
+    m_warning.assert_called_with("sftp/push: upload failed on %d/%d hosts: %s",
+                                 2, 2, "host1,host2")
+
+
+def test_build_manifest(tmpdir):
+    image = tmpdir.join("image.squashfs")
+    image.write_binary(b"a" * 2500)
+    manifest = build_manifest(str(image), 1000)
+    assert manifest['size'] == 2500
+    assert len(manifest['chunks']) == 3
+    assert manifest['chunks'][0] == manifest['chunks'][1] != manifest['chunks'][2]
+    assert tmpdir.join("image.squashfs.manifest").check()
+
+
+def test_chunked_put(mocker, tmpdir, data_dir):
+    mocker.patch("clara.sftp.CHECKPOINT_CHUNKS", 1)
+    source = tmpdir.mkdir("local").join("image.squashfs")
+    dest = str(tmpdir.mkdir("remote").join("image.squashfs"))
+    data = bytearray(os.urandom(10 * 1024))
+    source.write_binary(bytes(data))
+
+    new_stfp = Sftp(['host1'], '', data_dir.id_rsa, '', chunk_size=1024)
+    client = FakeSFTPClient()
+
+    # first transfer sends the whole file
+    new_stfp.manifests[str(source)] = build_manifest(str(source), 1024)
+    assert new_stfp._chunked_put(client, 'host1', str(source), dest, 0o644) == 10 * 1024
+    assert open(dest, 'rb').read() == bytes(data)
+    assert not os.path.exists(dest + ".part")
+
+    # only the modified chunks are sent, the transfer dies after one chunk
+    data[0:10] = os.urandom(10)
+    data[5000:5010] = os.urandom(10)
+    data[9000:9010] = os.urandom(10)
+    source.write_binary(bytes(data))
+    os.utime(str(source), (0, 0))
+    new_stfp.manifests[str(source)] = build_manifest(str(source), 1024)
+    client.fail_after = 1
+    with pytest.raises(IOError):
+        new_stfp._chunked_put(client, 'host1', str(source), dest, 0o644)
+    assert open(dest, 'rb').read() != bytes(data)
+
+    # the transfer is resumed with the two remaining chunks
+    client.fail_after = -1
+    client.written = 0
+    assert new_stfp._chunked_put(client, 'host1', str(source), dest, 0o644) == 2 * 1024
+    assert open(dest, 'rb').read() == bytes(data)
+    assert not os.path.exists(dest + ".part.manifest")
+
+    # the remote file was modified behind its manifest, keeping its size
+    with open(dest, 'r+b') as f:
+        f.write(b"x" * 10)
+    client.written = 0
+    assert new_stfp._chunked_put(client, 'host1', str(source), dest, 0o644) == 10 * 1024
+    assert open(dest, 'rb').read() == bytes(data)
+    assert new_stfp._chunked_put(client, 'host1', str(source), dest, 0o644) == 0
 
 
 # def test_upload(mocker):
@@ -0,0 +1,47 @@
+import pytest
+
+from clara import utils
+from tests.common import fakeconfig
+
+
+def test_config_view(mocker):
+    config = fakeconfig()
+    config.set("images", "extra_packages_image", " vim, emacs ")
+    config.set("images-calibre9", "extra_packages_image", "nano")
+    mocker.patch("clara.utils.getconfig", return_value=config)
+
+    assert utils.get_distributions() == ("calibre8", "calibre9")
+    assert utils.get_from_config("images", "extra_packages_image") == "vim, emacs"
+    assert utils.get_from_config("images", "extra_packages_image", "calibre9") == "nano"
+    assert utils.get_from_config_or("images", "missing", "calibre9", "default") == "default"
+    assert utils.get_from_config_or("images", "extra_packages_image", "calibre", "default") == "default"
+
+    # the views are compiled once and can not be modified
+    view = utils.config_view("images", "calibre9")
+    assert utils.config_view("images", "calibre9") is view
+    with pytest.raises(TypeError):
+        view._values["extra_packages_image"] = "vim"
+
+    with pytest.raises(SystemExit):
+        utils.config_view("images", "calibre")
+
+    # a modified configuration is compiled again
+    config.set("images-calibre9", "extra_packages_image", "vim")
+    assert utils.get_from_config("images", "extra_packages_image", "calibre9") == "vim"
+
+
+def test_config_view_types(mocker):
+    config = fakeconfig()
+    config.set("ipmi", "timeout", "10")
+    mocker.patch("clara.utils.getconfig", return_value=config)
+
+    assert utils.get_int_from_config_or("ipmi", "timeout") == 10
+    assert utils.get_int_from_config_or("ipmi", "retries", default=3) == 3
+    assert utils.get_int_from_config("ipmi", "port") == 7890
+    assert utils.get_bool_from_config_or("ipmi", "ssh_jump_host") is True
+    assert utils.get_bool_from_config_or("images", "sftp_chunked", "calibre9") is False
+
+    # the typed values are checked when the configuration is compiled
+    config.set("images-calibre9", "push_fanout", "many")
+    with pytest.raises(SystemExit):
+        utils.compiled_config()
@@ -1,3 +1,12 @@
+import collections
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from unittest import mock
+
 from clara.virt.libvirt.nodegroup import NodeGroup
 from clara.virt.conf.virtconf import VirtConf
 import pytest
@@ -15,16 +24,37 @@ class virDomain:
         return self._state
 
     def shutdown(self):
+        import libvirt
+        # the guests shut down at once
+        if self._name in virConnect.callbacks:
+            virConnect.callbacks[self._name](libvirt.VIR_DOMAIN_EVENT_STOPPED)
         return 0
 
 
 class virStorageVol:
     """ Fake class for libvirt.virStorageVol"""
+    calls = 0
+
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
     def info(self):
+        virStorageVol.calls += 1
         return [3, 10000000000, 0]
+
     def path(self):
+        virStorageVol.calls += 1
         return "/some_path"
 
+    wiped = []
+
+    def wipePattern(self, algorithm, flags=0):
+        virStorageVol.wiped.append(self._name)
+        return 0
+
 
 class virStoragePool:
     """ Fake class for libvirt.virStoragePool"""
@@ -35,13 +65,24 @@ class virStoragePool:
     def name(self):
         return self._name
 
+    calls = 0
+
     def listVolumes(self):
+        virStoragePool.calls += 1
         return self.volumes
 
+    def listAllVolumes(self):
+        virStoragePool.calls += 1
+        return [virStorageVol(name) for name in self.volumes]
+
     def storageVolLookupByName(self, name):
-        return virStorageVol()
+        virStoragePool.calls += 1
+        return virStorageVol(name)
+
+    created = []
 
     def createXML(self, xml_desc):
+        virStoragePool.created.append(xml_desc)
         return True
 
 class virConnect:
@@ -72,10 +113,39 @@ class virConnect:
         return self.domains
 
 
+    def getAllDomainStats(self, stats=0, flags=0):
+        return [(domain, {'state.state': domain.state()[0],
+                          'balloon.maximum': 2097152,
+                          'vcpu.current': 4})
+                for domain in self.domains]
+
+
+    lookups = 0
+
     def lookupByName(self, name):
+        virConnect.lookups += 1
         return self.domains[0]
 
 
+    callbacks = {}
+
+    def domainEventRegisterAny(self, dom, event_id, callback, opaque):
+        virConnect.callbacks[self.domains[0].name()] = lambda event: callback(
+            self, self.domains[0], event, 0, opaque)
+        return self.domains[0].name()
+
+    def domainEventDeregisterAny(self, callback_id):
+        virConnect.callbacks.pop(callback_id, None)
+
+    def registerCloseCallback(self, callback, opaque):
+        # libvirt rejects a second close callback
+        assert not getattr(self, 'close_callback', None)
+        self.close_callback = callback
+
+    def setKeepAlive(self, interval, count):
+        pass
+
+
 @pytest.fixture
 def nodegroup(mocker, data_dir):
     """it setup mock object for libvirt module and returns
@@ -110,6 +180,115 @@ def test_nodegroup_vms(nodegroup):
     assert volumes[0].get_capacity() == '10.0 GB'
 
 
+def test_nodegroup_inventory(nodegroup):
+    """The inventory is built without looking up the domains one by one"""
+    virConnect.lookups = 0
+    vms = nodegroup.get_vms()
+    assert virConnect.lookups == 0
+    assert vms['node2'].get_host_state() == {'hw2': 'RUNNING'}
+    assert vms['node1'].get_info() == [1, 2097152, 0, 4, 0]
+
+
+def test_pool_rpc_count(nodegroup):
+    """The volumes of a pool are described without looking them up one by one"""
+    pool = virConnect.pools[0]
+    volumes = pool.volumes
+    pool.volumes = ['node%d_disk' % i for i in range(1000)]
+    virStoragePool.calls = virStorageVol.calls = 0
+    try:
+        vms = nodegroup.get_vms()
+    finally:
+        pool.volumes = volumes
+    calls = virStoragePool.calls + virStorageVol.calls
+    # listAllVolumes, then info() and path() once per volume
+    assert calls == 1 + 2 * 1000
+    assert len(vms) == 1000
+    assert vms['node999'].get_volumes()[0].get_capacity() == '10.0 GB'
+
+
+def test_list_formats(nodegroup):
+    """The inventory is rendered from a single report in all the formats"""
+    from clara.virt import report
+
+    hosts = report.build_report(nodegroup)
+    assert [host['name'] for host in hosts] == ['hw1', 'hw2']
+    assert hosts[0]['used_memory'] == 2048
+    assert hosts[0]['vms'][0]['volumes'][0]['capacity'] == 10000000000
+
+    data = json.loads(report.render_json(hosts))
+    assert data['hosts'][1]['vms'][0]['name'] == 'node2'
+    assert report.render_csv(hosts).splitlines() == [
+        'host,vm,state,role,anti_affinity,memory,cpus,volumes',
+        'hw1,node1,RUNNING,de,False,2048,4,node1_disk',
+        'hw2,node2,RUNNING,de,False,2048,4,']
+    table = report.render_table(report.build_report(nodegroup, host_name='hw2')).splitlines()
+    assert 'node2' in table[5] and len(table) == 7
+
+
+def test_wait_state(nodegroup):
+    """The states of the VMs are tracked with the lifecycle events"""
+    import libvirt
+    from clara.virt.watcher import StateWatcher
+
+    virConnect.callbacks = {}
+    watcher = StateWatcher(nodegroup, ['node1', 'node2', 'node3'])
+    assert watcher.pending('RUNNING') == ['node3']
+
+    def stop():
+        for callback in virConnect.callbacks.values():
+            callback(libvirt.VIR_DOMAIN_EVENT_STOPPED)
+
+    threading.Timer(0.1, stop).start()
+    assert watcher.wait('SHUTOFF', timeout=0.5) == ['node3']
+    assert watcher.get_state('node1') == 'SHUTOFF'
+    virConnect.callbacks['node1'](libvirt.VIR_DOMAIN_EVENT_UNDEFINED)
+    assert watcher.wait('MISSING', timeout=0.1) == ['node2']
+
+
+def test_start_stop_stages(nodegroup, capsys):
+    """The VMs are stopped by reverse order of their roles"""
+    from clara.virt.actions import ActionRunner, get_stages, print_summary
+
+    role_order = {'adm': 1, 'batch': 2}
+    vm_names = ['frbatch1', 'frlogin1', 'fradm1', 'frbatch2']
+    assert get_stages(vm_names, role_order) == [['fradm1'], ['frbatch1', 'frbatch2'], ['frlogin1']]
+    assert get_stages(vm_names, role_order, reverse=True)[0] == ['frlogin1']
+
+    virConnect.callbacks = {}
+    results = ActionRunner(nodegroup, parallel=2, stage_timeout=0.5).run(
+        'stop', [['node1'], ['node2'], ['node3']])
+    assert {vm_name: success for vm_name, (success, _) in results.items()} == \
+        {'node1': True, 'node2': True, 'node3': False}
+    assert print_summary('stop', results, 1.0) == ['node3']
+    assert "stop: 3 VM(s) in 1.0s, 1 failed" in capsys.readouterr().out
+    # the events are not watched after the action
+    assert virConnect.callbacks == {}
+
+    # the events of the same connections are watched again, as in the agent
+    results = ActionRunner(nodegroup, stage_timeout=0.5).run('stop', [['node1'], ['node2']])
+    assert results['node2'][0] is True
+
+
+def test_start_stop_stage_timeout(nodegroup, mocker):
+    """The next roles are not stopped while the VMs of a role are running"""
+    from clara.virt.actions import ActionRunner
+
+    mocker.patch.object(virDomain, 'shutdown', return_value=0)
+    results = ActionRunner(nodegroup, stage_timeout=0.1).run('stop', [['node1'], ['node2']])
+    assert results['node1'][0] is False
+    assert results['node2'] == (False, 0.0)
+
+
+def test_wipe_vms(nodegroup):
+    """The volumes of the VMs are wiped with the strategy of their pool"""
+    vms = nodegroup.get_vms()
+    nodegroup.get_pool().wipe_strategy = 'zero'
+    virStorageVol.wiped = []
+    vms['node1'].state = 'SHUTOFF'
+    assert nodegroup.wipe_vms([vms['node1'], vms['node2']]) == {'node2'}
+    assert virStorageVol.wiped == ['node1_disk']
+
+
 def test_vm_actions(nodegroup):
     """It tests VM actions"""
     vms = nodegroup.get_vms()
@@ -135,3 +314,171 @@ def test_create_volume(nodegroup, data_dir):
     vms = nodegroup.get_vms()
     vm1 = list(vms.values())[0]
     vm1.create_volumes("node", data_dir.root)
+
+
+def test_load_template(tmpdir):
+    from clara.virt.libvirt.vm import load_template
+
+    template = tmpdir.join("vol.xml")
+    template.write("<name>{{ name }}</name>")
+    assert load_template(str(template)).render(name="a") == "<name>a</name>"
+    assert load_template(str(template)) is load_template(str(template))
+    # an edited template is read again
+    template.write("<volume>{{ name }}</volume>")
+    os.utime(str(template), ns=(0, 0))
+    assert load_template(str(template)).render(name="a") == "<volume>a</volume>"
+
+
+def test_create_volumes_batch(nodegroup, data_dir):
+    from clara.virt.libvirt.vm import _compile_template
+
+    vms = nodegroup.get_vm_list(['node1', 'node3', 'node4'], create=True)
+    _compile_template.cache_clear()
+    xml_descs = []
+    for vm in vms:
+        xml_descs += vm.get_missing_volumes("node", data_dir.root)
+    # one system volume per VM, the template is read once
+    assert len(xml_descs) == 3
+    assert _compile_template.cache_info().misses == 1
+
+    virStoragePool.created = []
+    virStoragePool.calls = 0
+    assert nodegroup.get_pool().create_volumes(xml_descs) == []
+    assert len(virStoragePool.created) == 3
+    # the pool is listed once after all the creations
+    assert virStoragePool.calls == 1
+
+
+class FakeGroup:
+    """Node group of the agent, counting the connections"""
+    connections = 0
+
+    def __init__(self):
+        FakeGroup.connections += 1
+        self.broken = False
+        self.stale = True
+
+    def watch_events(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_agent(tmpdir, capsys):
+    from clara.virt import agent
+    import threading
+
+    def do_list(group, params):
+        print("VM list of %s" % params['host_name'])
+        logging.getLogger("clara.virt").warning("warning sent back")
+
+    path = str(tmpdir.join("virt.sock"))
+    virt_agent = agent.Agent(path, "/etc/clara/virt.ini", {'list': do_list}, FakeGroup)
+    server = virt_agent.listen()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for _ in range(2):
+            reply = agent.request(path, "/etc/clara/virt.ini", 'list', {'host_name': 'hw1'})
+            assert agent.replay(reply) == 0
+        assert "VM list of hw1" in capsys.readouterr().out
+        assert reply['records'] == [[logging.WARNING, "clara.virt", "warning sent back"]]
+        # the connections are kept between the requests
+        assert FakeGroup.connections == 1
+
+        with pytest.raises(agent.AgentUnavailable):
+            agent.request(path, "/tmp/virt.ini", 'list', {})
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # the agent dies once the command is sent, it must not be run again
+    def die(listener):
+        conn, _ = listener.accept()
+        conn.makefile('rb').readline()
+        conn.close()
+
+    os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    threading.Thread(target=die, args=(listener,), daemon=True).start()
+    try:
+        with pytest.raises(agent.AgentError):
+            agent.request(path, "/etc/clara/virt.ini", 'list', {})
+    finally:
+        listener.close()
+
+
+def test_placement_plan(capsys):
+    from clara.virt.placement import HostLoad, Placement, print_plan
+
+    hosts = [HostLoad('hw1', 16384, 8), HostLoad('hw2', 16384, 8), HostLoad('hw3', 12288, 8)]
+    hosts[0].add('exbatch1', 4096, 2)
+    hosts[0].add('exadmin1', 8192, 4)
+    hosts[1].add('exbatch2', 2048, 2)
+    hosts[2].add('exproxy1', 6144, 2)
+    placement = Placement(hosts)
+
+    plan = placement.plan(['exbatch1', 'exadmin1'])
+    # the biggest VM first, only hw2 has enough memory left for it, then the
+    # batch VM avoids the host running the other batch VM
+    assert plan == [('exadmin1', 'hw2'), ('exbatch1', 'hw3')]
+    # the drained host is now the best one for a new VM
+    assert placement.elect('exbatch3', 1024, 1) == 'hw1'
+    # no host has enough memory
+    assert placement.elect('exbatch3', 32768, 1) is None
+
+    print_plan(plan, placement, {'exadmin1': 'hw1', 'exbatch1': 'hw1'})
+    output = capsys.readouterr().out
+    assert "VM:exadmin1         hw1              -> hw2" in output
+    assert "Host:hw2              Memory(MiB):   10240/16384    ( 62%)" in output
+
+
+class FakeMigrationClient:
+    """Client recording the concurrent migrations, the first migration of
+    'exfail1' fails"""
+
+    def __init__(self, hostname, record):
+        self.hostname = hostname
+        self.record = record
+
+    def vm_migrate(self, vm_name, dest_client, bandwidth=0, compressed=False,
+                   auto_converge=False):
+        from libvirt import libvirtError
+        record = self.record
+        with record['lock']:
+            record['running'].append(dest_client.hostname)
+            record['max'] = max(record['max'], len(record['running']))
+            record['max_per_host'] = max(record['max_per_host'],
+                                         record['running'].count(dest_client.hostname))
+            record['attempts'][vm_name] += 1
+            fail = vm_name == 'exfail1' and record['attempts'][vm_name] == 1
+        time.sleep(0.05)
+        with record['lock']:
+            record['running'].remove(dest_client.hostname)
+        if fail:
+            raise libvirtError("migration failed")
+
+    def get_migration_progress(self, vm_name):
+        return None
+
+
+def test_migration_scheduler():
+    from clara.virt.migration import MigrationScheduler
+
+    record = {'lock': threading.Lock(), 'running': [], 'max': 0, 'max_per_host': 0,
+              'attempts': collections.Counter()}
+    group = mock.Mock()
+    group.get_clients.return_value = {host: FakeMigrationClient(host, record)
+                                      for host in ['hw1', 'hw2', 'hw3']}
+    plan = [('exbatch%d' % i, 'hw1', 'hw%d' % (2 + i % 2)) for i in range(6)]
+    plan += [('exfail1', 'hw1', 'hw2'), ('exbatch9', 'hw1', 'hw4')]
+
+    scheduler = MigrationScheduler(group, parallel=3, per_host=2, retries=1,
+                                   interval=0.01, retry_delay=0)
+    assert scheduler.run(plan) == ['exbatch9']
+    assert record['max'] == 3
+    assert record['max_per_host'] == 2
+    # the failed migration has been retried
+    assert record['attempts']['exfail1'] == 2